@@ -0,0 +1,223 @@
+import socket
+import ssl
+import errno
+import logging
+import threading
+from SimpleWebSocketServer import BroadcastMixin, KeepaliveMixin
+
+try:
+	import asyncio
+except ImportError:
+	# python 2 backport of asyncio with the same API
+	import trollius as asyncio
+
+
+class TransportSocket(object):
+	# socket-like facade over an asyncio transport so WebSocket runs unchanged on top of it
+
+	def __init__(self, server, transport):
+		self.server = server
+		self.transport = transport
+		self.recvbuffer = bytearray()
+		self.paused = False
+		self.scheduled = 0
+
+		sock = transport.get_extra_info('socket')
+		self._fileno = sock.fileno() if sock is not None else id(self)
+
+	def fileno(self):
+		return self._fileno
+
+	def setblocking(self, flag):
+		pass
+
+	def feed(self, data):
+		self.recvbuffer.extend(data)
+
+	def pending(self):
+		return len(self.recvbuffer)
+
+	def recv(self, size):
+		data = str(self.recvbuffer[:size])
+		del self.recvbuffer[:size]
+		return data
+
+	def recv_into(self, view, size=0):
+		size = min(size or len(view), len(self.recvbuffer))
+		view[:size] = self.recvbuffer[:size]
+		del self.recvbuffer[:size]
+		return size
+
+	def send(self, data):
+		# the transport buffers everything, so honour the protocol flow control instead
+		if self.paused:
+			raise socket.error(errno.EAGAIN, 'transport paused')
+
+		data = str(data)
+		if self.scheduled == 0 and self.server.inLoopThread():
+			self.transport.write(data)
+		else:
+			# transports are not thread safe, keep the order of writes coming from other threads
+			self.scheduled += 1
+			self.server.loop.call_soon_threadsafe(self.writeScheduled, data)
+		return len(data)
+
+	def writeScheduled(self, data):
+		self.scheduled -= 1
+		self.transport.write(data)
+
+	def close(self):
+		self.transport.close()
+
+
+class WebSocketProtocol(asyncio.Protocol):
+
+	def __init__(self, server):
+		self.server = server
+		self.client = None
+		self.sock = None
+
+	def connection_made(self, transport):
+		if self.server.loopthread is None:
+			self.server.loopthread = threading.current_thread()
+
+		transport.set_write_buffer_limits(high=self.server.writeHighWater)
+		self.sock = TransportSocket(self.server, transport)
+		address = transport.get_extra_info('peername')
+		try:
+			self.client = self.server.constructWebSocket(self.sock, address)
+		except Exception as n:
+			logging.debug(str(address) + ' ' + str(n))
+			transport.close()
+			return
+
+		self.server.connections[self.client.fileno] = self.client
+		self.server.keepalive(self.client)
+
+	def data_received(self, data):
+		if self.client is None:
+			return
+
+		self.sock.feed(data)
+		try:
+			while self.sock.pending() > 0 and self.client.fileno in self.server.connections:
+				self.client.handleData()
+
+		except Exception as n:
+
+			logging.debug(str(self.client.address) + ' ' + str(n))
+
+			self.server.removeConnection(self.client)
+
+	def eof_received(self):
+		return False
+
+	def connection_lost(self, exc):
+		if self.client is not None:
+			self.server.removeConnection(self.client)
+
+	def pause_writing(self):
+		self.sock.paused = True
+
+	def resume_writing(self):
+		self.sock.paused = False
+		if self.client is None:
+			return
+
+		try:
+			self.client.handleWrite()
+
+		except Exception as n:
+
+			logging.debug(str(self.client.address) + ' ' + str(n))
+
+			self.server.removeConnection(self.client)
+
+
+class AsyncWebSocketServer(BroadcastMixin, KeepaliveMixin):
+	def __init__(self, host, port, websocketclass, loop=None):
+		self.websocketclass = websocketclass
+		self.host = host
+		self.port = port
+		self.loop = loop or asyncio.get_event_loop()
+		self.server = None
+		self.loopthread = None
+
+		# pause a connection once this many bytes are buffered in its transport
+		self.writeHighWater = 65536
+
+		# fileno -> WebSocket
+		self.connections = {}
+		# group name -> set of WebSocket
+		self.groups = {}
+
+	def inLoopThread(self):
+		return self.loopthread is None or self.loopthread is threading.current_thread()
+
+	def sslContext(self):
+		return None
+
+	def constructWebSocket(self, sock, address):
+		return self.websocketclass(self, sock, address)
+
+	def callLater(self, delay, callback, *args):
+		return self.loop.call_later(delay, callback, *args)
+
+	def setWriteInterest(self, client, wanted):
+		# the protocol resumes the send queue from resume_writing
+		pass
+
+	def removeConnection(self, client):
+		if self.connections.pop(client.fileno, None) is None:
+			return
+
+		self.leaveAll(client)
+
+		try:
+			client.handleClose()
+		except:
+			pass
+
+		client.close()
+
+	def start(self):
+		# returns a future, run it on the loop when it is shared with other services
+		return self.loop.create_server(lambda: WebSocketProtocol(self),
+		                               self.host or None, self.port,
+		                               ssl=self.sslContext(), reuse_address=True)
+
+	def close(self):
+		if self.server is not None:
+			self.server.close()
+
+		for conn in self.connections.values():
+			self.removeConnection(conn)
+
+	def serveforever(self):
+		self.loopthread = threading.current_thread()
+		self.server = self.loop.run_until_complete(self.start())
+		try:
+			self.loop.run_forever()
+		finally:
+			self.close()
+
+
+class AsyncSSLWebSocketServer(AsyncWebSocketServer):
+
+	def __init__(self, host, port, websocketclass, certfile, keyfile, version = ssl.PROTOCOL_TLSv1, loop=None):
+
+		AsyncWebSocketServer.__init__(self, host, port, websocketclass, loop)
+
+		self.cerfile = certfile
+		self.keyfile = keyfile
+		self.version = version
+
+	def sslContext(self):
+		context = ssl.SSLContext(self.version)
+		context.load_cert_chain(self.cerfile, self.keyfile)
+		return context
+
+	def constructWebSocket(self, sock, address):
+		ws = self.websocketclass(self, sock, address)
+		ws.usingssl = True
+		return ws
@@ -0,0 +1,230 @@
+import os
+import time
+import errno
+import struct
+import signal
+import socket
+import logging
+import multiprocessing
+from select import select
+from SimpleWebSocketServer import SimpleWebSocketServer, SO_REUSEPORT
+
+# largest relay datagram, header included; well under the default unix socket buffer so the kernel never refuses one
+RELAY_MAXSIZE = 65536
+
+
+def packBroadcast(message, group):
+	# flag byte (text or binary), group name and payload in one datagram
+	flag = 1 if isinstance(message, str) else 2
+	group = '' if group is None else str(group)
+	return struct.pack('!BH', flag, len(group)) + group + str(message)
+
+
+def unpackBroadcast(data):
+	flag, size = struct.unpack_from('!BH', data)
+	group = data[3:3+size] or None
+	message = data[3+size:]
+	if flag == 2:
+		message = bytearray(message)
+	return message, group
+
+
+class WorkerRelay(object):
+	# a worker's end of the datagram pair shared with the supervisor
+
+	def __init__(self, server, sock):
+		self.server = server
+		self.sock = sock
+		self.sock.setblocking(0)
+		server.relay = self
+		server.addReader(sock.fileno(), self.handleData)
+
+	def forward(self, message, group):
+		data = packBroadcast(message, group)
+		if len(data) > RELAY_MAXSIZE:
+			# refused up front, a datagram cut short would reach the other workers corrupted
+			raise ValueError('broadcast of ' + str(len(data)) + ' bytes exceeds the relay limit of ' + str(RELAY_MAXSIZE))
+
+		try:
+			self.sock.send(data)
+		except socket.error as e:
+			logging.debug('relay ' + str(e))
+
+	def handleData(self):
+		while True:
+			try:
+				# one spare byte tells a truncated datagram from one of exactly the limit
+				data = self.sock.recv(RELAY_MAXSIZE + 1)
+			except socket.error as e:
+				if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+					return
+				raise e
+
+			if len(data) > RELAY_MAXSIZE:
+				logging.error('relay dropped an oversized broadcast')
+				continue
+
+			message, group = unpackBroadcast(data)
+			self.server.broadcast(message, group=group)
+
+
+class PreforkWebSocketServer(object):
+	def __init__(self, host, port, websocketclass, workers=None, backlog=128, serverclass=SimpleWebSocketServer, **serverargs):
+		if SO_REUSEPORT is None:
+			raise socket.error(errno.ENOPROTOOPT, 'pre-fork workers need SO_REUSEPORT, not available on this platform')
+
+		self.host = host
+		self.port = port
+		self.websocketclass = websocketclass
+		self.numworkers = workers or multiprocessing.cpu_count()
+		self.backlog = backlog
+		self.serverclass = serverclass
+		self.serverargs = serverargs
+
+		# wait this long before restarting a worker that died, avoids a fork loop on a bad bind
+		self.restartDelay = 1.0
+		self.selectInterval = 1.0
+
+		# pid -> (worker index, supervisor end of the relay pair)
+		self.workers = {}
+		# worker index -> time it may be restarted, so the loop keeps relaying while it waits
+		self.restarts = {}
+		self.running = False
+
+	def spawnWorker(self, index):
+		parent, child = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+
+		pid = os.fork()
+		if pid == 0:
+			parent.close()
+			for _, sock in self.workers.itervalues():
+				sock.close()
+			signal.signal(signal.SIGTERM, signal.SIG_DFL)
+			signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+			status = 0
+			try:
+				self.runWorker(index, child)
+			except Exception as n:
+				logging.error('worker ' + str(index) + ' ' + str(n))
+				status = 1
+			finally:
+				os._exit(status)
+
+		child.close()
+		parent.setblocking(0)
+		self.workers[pid] = (index, parent)
+
+	def runWorker(self, index, sock):
+		server = self.serverclass(self.host, self.port, self.websocketclass, backlog=self.backlog, reusePort=True, **self.serverargs)
+		server.workerIndex = index
+		WorkerRelay(server, sock)
+		server.serveforever()
+
+	def relayBroadcasts(self, ready):
+		for pid, (index, sock) in self.workers.items():
+			if sock.fileno() not in ready:
+				continue
+
+			while True:
+				try:
+					data = sock.recv(RELAY_MAXSIZE + 1)
+				except socket.error as e:
+					if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+						break
+					raise e
+
+				if len(data) > RELAY_MAXSIZE:
+					logging.error('relay dropped an oversized broadcast from worker ' + str(index))
+					continue
+
+				for other, (_, othersock) in self.workers.items():
+					if other == pid:
+						continue
+					try:
+						othersock.send(data)
+					except socket.error as e:
+						# a worker that is not draining its relay loses the broadcast, never the supervisor
+						logging.debug('relay to worker ' + str(other) + ' ' + str(e))
+
+	def reapWorkers(self):
+		while True:
+			try:
+				pid, status = os.waitpid(-1, os.WNOHANG)
+			except OSError as e:
+				if e.errno == errno.ECHILD:
+					return
+				raise e
+
+			if pid == 0:
+				return
+
+			worker = self.workers.pop(pid, None)
+			if worker is None:
+				continue
+
+			index, sock = worker
+			sock.close()
+			logging.warning('worker ' + str(index) + ' (pid ' + str(pid) + ') exited with status ' + str(status))
+
+			if self.running:
+				self.restarts[index] = time.time() + self.restartDelay
+
+	def restartWorkers(self):
+		now = time.time()
+		for index, when in self.restarts.items():
+			if when <= now:
+				del self.restarts[index]
+				self.spawnWorker(index)
+
+	def pollTimeout(self):
+		# wake up in time for the next pending restart
+		timeout = self.selectInterval
+		if self.restarts:
+			timeout = min(timeout, max(0, min(self.restarts.itervalues()) - time.time()))
+		return timeout
+
+	def stop(self, *args):
+		self.running = False
+
+	def close(self):
+		self.running = False
+		for pid, (_, sock) in self.workers.items():
+			try:
+				os.kill(pid, signal.SIGTERM)
+			except OSError:
+				pass
+			sock.close()
+
+		for pid in self.workers.keys():
+			try:
+				os.waitpid(pid, 0)
+			except OSError:
+				pass
+
+		self.workers = {}
+		self.restarts = {}
+
+	def serveforever(self):
+		self.running = True
+		signal.signal(signal.SIGTERM, self.stop)
+		signal.signal(signal.SIGINT, self.stop)
+
+		for index in xrange(self.numworkers):
+			self.spawnWorker(index)
+
+		try:
+			while self.running:
+				fds = [sock.fileno() for _, sock in self.workers.itervalues()]
+				try:
+					ready, _, _ = select(fds, [], [], self.pollTimeout())
+				except Exception as e:
+					if e.args[0] != errno.EINTR:
+						raise
+					ready = []
+
+				self.relayBroadcasts(set(ready))
+				self.reapWorkers()
+				self.restartWorkers()
+		finally:
+			self.close()
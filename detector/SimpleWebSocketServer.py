@@ -8,9 +8,296 @@ import time
 import sys
 import errno
 import logging
+import select
+import zlib
+import threading
+import heapq
+import itertools
+from collections import deque
 from BaseHTTPServer import BaseHTTPRequestHandler
 from StringIO import StringIO
-from select import select
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+
+def unmask(payload, mask, start=0, end=None):
+	# xor payload[start:end] in place with the 4 byte mask, a word at a time when numpy is around;
+	# start is the offset of the region inside the frame payload
+	if end is None:
+		end = len(payload)
+	length = end - start
+	if length <= 0:
+		return payload
+
+	rotate = start % 4
+	mask = mask[rotate:] + mask[:rotate]
+
+	if numpy is not None:
+		words = length // 4
+		if words > 0:
+			view = numpy.frombuffer(payload, dtype=numpy.uint32, count=words, offset=start)
+			numpy.bitwise_xor(view, numpy.frombuffer(mask, dtype=numpy.uint32)[0], out=view)
+		for i in xrange(words * 4, length):
+			payload[start + i] ^= mask[i % 4]
+	else:
+		key = (str(mask) * (length // 4 + 1))[:length]
+		value = int(str(payload[start:end]).encode('hex'), 16) ^ int(key.encode('hex'), 16)
+		payload[start:end] = ('%x' % value).zfill(length * 2).decode('hex')
+
+	return payload
+
+
+def encodeFrame(opcode, payload, fin=True, rsv=0):
+	# header and payload in one immutable buffer, so the same frame can be queued to many connections
+	b1 = opcode | rsv
+	if fin:
+		b1 |= 0x80
+
+	length = len(payload)
+	if length <= 125:
+		header = struct.pack('!BB', b1, length)
+	elif length <= 65535:
+		header = struct.pack('!BBH', b1, 126, length)
+	else:
+		header = struct.pack('!BBQ', b1, 127, length)
+
+	return header + str(payload)
+
+
+#if s is a string then websocket TEXT is sent else BINARY
+def encodeMessage(s, hixie76=False):
+	if hixie76 is True:
+		return '\x00' + str(s).encode("UTF8") + '\xff'
+
+	if isinstance(s, str):
+		return encodeFrame(WebSocket.TEXT, s)
+	return encodeFrame(WebSocket.BINARY, s)
+
+
+class PerMessageDeflate(object):
+	# permessage-deflate (RFC 7692) compression state of one connection
+
+	TAIL = '\x00\x00\xff\xff'
+
+	def __init__(self, serverWindowBits=15, serverContextTakeover=True, clientContextTakeover=True):
+		self.serverWindowBits = serverWindowBits
+		self.serverContextTakeover = serverContextTakeover
+		self.clientContextTakeover = clientContextTakeover
+		self.compressor = None
+		self.decompressor = None
+
+	@classmethod
+	def negotiate(cls, header, windowBits=15, contextTakeover=True):
+		# returns the state and the response for the first acceptable offer, or None
+		for offer in header.split(','):
+			params = [param.strip() for param in offer.split(';')]
+			if params[0] != 'permessage-deflate':
+				continue
+
+			accepted = cls.accept(params[1:], windowBits, contextTakeover)
+			if accepted is not None:
+				return accepted
+
+		return None
+
+	@classmethod
+	def accept(cls, params, windowBits, contextTakeover):
+		serverWindowBits = windowBits
+		serverContextTakeover = contextTakeover
+		clientContextTakeover = True
+		seen = set()
+
+		for param in params:
+			name, _, value = param.partition('=')
+			name = name.strip()
+			value = value.strip().strip('"')
+			if name in seen:
+				return None
+			seen.add(name)
+
+			if name == 'server_no_context_takeover':
+				if value:
+					return None
+				serverContextTakeover = False
+
+			elif name == 'client_no_context_takeover':
+				if value:
+					return None
+				clientContextTakeover = False
+
+			elif name == 'server_max_window_bits':
+				# zlib cannot write raw deflate streams with a 256 byte window, so 8 is declined
+				if not value.isdigit() or not 9 <= int(value) <= 15:
+					return None
+				serverWindowBits = min(serverWindowBits, int(value))
+
+			elif name == 'client_max_window_bits':
+				# we always inflate with the largest window, any client window is fine
+				if value and (not value.isdigit() or not 8 <= int(value) <= 15):
+					return None
+
+			else:
+				return None
+
+		response = ['permessage-deflate']
+		if serverContextTakeover is False:
+			response.append('server_no_context_takeover')
+		if clientContextTakeover is False:
+			response.append('client_no_context_takeover')
+		if serverWindowBits < 15:
+			response.append('server_max_window_bits=%d' % serverWindowBits)
+
+		return cls(serverWindowBits, serverContextTakeover, clientContextTakeover), '; '.join(response)
+
+	def compress(self, data):
+		if self.compressor is None:
+			self.compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -self.serverWindowBits)
+
+		out = self.compressor.compress(str(data)) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+		if self.serverContextTakeover is False:
+			self.compressor = None
+
+		if out.endswith(self.TAIL):
+			out = out[:-4]
+		return out
+
+	def decompress(self, data, fin, maxsize):
+		if self.decompressor is None:
+			self.decompressor = zlib.decompressobj(-15)
+
+		# streaming hands each chunk over as a memoryview, and str() of one is its repr, not its bytes
+		data = data.tobytes() if isinstance(data, memoryview) else str(data)
+		if fin:
+			data += self.TAIL
+
+		out = self.decompressor.decompress(data, maxsize)
+		# inflating past the limit leaves input behind, treat it like an oversized payload
+		if self.decompressor.unconsumed_tail:
+			raise Exception('payload exceeded allowable size')
+
+		if fin and self.clientContextTakeover is False:
+			self.decompressor = None
+		return out
+
+
+POLLREAD = select.POLLIN | select.POLLPRI
+POLLWRITE = select.POLLOUT
+POLLERROR = select.POLLERR | select.POLLHUP | select.POLLNVAL
+
+# python 2 does not export it; only platforms whose value is known get it, elsewhere it stays None
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', None)
+if SO_REUSEPORT is None:
+	if sys.platform.startswith('linux'):
+		SO_REUSEPORT = 15
+	elif sys.platform == 'darwin' or 'bsd' in sys.platform:
+		SO_REUSEPORT = 0x200
+
+
+class SelectPoller(object):
+	# fallback for platforms without epoll or poll, limited to FD_SETSIZE descriptors
+
+	def __init__(self):
+		self.fds = {}
+
+	def register(self, fileno, events):
+		self.fds[fileno] = events
+
+	def modify(self, fileno, events):
+		self.fds[fileno] = events
+
+	def unregister(self, fileno):
+		self.fds.pop(fileno, None)
+
+	def close(self):
+		self.fds = {}
+
+	def poll(self, timeout):
+		fds = self.fds.items()
+		rlist = [fd for fd, events in fds if events & POLLREAD]
+		wlist = [fd for fd, events in fds if events & POLLWRITE]
+		xlist = [fd for fd, events in fds]
+
+		rList, wList, xList = select.select(rlist, wlist, xlist, timeout)
+
+		ready = {}
+		for fd in rList:
+			ready[fd] = ready.get(fd, 0) | select.POLLIN
+		for fd in wList:
+			ready[fd] = ready.get(fd, 0) | select.POLLOUT
+		for fd in xList:
+			ready[fd] = ready.get(fd, 0) | select.POLLERR
+		return ready.items()
+
+
+class PollPoller(object):
+
+	def __init__(self):
+		self.poller = select.poll()
+
+	def register(self, fileno, events):
+		self.poller.register(fileno, events)
+
+	def modify(self, fileno, events):
+		self.poller.modify(fileno, events)
+
+	def unregister(self, fileno):
+		self.poller.unregister(fileno)
+
+	def close(self):
+		# poll keeps no descriptor of its own
+		pass
+
+	def poll(self, timeout):
+		# poll takes milliseconds
+		if timeout is not None:
+			timeout = int(timeout * 1000)
+		return self.poller.poll(timeout)
+
+
+class EpollPoller(object):
+
+	def __init__(self):
+		self.poller = select.epoll()
+
+	def register(self, fileno, events):
+		self.poller.register(fileno, events)
+
+	def modify(self, fileno, events):
+		self.poller.modify(fileno, events)
+
+	def unregister(self, fileno):
+		self.poller.unregister(fileno)
+
+	def close(self):
+		self.poller.close()
+
+	def poll(self, timeout):
+		if timeout is None:
+			timeout = -1
+		return self.poller.poll(timeout)
+
+
+def createPoller():
+	if hasattr(select, 'epoll'):
+		return EpollPoller()
+	if hasattr(select, 'poll'):
+		return PollPoller()
+	return SelectPoller()
+
+
+class Timer(object):
+
+	def __init__(self, when, callback, args):
+		self.when = when
+		self.callback = callback
+		self.args = args
+		self.cancelled = False
+
+	def cancel(self):
+		self.cancelled = True
 
 
 class HTTPRequest(BaseHTTPRequestHandler):
@@ -27,7 +314,8 @@ class WebSocket(object):
 		"HTTP/1.1 101 Switching Protocols\r\n"
 		"Upgrade: WebSocket\r\n"
 		"Connection: Upgrade\r\n"
-		"Sec-WebSocket-Accept: %(acceptstr)s\r\n\r\n"
+		"Sec-WebSocket-Accept: %(acceptstr)s\r\n"
+		"%(headers)s\r\n"
 	)
 	
 	hixiehandshakedStr = (
@@ -47,16 +335,30 @@ class WebSocket(object):
 	PING = 0x9
 	PONG = 0xA
 
-	HEADERB1 = 1
-	HEADERB2 = 3
-	LENGTHSHORT = 4
-	LENGTHLONG = 5
-	MASK = 6
-	PAYLOAD = 7
+	# permessage-deflate settings, off unless a subclass sets deflate to True
+	deflate = False
+	deflateWindowBits = 15
+	deflateContextTakeover = True
+	# messages shorter than this are sent uncompressed
+	deflateThreshold = 128
+
+	# messages are refused once this many bytes wait in the send queue, 0 disables
+	maxSendQueue = 16777216
+
+	# subprotocols we speak, in order of preference, matched against Sec-WebSocket-Protocol
+	subprotocols = ()
+
+	# hand data to handleStream as it arrives instead of assembling whole messages for handleMessage
+	streaming = False
+
+	# seconds without traffic before we ping the client and before we drop it, None disables
+	pingInterval = None
+	idleTimeout = None
 
 	def __init__(self, server, sock, address):
 		self.server = server
 		self.client = sock
+		self.fileno = sock.fileno()
 		self.address = address
 		
 		self.handshaked = False
@@ -69,15 +371,47 @@ class WebSocket(object):
 		self.fin = 0
 		self.data = None
 		self.opcode = 0
-		self.hasmask = 0
-		self.maskarray = None
 		self.length = 0
-		self.lengtharray = None
-		self.index = 0
 		self.request = None
 		self.usingssl = False
-
-		self.state = self.HEADERB1
+		self.subprotocol = None
+
+		self.recvbuffer = bytearray()
+		self.recvsize = 65536
+
+		# a data frame larger than a recv is read straight into a buffer of its announced length
+		self.framebuffer = None
+		self.frameheader = 0
+		self.framemask = None
+		self.framefilled = 0
+
+		# message being assembled from fragments
+		self.messageopcode = None
+		self.messagelength = 0
+		self.fragments = []
+
+		# outbound [frame, key] entries waiting for the socket to drain, sent by the server loop on
+		# write readiness; an entry whose frame was replaced by a newer one with the same key is None
+		self.sendq = deque()
+		self.sendoffset = 0
+		# key -> newest queued entry for that key
+		self.sendkeys = {}
+		self.senddepth = 0
+		self.sendbytes = 0
+		self.sendmaxdepth = 0
+		self.coalesced = 0
+		self.sendlock = threading.RLock()
+		self.writeinterest = False
+
+		self.lastrecv = time.time()
+		self.lastping = 0
+
+		# PerMessageDeflate when negotiated in the handshake
+		self.compression = None
+		self.compressed = False
+
+		# names of the server groups this connection joined
+		self.groups = set()
 	
 		# restrict the size of header and payload for security reasons
 		self.maxheader = 65536
@@ -85,8 +419,15 @@ class WebSocket(object):
 
 	def close(self):
 		self.client.close()
-		self.state = self.HEADERB1
-		self.hasmask = False
+		self.recvbuffer = bytearray()
+		self.framebuffer = None
+		self.messageopcode = None
+		self.fragments = []
+		self.sendq.clear()
+		self.sendoffset = 0
+		self.sendkeys = {}
+		self.senddepth = 0
+		self.sendbytes = 0
 		self.handshaked = False
 		self.readdraftkey = False
 		self.hixie76 = False
@@ -98,6 +439,10 @@ class WebSocket(object):
 	def handleMessage(self):
 		pass
 
+	# streaming mode: data is a memoryview only valid during the call, fin marks the end of the message
+	def handleStream(self, data, fin):
+		pass
+
 	def handleConnected(self):
 		pass
 
@@ -111,9 +456,9 @@ class WebSocket(object):
 			raise Exception("received client close")
 		# ping
 		elif self.opcode == self.PING:
-			pass
+			self.sendPong(self.data)
 		
-		# pong
+		# pong, receiving it already counts as activity
 		elif self.opcode == self.PONG:
 			pass
 		
@@ -123,6 +468,7 @@ class WebSocket(object):
 
 
 	def handleData(self):		
+		self.lastrecv = time.time()
 		
 		# do the HTTP header and handshake
 		if self.handshaked is False:
@@ -172,16 +518,41 @@ class WebSocket(object):
 					# handshake rfc 6455
 					elif self.request.headers.has_key('Sec-WebSocket-Key'.lower()):
 						key = self.request.headers['Sec-WebSocket-Key'.lower()]
-						hStr = self.handshakeStr % { 'acceptstr' :  base64.b64encode(hashlib.sha1(key + self.GUIDStr).digest()) }
+						headers = ''
+
+						extensions = self.request.headers.get('Sec-WebSocket-Extensions'.lower())
+						if self.deflate is True and extensions:
+							negotiated = PerMessageDeflate.negotiate(extensions, self.deflateWindowBits, self.deflateContextTakeover)
+							if negotiated is not None:
+								self.compression, response = negotiated
+								headers += 'Sec-WebSocket-Extensions: %s\r\n' % response
+
+						offered = self.request.headers.get('Sec-WebSocket-Protocol'.lower())
+						if self.subprotocols and offered:
+							offered = [protocol.strip() for protocol in offered.split(',')]
+							for protocol in self.subprotocols:
+								if protocol in offered:
+									self.subprotocol = protocol
+									headers += 'Sec-WebSocket-Protocol: %s\r\n' % protocol
+									break
+
+						hStr = self.handshakeStr % { 'acceptstr' :  base64.b64encode(hashlib.sha1(key + self.GUIDStr).digest()), 'headers' : headers }
 						self.sendBuffer(hStr)
 						self.handshaked = True
+
+						# keep any frame bytes the client sent right behind the header
+						index = self.headerbuffer.find('\r\n\r\n') + 4
+						self.recvbuffer.extend(self.headerbuffer[index:])
 						self.headerbuffer = ''
 						
 						try:
 							self.handleConnected()
 						except Exception as e:
 							print e
-							pass		
+							pass
+
+						if self.recvbuffer:
+							self.parseBuffer()
 					else:
 						raise Exception('Sec-WebSocket-Key does not exist')
 
@@ -190,14 +561,22 @@ class WebSocket(object):
 				raise Exception("remote socket closed")
 				
 		# else do normal data		
+		elif self.framebuffer is not None:
+			view = memoryview(self.framebuffer)[self.framefilled:]
+			count = self.client.recv_into(view, len(view))
+			if count:
+				self.fillFrame(count)
+			else:
+				raise Exception("remote socket closed")
+
 		else:
-			data = self.client.recv(2048)
+			data = self.client.recv(self.recvsize)
 			if data:
-				for val in data:
-					if self.hixie76 is False:
-						self.parseMessage(ord(val))
-					else:
-						self.parseMessage_hixie76(ord(val))
+				self.recvbuffer.extend(data)
+				if self.hixie76 is False:
+					self.parseBuffer()
+				else:
+					self.parseBuffer_hixie76()
 			else:
 				raise Exception("remote socket closed")
 	
@@ -239,265 +618,481 @@ class WebSocket(object):
 
 	def sendClose(self):
 
-		msg = bytearray()
 		if self.hixie76 is False:
-			msg.append(0x88)
-			msg.append(0x00)
-			self.sendBuffer(msg)
+			self.sendBuffer(encodeFrame(self.CLOSE, ''))
 		else:
 			pass
 
-	def sendBuffer(self, buff):
-		size = len(buff)
-		tosend = size
-		index = 0
-
-		while tosend > 0:
-			try:
-				# i should be able to send a bytearray
-				sent = self.client.send(str(buff[index:size]))
-				if sent == 0:
-					raise RuntimeError("socket connection broken")
+	def sendPing(self, data=''):
+		if self.hixie76 is False:
+			self.sendBuffer(encodeFrame(self.PING, data))
 
-				index += sent
-				tosend -= sent
+	def sendPong(self, data=''):
+		if self.hixie76 is False:
+			self.sendBuffer(encodeFrame(self.PONG, data))
+
+	def checkKeepalive(self, now):
+		# pings an idle client and fails once it stays silent, returns the seconds until the next check
+		if self.handshaked is True and self.hixie76 is True:
+			# hixie76 has no ping, a client that only listens is silent yet healthy;
+			# until the handshake completes the idle timeout below still applies
+			return None
+
+		idle = now - self.lastrecv
+		if self.idleTimeout and idle >= self.idleTimeout:
+			raise Exception('connection idle for %.1f seconds' % idle)
+
+		if self.pingInterval and self.handshaked is True:
+			if idle >= self.pingInterval and now - self.lastping >= self.pingInterval:
+				self.sendPing()
+				self.lastping = now
+
+		delays = [self.pingInterval]
+		if self.idleTimeout:
+			delays.append(self.idleTimeout - idle)
+		delays = [delay for delay in delays if delay and delay > 0]
+		if not delays:
+			return None
+		return min(delays)
+
+	# a buffer sent with a key replaces any unsent buffer queued with the same key, so only the
+	# latest state goes out; buffers without a key are always sent, in order
+	def sendBuffer(self, buff, key=None):
+		if len(buff) == 0:
+			return
+
+		with self.sendlock:
+			buff = str(buff)
+
+			old = None
+			if key is not None:
+				old = self.sendkeys.get(key)
+				# the head entry may already be partly on the wire, that one has to finish
+				if old is not None and (old[0] is None or (old is self.sendq[0] and self.sendoffset > 0)):
+					old = None
+
+			# check the limit before touching the queue so a refused buffer leaves the old one in place
+			replaced = len(old[0]) if old is not None else 0
+			if self.maxSendQueue and self.sendbytes - replaced + len(buff) > self.maxSendQueue:
+				raise Exception('send queue exceeded allowable size')
+
+			if old is not None:
+				self.sendbytes -= replaced
+				self.senddepth -= 1
+				self.coalesced += 1
+				old[0] = None
+
+			entry = [buff, key]
+			self.sendq.append(entry)
+			if key is not None:
+				self.sendkeys[key] = entry
+			self.senddepth += 1
+			self.sendbytes += len(buff)
+			self.sendmaxdepth = max(self.sendmaxdepth, self.senddepth)
+
+			# anything already queued goes out first, the server loop flushes it on write readiness
+			if len(self.sendq) == 1:
+				self.flushSendQueue()
+
+	def queueStats(self):
+		with self.sendlock:
+			return {
+				'depth' : self.senddepth,
+				'bytes' : self.sendbytes,
+				'maxdepth' : self.sendmaxdepth,
+				'coalesced' : self.coalesced,
+			}
+
+	def handleWrite(self):
+		with self.sendlock:
+			self.flushSendQueue()
+
+	def flushSendQueue(self):
+		# must be called with sendlock held
+		while self.sendq:
+			entry = self.sendq[0]
+			buff = entry[0]
+			if buff is None:
+				self.sendq.popleft()
+				continue
 
-			except socket.error as e:
-				# if we have full buffers then wait for them to drain and try again
-				if e.errno == errno.EAGAIN:
-					time.sleep(0.001)
+			try:
+				if self.sendoffset > 0:
+					sent = self.client.send(buffer(buff, self.sendoffset))
 				else:
-					raise e
+					sent = self.client.send(buff)
+			except ssl.SSLError as e:
+				if e.errno in (ssl.SSL_ERROR_WANT_WRITE, ssl.SSL_ERROR_WANT_READ):
+					break
+				raise e
+			except socket.error as e:
+				# if we have full buffers then wait for them to drain
+				if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+					break
+				raise e
+
+			if sent == 0:
+				raise RuntimeError("socket connection broken")
+
+			self.sendoffset += sent
+			if self.sendoffset < len(buff):
+				break
+
+			self.sendq.popleft()
+			self.sendoffset = 0
+			self.senddepth -= 1
+			self.sendbytes -= len(buff)
+			if entry[1] is not None and self.sendkeys.get(entry[1]) is entry:
+				del self.sendkeys[entry[1]]
+
+		wanted = len(self.sendq) > 0
+		if wanted != self.writeinterest:
+			self.writeinterest = wanted
+			self.server.setWriteInterest(self, wanted)
 
 	
 	#if s is a string then websocket TEXT is sent else BINARY
-	def sendMessage(self, s):
-		
-		if self.hixie76 is False:
-
-			header = bytearray()
-			isString = isinstance(s, str)
-
-			if isString is True: 
-				header.append(0x81)
-			else:
-				header.append(0x82)
-
-			b2 = 0		
-			length = len(s)
-
-			if length <= 125:
-				b2 |= length
-				header.append(b2)
-
-			elif length >= 126 and length <= 65535:
-				b2 |= 126
-				header.append(b2)
-				header.extend(struct.pack("!H", length))
-		
-			else:
-				b2 |= 127
-				header.append(b2)
-				header.extend(struct.pack("!Q", length))
-		
-			self.sendBuffer(header)
-			header = None
-
-			if length > 0:
-				self.sendBuffer(s)
-
+	# a key marks the message as state, see sendBuffer
+	def sendMessage(self, s, key=None):
+		# with context takeover the frames must be queued in the order they were compressed
+		with self.sendlock:
+			self.sendBuffer(self.frameMessage(s, key), key)
+
+	def compresses(self, s, key=None):
+		if self.compression is None or self.hixie76 is True or len(s) < self.deflateThreshold:
+			return False
+		# a keyed frame may be replaced before it is sent, which would break a shared compression context
+		return key is None or self.compression.serverContextTakeover is False
+
+	def frameMessage(self, s, key=None):
+		if not self.compresses(s, key):
+			return encodeMessage(s, self.hixie76)
+
+		if isinstance(s, str):
+			opcode = self.TEXT
 		else:
-			msg = bytearray()			
-			msg.append(0)
-			if len(s) > 0:
-				msg.extend(str(s).encode("UTF8"))
-			msg.append(0xFF)
-
-			self.sendBuffer(msg)
-			msg = None
+			opcode = self.BINARY
+		return encodeFrame(opcode, self.compression.compress(s), rsv=0x40)
 
+	def frameKey(self, s, key=None):
+		# connections with the same frame key get the same bytes from frameMessage, None when the
+		# frame depends on this connection's compression history
+		if self.hixie76 is True:
+			return 'hixie76'
+		if not self.compresses(s, key):
+			return 'plain'
+		if self.compression.serverContextTakeover is True:
+			return None
+		return ('deflate', self.compression.serverWindowBits)
 
-	def parseMessage_hixie76(self, byte):
 
-		if self.state == self.HEADERB1:
-			if byte == 0:
-				self.state = self.PAYLOAD
-				self.data = bytearray()
+	def parseBuffer_hixie76(self):
+		buff = self.recvbuffer
+		offset = 0
 
-		elif self.state == self.PAYLOAD:
-			if byte == 0xFF:
-				self.opcode = 1
+		try:
+			while offset < len(buff):
+				# skip anything before the start of a frame
+				start = buff.find('\x00', offset)
+				if start == -1:
+					offset = len(buff)
+					break
+
+				end = buff.find('\xff', start + 1)
+				if end == -1:
+					# if length exceeds allowable size then we except and remove the connection
+					if len(buff) - start - 1 >= self.maxpayload:
+						raise Exception('payload exceeded allowable size')
+					offset = start
+					break
+
+				self.opcode = self.TEXT
+				self.data = buff[start+1:end]
 				self.length = len(self.data)
+				offset = end + 1
 				try:
 					self.handlePacket()
 				finally:
 					self.data = None
-					self.state = self.HEADERB1
-			else	:
-				self.data.append(byte)
+		finally:
+			if offset > 0:
+				del buff[:offset]
+
+
+	def parseBuffer(self):
+		buff = self.recvbuffer
+		offset = 0
+
+		try:
+			# decode every complete frame in the buffer, a partial frame stays for the next recv
+			while len(buff) - offset >= 2:
+				b1 = buff[offset]
+				b2 = buff[offset+1]
+				pos = offset + 2
+
+				length = b2 & 0x7F
+				if length == 126:
+					if len(buff) - pos < 2:
+						break
+					length = struct.unpack_from('!H', buff, pos)[0]
+					pos += 2
+				elif length == 127:
+					if len(buff) - pos < 8:
+						break
+					length = struct.unpack_from('!Q', buff, pos)[0]
+					pos += 8
+
 				# if length exceeds allowable size then we except and remove the connection
-				if len(self.data) >= self.maxpayload:
+				if length >= self.maxpayload:
 					raise Exception('payload exceeded allowable size')
 
+				control = (b1 & 0x0F) >= 0x8
+				if control and length > 125:
+					raise Exception('control frame exceeded allowable size')
+
+				mask = None
+				if b2 & 0x80:
+					if len(buff) - pos < 4:
+						break
+					mask = buff[pos:pos+4]
+					pos += 4
+
+				available = len(buff) - pos
+				if available < length:
+					if control is False and (self.streaming is True or length > self.recvsize):
+						self.startFrame(b1)
+						self.framebuffer = bytearray(length)
+						self.framebuffer[:available] = buff[pos:]
+						self.frameheader = b1
+						self.framemask = mask
+						self.framefilled = 0
+						offset = len(buff)
+						self.fillFrame(available)
+					break
+
+				payload = buff[pos:pos+length]
+				if mask is not None:
+					unmask(payload, mask)
+				offset = pos + length
+
+				self.startFrame(b1)
+				self.handleFrameData(b1, payload, True)
+		finally:
+			if offset > 0:
+				del buff[:offset]
+
+	def fillFrame(self, count):
+		# count more bytes of framebuffer have arrived
+		start = self.framefilled
+		end = start + count
+		self.framefilled = end
+		if self.framemask is not None:
+			unmask(self.framebuffer, self.framemask, start, end)
+
+		last = end == len(self.framebuffer)
+		framebuffer = self.framebuffer
+		if last:
+			self.framebuffer = None
+
+		if self.streaming is True:
+			if count > 0:
+				self.handleFrameData(self.frameheader, memoryview(framebuffer)[start:end], last)
+		elif last:
+			self.handleFrameData(self.frameheader, framebuffer, True)
+
+	def startFrame(self, b1):
+		opcode = b1 & 0x0F
+
+		# rsv1 marks a compressed message, only on its first frame and only when negotiated
+		if b1 & 0x70:
+			if b1 & 0x70 != 0x40 or self.compression is None or opcode not in (self.TEXT, self.BINARY):
+				raise Exception('reserved bits set')
+
+		if opcode >= 0x8:
+			if not b1 & 0x80:
+				raise Exception('fragmented control frame')
+
+		elif opcode == self.STREAM:
+			if self.messageopcode is None:
+				raise Exception('continuation frame without a message')
+
+		elif opcode == self.TEXT or opcode == self.BINARY:
+			if self.messageopcode is not None:
+				raise Exception('new message before the previous one finished')
+			self.messageopcode = opcode
+			self.messagelength = 0
+			self.compressed = (b1 & 0x40) != 0
 
-	def parseMessage(self, byte):	
-		# read in the header
-		if self.state == self.HEADERB1:
-			# fin
-			self.fin = (byte & 0x80)
-			# get opcode
-			self.opcode = (byte & 0x0F)
-			
-			self.state = self.HEADERB2
-		
-		elif self.state == self.HEADERB2:
-			mask = byte & 0x80				
-			length = byte & 0x7F
-			
-			if mask == 128:
-				self.hasmask = True
-			else:
-				self.hasmask = False
-			
-			if length <= 125:
-				self.length = length
-				
-				# if we have a mask we must read it
-				if self.hasmask is True:
-					self.maskarray = bytearray()
-					self.state = self.MASK
-				else:
-					# if there is no mask and no payload we are done
-					if self.length <= 0:
-						try:
-							self.handlePacket()
-						finally:
-							self.state = self.HEADERB1
-							self.data = None
-							
-					# we have no mask and some payload
-					else:
-						self.index = 0
-						self.data = bytearray()
-						self.state = self.PAYLOAD
-					
-			elif length == 126:
-				self.lengtharray = bytearray()
-				self.state = self.LENGTHSHORT
-				
-			elif length == 127:
-				self.lengtharray = bytearray()
-				self.state = self.LENGTHLONG
+		else:
+			raise Exception('unknown opcode')
+
+	def handleFrameData(self, b1, chunk, last):
+		# chunk is the next part of the current frame payload, last when it completes the frame
+		opcode = b1 & 0x0F
+		if opcode >= 0x8:
+			self.fin = b1 & 0x80
+			self.opcode = opcode
+			self.length = len(chunk)
+			self.data = chunk
+			try:
+				self.handlePacket()
+			finally:
+				self.data = None
+			return
+
+		fin = last is True and (b1 & 0x80) != 0
+		if self.compressed is True:
+			chunk = self.compression.decompress(chunk, fin, self.maxpayload - self.messagelength)
+
+		self.messagelength += len(chunk)
+		if self.messagelength >= self.maxpayload:
+			raise Exception('payload exceeded allowable size')
+
+		if self.streaming is True:
+			self.opcode = self.messageopcode
+			if fin is True:
+				self.messageopcode = None
+			if len(chunk) > 0 or fin is True:
+				if not isinstance(chunk, memoryview):
+					chunk = memoryview(chunk)
+				self.handleStream(chunk, fin)
+			return
+
+		if fin is False:
+			if len(chunk) > 0:
+				self.fragments.append(chunk)
+			return
+
+		if self.fragments:
+			# the whole message is allocated once, from the fragments as they were received
+			self.fragments.append(chunk)
+			data = bytearray().join(self.fragments)
+			self.fragments = []
+		elif isinstance(chunk, bytearray):
+			data = chunk
+		else:
+			data = bytearray(chunk)
 
-		
-		elif self.state == self.LENGTHSHORT:
-			self.lengtharray.append(byte)
+		self.fin = 0x80
+		self.opcode = self.messageopcode
+		self.messageopcode = None
+		self.length = len(data)
+		self.data = data
+		try:
+			self.handlePacket()
+		finally:
+			self.data = None
 
-			if len(self.lengtharray) > 2:
-				raise Exception('short length exceeded allowable size')
 
-			if len(self.lengtharray) == 2:
-				self.length = struct.unpack_from('!H', str(self.lengtharray))[0]
-				
-				if self.hasmask is True:
-					self.maskarray = bytearray()
-					self.state = self.MASK
-				else:
-					# if there is no mask and no payload we are done
-					if self.length <= 0:
-						try:
-							self.handlePacket()
-						finally:
-							self.state = self.HEADERB1
-							self.data = None
+class BroadcastMixin(object):
+	# named groups of connections and encode-once fan-out, shared by the server flavours
 
-					# we have no mask and some payload
-					else:
-						self.index = 0
-						self.data = bytearray()
-						self.state = self.PAYLOAD
-			
-		elif self.state == self.LENGTHLONG:
+	# forwards publish() to sibling worker processes when running pre-forked
+	relay = None
 
-			self.lengtharray.append(byte)
+	def join(self, client, group):
+		self.groups.setdefault(group, set()).add(client)
+		client.groups.add(group)
 
-			if len(self.lengtharray) > 8:
-				raise Exception('long length exceeded allowable size')
+	def leave(self, client, group):
+		client.groups.discard(group)
+		members = self.groups.get(group)
+		if members is not None:
+			members.discard(client)
+			if not members:
+				del self.groups[group]
 
-			if len(self.lengtharray) == 8:
-				self.length = struct.unpack_from('!Q', str(self.lengtharray))[0]
+	def leaveAll(self, client):
+		for group in list(client.groups):
+			self.leave(client, group)
 
-				if self.hasmask is True:
-					self.maskarray = bytearray()
-					self.state = self.MASK
-				else:
-					# if there is no mask and no payload we are done
-					if self.length <= 0:
-						try:
-							self.handlePacket()
-						finally:
-							self.state = self.HEADERB1
-							self.data = None
+	def broadcast(self, message, filter=None, group=None, key=None):
+		if group is None:
+			targets = self.connections.values()
+		else:
+			targets = list(self.groups.get(group, ()))
 
-					# we have no mask and some payload
-					else:
-						self.index = 0
-						self.data = bytearray()
-						self.state = self.PAYLOAD
-			
-		# MASK STATE
-		elif self.state == self.MASK:
-			self.maskarray.append(byte)
-
-			if len(self.maskarray) > 4:
-				raise Exception('mask exceeded allowable size')
-
-			if len(self.maskarray) == 4:
-				# if there is no mask and no payload we are done
-				if self.length <= 0:
-					try:
-						self.handlePacket()
-					finally:
-						self.state = self.HEADERB1
-						self.data = None
-						
-				# we have no mask and some payload
+		# one frame per protocol flavour and compression setting, shared by every target connection
+		frames = {}
+		sent = 0
+		for client in targets:
+			if client.handshaked is False:
+				continue
+			if filter is not None and not filter(client):
+				continue
+
+			try:
+				shared = client.frameKey(message, key)
+				if shared is None:
+					client.sendMessage(message, key)
 				else:
-					self.index = 0
-					self.data = bytearray()
-					self.state = self.PAYLOAD
-		
-		# PAYLOAD STATE
-		elif self.state == self.PAYLOAD:
-			if self.hasmask is True:
-				self.data.append( byte ^ self.maskarray[self.index % 4] )
-			else:
-				self.data.append( byte )
+					frame = frames.get(shared)
+					if frame is None:
+						frame = frames[shared] = client.frameMessage(message, key)
+					client.sendBuffer(frame, key)
+				sent += 1
+			except Exception as n:
+				# same as a failed write, the connection is gone for every later broadcast too
+				logging.debug(str(client.address) + ' ' + str(n))
+				self.removeConnection(client)
 
-			# if length exceeds allowable size then we except and remove the connection
-			if len(self.data) >= self.maxpayload:
-				raise Exception('payload exceeded allowable size')
+		return sent
 
-			# check if we have processed length bytes; if so we are done
-			if (self.index+1) == self.length:
-				try:
-					self.handlePacket()
-				finally:
-					self.state = self.HEADERB1
-					self.data = None
-			else:
-				self.index += 1
+	def publish(self, message, group=None):
+		# broadcast here and on every other worker sharing the port
+		if self.relay is not None:
+			self.relay.forward(message, group)
+		return self.broadcast(message, group=group)
+
+
+class KeepaliveMixin(object):
+	# drives the ping and idle checks of every connection from the server timers
+
+	def keepalive(self, client):
+		if self.connections.get(client.fileno) is not client:
+			return
+
+		try:
+			delay = client.checkKeepalive(time.time())
+		except Exception as n:
+			logging.debug(str(client.address) + ' ' + str(n))
+			self.removeConnection(client)
+			return
+
+		if delay is not None:
+			self.callLater(delay, self.keepalive, client)
 
 
-class SimpleWebSocketServer(object):
-	def __init__(self, host, port, websocketclass):
+class SimpleWebSocketServer(BroadcastMixin, KeepaliveMixin):
+	def __init__(self, host, port, websocketclass, selectInterval=1.0, backlog=5, reusePort=False):
 		self.websocketclass = websocketclass
 		self.serversocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 		self.serversocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		if reusePort is True:
+			if SO_REUSEPORT is None:
+				raise socket.error(errno.ENOPROTOOPT, 'SO_REUSEPORT is not available on ' + sys.platform)
+			# lets several processes bind the same port, the kernel spreads the connections
+			self.serversocket.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
 		self.serversocket.bind((host, port))
-		self.serversocket.listen(5)
+		self.serversocket.listen(backlog)
+		self.serversocket.setblocking(0)
+		self.selectInterval = selectInterval
+		# how long to stop accepting when the process runs out of descriptors
+		self.acceptBackoff = 0.5
+		self.accepting = True
+
+		# fileno -> WebSocket
 		self.connections = {}
-		self.listeners = [self.serversocket]
+		# fileno -> callback for other descriptors served by the loop
+		self.readers = {}
+		# (deadline, sequence, Timer) heap serviced by the loop
+		self.timers = []
+		self.timerseq = itertools.count()
+		self.timerlock = threading.Lock()
+		# group name -> set of WebSocket
+		self.groups = {}
+		self.poller = createPoller()
+		self.poller.register(self.serversocket.fileno(), POLLREAD)
 
 
 	def decorateSocket(self, sock):
@@ -517,72 +1112,188 @@ class SimpleWebSocketServer(object):
 	
 			conn.close()
 
+		self.connections = {}
 
-	def serveforever(self):
+	def callLater(self, delay, callback, *args):
+		timer = Timer(time.time() + delay, callback, args)
+		with self.timerlock:
+			heapq.heappush(self.timers, (timer.when, next(self.timerseq), timer))
+		return timer
+
+	def runTimers(self):
+		now = time.time()
 		while True:
-			rList, wList, xList = select(self.listeners, [], self.listeners, 1)	
+			with self.timerlock:
+				if not self.timers or self.timers[0][0] > now:
+					return
+				timer = heapq.heappop(self.timers)[2]
 
-			for ready in rList:
-				if ready == self.serversocket:
-					try:
-						sock, address = self.serversocket.accept()
-						newsock = self.decorateSocket(sock)
-						newsock.setblocking(0)
-						fileno = newsock.fileno()
-						self.listeners.append(fileno)
-						self.connections[fileno] = self.constructWebSocket(newsock, address)
+			if timer.cancelled is True:
+				continue
 
-					except Exception as n:
+			try:
+				timer.callback(*timer.args)
+			except Exception as n:
+				logging.debug('timer ' + str(n))
+
+	def pollTimeout(self, timeout):
+		# sleep no longer than the next timer
+		with self.timerlock:
+			if self.timers:
+				timeout = min(timeout, max(0, self.timers[0][0] - time.time()))
+		return timeout
+
+	def addReader(self, fileno, callback):
+		self.readers[fileno] = callback
+		self.poller.register(fileno, POLLREAD)
+
+	def removeReader(self, fileno):
+		if self.readers.pop(fileno, None) is not None:
+			self.poller.unregister(fileno)
+
+	def setWriteInterest(self, client, wanted):
+		# may be called from other threads sending on a connection
+		fileno = client.fileno
+		if fileno not in self.connections:
+			return
+
+		events = POLLREAD
+		if wanted:
+			events |= POLLWRITE
 
-						logging.debug(str(address) + ' ' + str(n))
+		try:
+			self.poller.modify(fileno, events)
+		except (IOError, OSError, KeyError):
+			pass
 
-						if sock is not None:
-							sock.close()
-				else:
-					client = self.connections[ready]
-					fileno = client.client.fileno()
-				
-					try:
-						client.handleData()
+	def acceptConnections(self):
+		while True:
+			sock = None
+			address = None
+			try:
+				sock, address = self.serversocket.accept()
+			except socket.error as e:
+				if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+					return
 
-					except Exception as n:
+				logging.warning('accept ' + str(e))
+				if e.errno in (errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.ENOMEM):
+					# the connection stays in the backlog and the listener stays readable, so polling
+					# it again right away would spin; stop watching it until descriptors are freed
+					self.pauseAccepting()
+					return
 
-						logging.debug(str(client.address) + ' ' + str(n))
+				# ECONNABORTED and the like only cost that one connection
+				continue
 
-						try:
-							client.handleClose()
-						except:
-							pass
+			try:
+				newsock = self.decorateSocket(sock)
+				newsock.setblocking(0)
+				client = self.constructWebSocket(newsock, address)
+				self.connections[client.fileno] = client
+				self.poller.register(client.fileno, POLLREAD)
+				self.keepalive(client)
 
-						client.close()
+			except Exception as n:
 
-						del self.connections[fileno]
-						self.listeners.remove(ready)
-		
-			for failed in xList:
-				if failed == self.serversocket:
+				logging.debug(str(address) + ' ' + str(n))
+
+				if sock is not None:
+					sock.close()
+
+	def pauseAccepting(self):
+		if self.accepting is False:
+			return
+
+		self.accepting = False
+		try:
+			self.poller.unregister(self.serversocket.fileno())
+		except (IOError, OSError, KeyError):
+			pass
+		self.callLater(self.acceptBackoff, self.resumeAccepting)
+
+	def resumeAccepting(self):
+		if self.accepting is True:
+			return
+
+		self.accepting = True
+		self.poller.register(self.serversocket.fileno(), POLLREAD)
+
+	def removeConnection(self, client):
+		fileno = client.fileno
+		if self.connections.pop(fileno, None) is None:
+			return
+
+		self.leaveAll(client)
+
+		try:
+			self.poller.unregister(fileno)
+		except (IOError, OSError, KeyError):
+			pass
+
+		try:
+			client.handleClose()
+		except:
+			pass
+
+		client.close()
+
+	def serveonce(self, timeout):
+		try:
+			events = self.poller.poll(self.pollTimeout(timeout))
+		except (IOError, OSError, select.error) as e:
+			if e.args[0] == errno.EINTR:
+				return
+			raise
+
+		for fileno, event in events:
+			if fileno == self.serversocket.fileno():
+				if event & POLLERROR:
 					self.close()
 					raise Exception("server socket failed")
-				else:
-					client = self.connections[failed]
-					fileno = client.client.fileno()
 
-					try:
-						client.handleClose()
-					except:
-						pass
+				self.acceptConnections()
+				continue
 
-					client.close()
+			reader = self.readers.get(fileno)
+			if reader is not None:
+				try:
+					reader()
+				except Exception as n:
+					logging.debug('reader ' + str(fileno) + ' ' + str(n))
+				continue
+
+			client = self.connections.get(fileno)
+			if client is None:
+				continue
+
+			try:
+				if event & POLLWRITE:
+					client.handleWrite()
+
+				if event & POLLREAD:
+					client.handleData()
+				elif event & POLLERROR:
+					raise Exception("socket failed")
+
+			except Exception as n:
 
-					del self.connections[fileno]
-					self.listeners.remove(failed)
+				logging.debug(str(client.address) + ' ' + str(n))
+
+				self.removeConnection(client)
+
+		self.runTimers()
+
+	def serveforever(self):
+		while True:
+			self.serveonce(self.selectInterval)
 					
 
 class SimpleSSLWebSocketServer(SimpleWebSocketServer):
 
-	def __init__(self, host, port, websocketclass, certfile, keyfile, version = ssl.PROTOCOL_TLSv1):
+	def __init__(self, host, port, websocketclass, certfile, keyfile, version = ssl.PROTOCOL_TLSv1, selectInterval=1.0, backlog=5, reusePort=False):
 
-		SimpleWebSocketServer.__init__(self, host, port, websocketclass)
+		SimpleWebSocketServer.__init__(self, host, port, websocketclass, selectInterval, backlog, reusePort)
 
 		self.cerfile = certfile
 		self.keyfile = keyfile
@@ -1,24 +1,60 @@
+# coding:utf-8
 from SimpleWebSocketServer import WebSocket, SimpleWebSocketServer
+from optparse import OptionParser
+from pool_detectores import PoolDetectores, WebSocketFaixa
 import detector_movimento
+from latencia import MedidorLatencia
+from estado_jogo import EstadoJogo, PersistenciaEstado
 import cv2
 
 
 
 class WebSocketWebCam(WebSocket):
 
-    camera = cv2.VideoCapture(0)
+    # aberta na primeira conexão, no modo --processo quem abre é o processo da visão
+    camera = None
     processo = None
 
+    # o jogo pede o estado em binário, clientes antigos continuam recebendo JSON
+    subprotocols = (detector_movimento.GerenciadorEstadoJogador.SUBPROTOCOLO_BINARIO,)
+
+    # aba do jogo fechada ou travada deve matar o jogador rapido
+    pingInterval = 2.0
+    idleTimeout = 6.0
+
+    # as mensagens maiores vão comprimidas para quem oferece permessage-deflate
+    deflate = True
+
+    # nos totens ninguém olha a janela da detecção
+    sem_interface = False
+    fps_previa = 0
+
+    # um detector só por servidor, a latência é medida em todas as conexões dele
+    latencia = MedidorLatencia()
+
+    # tela e vida do jogador, vindos do jogo, e o estado que o detector calcula
+    estado_jogo = EstadoJogo()
+
     def handleMessage(self):
+        sequencia = self.latencia.eco(self.data)
+        if sequencia is not None:
+            self.latencia.registrar_eco(sequencia)
+            return
         print 'Recebeu msg: ', self.data
-        with open('./file/estado_jogo_cliente.json', 'w') as arq:
-            arq.write(self.data)
+        try:
+            self.estado_jogo.atualizar_json(self.data)
+        except (ValueError, TypeError) as e:
+            print 'Mensagem inválida:', e
 
     def handleConnected(self):
         print self.address, 'connected'
         if self.processo is None:
             if detector_movimento.processo is None:
-                self.processo = detector_movimento.DetectorMovimento(conexao=self)
+                if WebSocketWebCam.camera is None:
+                    WebSocketWebCam.camera = cv2.VideoCapture(0)
+                self.processo = detector_movimento.DetectorMovimento(
+                    conexao=self, sem_interface=self.sem_interface, fps_previa=self.fps_previa,
+                    estado_jogo=self.estado_jogo)
                 detector_movimento.processo = self.processo
                 self.processo.start()
             else:
@@ -37,6 +73,46 @@ class WebSocketWebCam(WebSocket):
 
 
 if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option("-s", "--sem-interface", dest="sem_interface", action="store_true",
+                      help="Não desenhar nem abrir janela", default=False)
+    parser.add_option("-p", "--previa", dest="fps_previa", type="float",
+                      help="Sem interface, mostrar uma prévia com essa taxa de frames", default=0)
+    parser.add_option("-m", "--processo", dest="processo", action="store_true", default=False,
+                      help="Rodar captura e visão num processo separado do servidor")
+    parser.add_option("-v", "--previa-servidor", dest="fps_previa_servidor", type="float", default=0,
+                      help="Com --processo, mostrar a detecção no processo do servidor com essa taxa de frames")
+    parser.add_option("-e", "--persistir", dest="persistir", action="store_true", default=False,
+                      help="Gravar o estado do jogo em arquivos, para quem acompanha por eles")
+    (options, args) = parser.parse_args()
+
+    if options.processo:
+        # a visão não disputa o GIL com o laço do servidor: uma faixa só, na camera 0
+        pool = PoolDetectores([0], fps_previa_servidor=options.fps_previa_servidor,
+                              persistir=options.persistir,
+                              sem_interface=options.sem_interface, fps_previa=options.fps_previa)
+        server = SimpleWebSocketServer('', 1339, WebSocketFaixa)
+        pool.iniciar(server)
+        try:
+            server.serveforever()
+        finally:
+            pool.finalizar()
+            server.close()
+    else:
+        WebSocketWebCam.sem_interface = options.sem_interface
+        WebSocketWebCam.fps_previa = options.fps_previa
+
+        persistencia = None
+        if options.persistir:
+            persistencia = PersistenciaEstado(WebSocketWebCam.estado_jogo, {
+                detector_movimento.GerenciadorEstadoJogador.ARQUIVO_ESTADO_JOGADOR: EstadoJogo.CAMPOS_DETECTOR,
+                detector_movimento.GerenciadorEstadoJogador.ARQUIVO_ESTADO_VIDA_JOGADOR: EstadoJogo.CAMPOS_JOGO})
+            persistencia.start()
 
-    server = SimpleWebSocketServer('', 1339, WebSocketWebCam)
-    server.serveforever()
+        server = SimpleWebSocketServer('', 1339, WebSocketWebCam)
+        WebSocketWebCam.latencia.agendar(server)
+        try:
+            server.serveforever()
+        finally:
+            if persistencia is not None:
+                persistencia.parar()
@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+# coding:utf-8
+
+import json
+import time
+import platform
+from optparse import OptionParser
+import cv2
+import numpy as np
+from SimpleWebSocketServer import encodeMessage
+from detector_movimento import DetectorMovimento, GerenciadorEstadoJogador
+from fonte_frames import FonteSintetica, FonteRedimensionada, abrir_fonte
+
+
+class ConexaoMedida(object):
+
+    '''
+    Conexão falsa do benchmark: monta o frame WebSocket do estado como o
+    servidor faria, sem rede, para o custo de atualizar_estado ser o real
+    '''
+    address = ('benchmark', 0)
+    camera = None
+
+    def __init__(self, binario=True):
+        '''
+        Construtor da Classe
+        :param binario: se o estado vai no formato binário ou em JSON
+        '''
+        self.subprotocol = GerenciadorEstadoJogador.SUBPROTOCOLO_BINARIO if binario else None
+        self.enviados = 0
+
+    def sendMessage(self, mensagem, chave=None):
+        encodeMessage(mensagem)
+        self.enviados += 1
+
+
+class MedidorEtapas(object):
+
+    '''
+    Soma o tempo de cada etapa dentro de um frame e guarda a soma de cada frame
+    '''
+
+    def __init__(self):
+        # etapa -> tempos por frame, em ms
+        self.amostras = {}
+        self.frame_atual = {}
+
+    def medir(self, etapa, funcao):
+        '''
+        Embrulha uma função para que o tempo de cada chamada conte na etapa
+        :param etapa: nome da etapa
+        :param funcao: função medida
+        :returns: a função embrulhada
+        '''
+        def medida(*args, **kwargs):
+            inicio = time.time()
+            try:
+                return funcao(*args, **kwargs)
+            finally:
+                self.frame_atual[etapa] = self.frame_atual.get(etapa, 0.0) + \
+                    (time.time() - inicio) * 1000
+        return medida
+
+    def fechar_frame(self):
+        '''
+        Guarda os tempos do frame atual e começa o próximo
+        '''
+        for etapa, tempo in self.frame_atual.iteritems():
+            self.amostras.setdefault(etapa, []).append(tempo)
+        self.frame_atual = {}
+
+    def resumo(self):
+        '''
+        Percentis de cada etapa
+        :returns: etapa -> p50, p95, p99, média e máximo em ms, e em quantos frames a etapa rodou
+        '''
+        resumo = {}
+        for etapa, tempos in self.amostras.iteritems():
+            tempos = np.array(tempos)
+            p50, p95, p99 = np.percentile(tempos, [50, 95, 99])
+            resumo[etapa] = {'p50': round(p50, 4), 'p95': round(p95, 4), 'p99': round(p99, 4),
+                             'media': round(tempos.mean(), 4), 'max': round(tempos.max(), 4),
+                             'frames': len(tempos)}
+        return resumo
+
+
+def medir_resolucao(fonte, num_frames, aquecimento, desenhar=False, binario=True, **opcoes):
+    '''
+    Roda o pipeline da detecção sobre os frames da fonte, medindo cada etapa
+    :param fonte: fonte de frames, fora de tempo real
+    :param num_frames: frames medidos
+    :param aquecimento: frames processados antes de medir
+    :param desenhar: mede também o desenho das marcações
+    :param binario: estado no formato binário ou em JSON
+    :param opcoes: argumentos repassados ao DetectorMovimento
+    :returns: dicionário com o resultado da resolução
+    '''
+    conexao = ConexaoMedida(binario)
+    detector = DetectorMovimento(conexao=conexao, fonte=fonte, sem_interface=True, **opcoes)
+    medidor = MedidorEtapas()
+
+    segmentador = detector.segmentador
+    detector.espelhar = medidor.medir('espelhar', detector.espelhar)
+    segmentador.converter_hsv = medidor.medir('hsv', segmentador.converter_hsv)
+    segmentador.limiarizar = medidor.medir('inrange', segmentador.limiarizar)
+    if segmentador.tabela_cores is not None:
+        segmentador.tabela_cores.aplicar = medidor.medir('tabela_cores', segmentador.tabela_cores.aplicar)
+    segmentador.erodir = medidor.medir('erosao', segmentador.erodir)
+    segmentador.dilatar = medidor.medir('dilatacao', segmentador.dilatar)
+    segmentador.maior_componente = medidor.medir('componentes', segmentador.maior_componente)
+    if detector.camshift is not None:
+        detector.camshift._seguir = medidor.medir('camshift', detector.camshift._seguir)
+        detector.camshift._redetectar = medidor.medir('redeteccao', detector.camshift._redetectar)
+    localizar = medidor.medir('localizacao', detector.localizador.localizar)
+    atualizar_movimento = medidor.medir('maquina_estados', detector.atualizar_movimento)
+    gerenciador = detector.gerenciador_estado_jogador
+    gerenciador.atualizar_estado = medidor.medir('atualizar_estado', gerenciador.atualizar_estado)
+    desenho = medidor.medir('desenho', detector.desenhar)
+
+    frame = None
+    processados = 0
+    tempo_total = 0.0
+    while processados < aquecimento + num_frames:
+        inicio_leitura = time.time()
+        ok, frame = fonte.read(frame)
+        if not ok:
+            break
+        leitura = (time.time() - inicio_leitura) * 1000
+
+        inicio = time.time()
+        espelhado = detector.espelhar(frame)
+        retangulo = localizar(espelhado)
+        no_centro = atualizar_movimento(retangulo)
+        if desenhar:
+            desenho(espelhado, retangulo, no_centro)
+        duracao = time.time() - inicio
+
+        processados += 1
+        if processados <= aquecimento:
+            medidor.frame_atual = {}
+            continue
+        tempo_total += duracao
+        medidor.frame_atual['leitura'] = leitura
+        medidor.frame_atual['total'] = duracao * 1000
+        medidor.fechar_frame()
+
+    medidos = max(0, processados - aquecimento)
+    return {
+        'resolucao': '{0}x{1}'.format(int(fonte.get(cv2.CAP_PROP_FRAME_WIDTH)),
+                                      int(fonte.get(cv2.CAP_PROP_FRAME_HEIGHT))),
+        'frames': medidos,
+        'fps': round(medidos / tempo_total, 2) if tempo_total else 0.0,
+        'estados_enviados': conexao.enviados,
+        'etapas': medidor.resumo(),
+    }
+
+
+def imprimir(resultado):
+    '''
+    Mostra o resultado de uma resolução como tabela
+    :param resultado: dicionário devolvido por medir_resolucao
+    '''
+    print '\n{0}: {1} frames, {2} frames/s'.format(
+        resultado['resolucao'], resultado['frames'], resultado['fps'])
+    print '  {0:<18}{1:>10}{2:>10}{3:>10}{4:>10}{5:>8}'.format(
+        'etapa (ms)', 'p50', 'p95', 'p99', 'max', 'frames')
+    etapas = resultado['etapas']
+    for etapa in sorted(etapas, key=lambda nome: -etapas[nome]['p50']):
+        valores = etapas[etapa]
+        print '  {0:<18}{1:>10.3f}{2:>10.3f}{3:>10.3f}{4:>10.3f}{5:>8}'.format(
+            etapa, valores['p50'], valores['p95'], valores['p99'], valores['max'], valores['frames'])
+
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option("-f", "--fonte", dest="fonte", default=None,
+                      help="Vídeo, diretório ou .npz gravado; sem ela os frames são sintéticos")
+    parser.add_option("-R", "--resolucoes", dest="resolucoes", default="320x240,640x480,1280x720",
+                      help="Resoluções medidas, separadas por vírgula")
+    parser.add_option("-n", "--frames", dest="num_frames", type="int", default=500,
+                      help="Frames medidos em cada resolução")
+    parser.add_option("-w", "--aquecimento", dest="aquecimento", type="int", default=30,
+                      help="Frames processados antes de medir")
+    parser.add_option("-r", "--roi", dest="rastreamento_roi", action="store_true",
+                      help="Rastrear o marcador numa janela em volta da última posição", default=False)
+    parser.add_option("-t", "--tabela-cores", dest="tabela_cores", action="store_true",
+                      help="Limiarizar por uma tabela de cores pré-calculada", default=False)
+    parser.add_option("-k", "--kalman", dest="estimador", action="store_true", default=False,
+                      help="Medir a máquina de estados com o estimador de Kalman")
+    parser.add_option("-m", "--camshift", dest="camshift", action="store_true", default=False,
+                      help="Seguir o marcador com CamShift depois da calibração")
+    parser.add_option("-d", "--desenhar", dest="desenhar", action="store_true", default=False,
+                      help="Medir também o desenho das marcações")
+    parser.add_option("-j", "--json", dest="binario", action="store_false", default=True,
+                      help="Enviar o estado em JSON em vez do formato binário")
+    parser.add_option("-o", "--saida", dest="saida", default=None,
+                      help="Arquivo JSON onde salvar os resultados")
+    (options, args) = parser.parse_args()
+
+    resultados = []
+    for resolucao in options.resolucoes.split(','):
+        largura, altura = [int(valor) for valor in resolucao.split('x')]
+        if options.fonte is None:
+            fonte = FonteSintetica(largura=largura, altura=altura, tempo_real=False, repetir=True)
+        else:
+            # a fonte gravada tem a resolução dela; o benchmark mede na pedida
+            fonte = FonteRedimensionada(abrir_fonte(options.fonte, tempo_real=False), largura, altura)
+        resultado = medir_resolucao(
+            fonte, options.num_frames, options.aquecimento, options.desenhar, options.binario,
+            rastreamento_roi=options.rastreamento_roi, tabela_cores=options.tabela_cores,
+            estimador=options.estimador, camshift=options.camshift)
+        imprimir(resultado)
+        resultados.append(resultado)
+
+    if options.saida is not None:
+        with open(options.saida, 'w') as arq:
+            json.dump({
+                'data': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'maquina': platform.platform(),
+                'opencv': cv2.__version__,
+                'numpy': np.__version__,
+                'threads_opencv': cv2.getNumThreads(),
+                'opcoes': {'fonte': options.fonte or 'sintetico', 'roi': options.rastreamento_roi,
+                           'tabela_cores': options.tabela_cores, 'kalman': options.estimador,
+                           'camshift': options.camshift,
+                           'desenhar': options.desenhar,
+                           'binario': options.binario, 'aquecimento': options.aquecimento},
+                'resultados': resultados,
+            }, arq, indent=2, sort_keys=True)
+        print '\nResultados salvos em', options.saida
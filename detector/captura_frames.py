@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# coding:utf-8
+
+import threading
+import time
+from relogio import monotonico
+
+
+class CapturaFrames(threading.Thread):
+
+    '''
+    Lê os frames da camera continuamente em uma thread própria, guardando-os em
+    um buffer circular pequeno. Quem processa sempre recebe o frame mais novo;
+    os que chegaram enquanto o processamento estava ocupado são descartados e
+    contados.
+    '''
+
+    def __init__(self, camera, tamanho_buffer=3, sem_descarte=False):
+        '''
+        Construtor da Classe
+        :param camera: camera já aberta, qualquer objeto com read, isOpened e get
+        :param tamanho_buffer: número de posições do buffer, no mínimo 3
+        :param sem_descarte: espera cada frame ser lido antes de ler o próximo, para fontes gravadas
+        '''
+        threading.Thread.__init__(self)
+        self.daemon = True
+        if tamanho_buffer < 3:
+            raise ValueError(
+                "O buffer precisa de pelo menos 3 posições: escrita, mais novo e em uso")
+        self.camera = camera
+        self.sem_descarte = sem_descarte
+        self.frames = [None] * tamanho_buffer
+        self.momentos = [0.0] * tamanho_buffer
+        # posição do frame mais novo, do mais novo ainda não lido e do que está em uso
+        self.mais_novo = None
+        self.nao_lido = None
+        self.em_uso = None
+
+        self.capturados = 0
+        self.descartados = 0
+        self.executando = False
+        self.condicao = threading.Condition()
+
+    def start(self):
+        '''
+        Inicia a captura; ler() já pode esperar frames assim que start retorna
+        '''
+        self.executando = True
+        threading.Thread.start(self)
+
+    def run(self):
+        '''
+        Captura os frames até a camera fechar ou parar() ser chamado
+        '''
+        posicao = 0
+        try:
+            while self.executando and self.camera.isOpened():
+                # reaproveita o array da posição quando o tamanho do frame não muda
+                ok, frame = self.camera.read(self.frames[posicao])
+                momento = monotonico()
+                if not ok:
+                    break
+                with self.condicao:
+                    while self.sem_descarte and self.nao_lido is not None and self.executando:
+                        self.condicao.wait(0.1)
+                    self.frames[posicao] = frame
+                    self.momentos[posicao] = momento
+                    self.capturados += 1
+                    if self.nao_lido is not None:
+                        self.descartados += 1
+                    self.mais_novo = posicao
+                    self.nao_lido = posicao
+                    self.condicao.notify_all()
+                    posicao = self._proxima_posicao(posicao)
+        finally:
+            with self.condicao:
+                self.executando = False
+                self.condicao.notify_all()
+
+    def _proxima_posicao(self, posicao):
+        '''
+        Escolhe onde o próximo frame será escrito, sem tocar no mais novo nem no que está em uso
+        :param posicao: posição recém escrita
+        :returns: a próxima posição livre
+        '''
+        while True:
+            posicao = (posicao + 1) % len(self.frames)
+            if posicao != self.mais_novo and posicao != self.em_uso:
+                return posicao
+
+    def tem_frames(self):
+        '''
+        Se ainda há frames para ler: a captura está rodando ou sobrou um frame não lido
+        :returns: True enquanto ler() pode entregar algum frame
+        '''
+        return self.executando or self.nao_lido is not None
+
+    def ler(self, timeout=1.0):
+        '''
+        Entrega o frame mais novo que ainda não foi lido, esperando um chegar se preciso.
+        O frame continua válido até a próxima chamada de ler.
+        :param timeout: tempo máximo de espera em segundos
+        :returns: (frame, momento monotônico da captura) ou (None, None) se nenhum frame chegou
+        '''
+        limite = time.time() + timeout
+        with self.condicao:
+            while self.nao_lido is None and self.executando:
+                restante = limite - time.time()
+                if restante <= 0:
+                    break
+                self.condicao.wait(restante)
+            if self.nao_lido is None:
+                return None, None
+            self.em_uso = self.nao_lido
+            self.nao_lido = None
+            self.condicao.notify_all()
+            return self.frames[self.em_uso], self.momentos[self.em_uso]
+
+    def parar(self):
+        '''
+        Para a captura e espera a thread terminar
+        '''
+        self.executando = False
+        if self.is_alive():
+            self.join()
@@ -3,13 +3,23 @@
 
 import cv2
 import numpy as np
+import os
 import sys
 import json
 import time
+import struct
 from optparse import OptionParser
 from SimpleWebSocketServer import WebSocket, SimpleWebSocketServer
 from multiprocessing import Process
 import threading
+from captura_frames import CapturaFrames
+from rastreamento import Segmentador, RastreadorROI, RastreadorCamShift
+from limiar_lut import LimiarLUT
+from previa_deteccao import PreviaDeteccao
+from fonte_frames import abrir_fonte
+from estado_jogo import EstadoJogo, PersistenciaEstado
+from historico_y import HistoricoY
+from estimador_movimento import EstimadorKalman, quantil_normal
 
 processo = None
 
@@ -32,6 +42,12 @@ class GerenciadorEstadoJogador(object):
     # Constantes
     ARQUIVO_ESTADO_JOGADOR = './file/estado_jogador.json'
     ARQUIVO_ESTADO_VIDA_JOGADOR = './file/estado_jogo_cliente.json'
+    # Subprotocolo do WebSocket em que o estado vai como frame binário em vez de JSON
+    SUBPROTOCOLO_BINARIO = 'jump-estado-binario'
+    # movimento, calibrado, número de sequência e momento monotônico da captura em ms (0 sem frame)
+    FORMATO_BINARIO = struct.Struct('!bBId')
+    # um estado novo substitui o anterior que ainda não saiu da fila do WebSocket
+    CHAVE_ESTADO = 'estado'
 
     class EstadosJogador(object):
 
@@ -42,16 +58,37 @@ class GerenciadorEstadoJogador(object):
         PULANDO = 1
         AGACHADO = -1
 
-    def __init__(self, conexao=None):
+    def __init__(self, conexao=None, estado=None):
+        '''
+        Construtor da Classe
+        :param conexao: WebSocket do jogo, sem ela o estado só fica no EstadoJogo
+        :param estado: EstadoJogo compartilhado com o servidor; sem ele o estado fica só neste objeto
+        '''
         self.conexao = conexao
+        self.estado = estado if estado is not None else EstadoJogo()
+        self.sequencia = 0
         self.atualizar_estado(Movimentos.EM_PE, False)
         self._set_vivo(True)
 
-    def atualizar_estado(self, movimento, calibrado):
+    @staticmethod
+    def arquivo_faixa(arquivo, faixa):
         '''
-        Atualiza o estado do jogador no arquivo
+        Caminho do arquivo de estado de uma faixa
+        :param arquivo: caminho do arquivo quando há um só jogador
+        :param faixa: faixa do pool de detectores ou None
+        :returns: o caminho com o número da faixa antes da extensão
+        '''
+        if faixa is None:
+            return arquivo
+        nome, extensao = os.path.splitext(arquivo)
+        return '{0}_{1}{2}'.format(nome, faixa, extensao)
+
+    def atualizar_estado(self, movimento, calibrado, momento_captura=None):
+        '''
+        Atualiza o estado do jogador e o envia ao jogo
         :param movimento: movimento do jogador
         :param calibrado: se a camera foi calibrada com o jogador
+        :param momento_captura: momento monotônico da captura do frame que gerou o estado
         '''
         novo_estado = 0
         if movimento == Movimentos.EM_PE:
@@ -60,60 +97,91 @@ class GerenciadorEstadoJogador(object):
             novo_estado = self.EstadosJogador.PULANDO
         elif movimento == Movimentos.AGACHADO:
             novo_estado = self.EstadosJogador.AGACHADO
-        estado_jogador = {"movimento": novo_estado, "calibrado": calibrado}
-        str_json = json.dumps(estado_jogador)
+        self.estado.atualizar(movimento=novo_estado, calibrado=calibrado)
         if self.conexao is None:
-            # Recria o arquivo e insere o novo estado do jogador
-            print 'escreveu no arquivo: ', str_json
-            with open(self.ARQUIVO_ESTADO_JOGADOR, 'w') as arq:
-                arq.write(str_json)
-        else:
+            # quem precisar do estado em arquivo usa a PersistenciaEstado
+            return
+        self.sequencia = (self.sequencia + 1) % 0x100000000
+        if self.conexao.subprotocol == self.SUBPROTOCOLO_BINARIO:
             try:
-                print self.conexao.address
-                print 'Enviou: ', str_json
-                self.conexao.sendMessage(str_json)
+                self.conexao.sendMessage(
+                    self.codificar_binario(novo_estado, calibrado, momento_captura), self.CHAVE_ESTADO)
+                self.registrar_envio(momento_captura)
             except:
                 print 'Não foi possível enviar a mensagem ao cliente'
+            return
+        estado_jogador = {"movimento": novo_estado, "calibrado": calibrado, "sequencia": self.sequencia,
+                          "captura": None if momento_captura is None else momento_captura * 1000}
+        str_json = json.dumps(estado_jogador)
+        try:
+            print self.conexao.address
+            print 'Enviou: ', str_json
+            self.conexao.sendMessage(str_json, self.CHAVE_ESTADO)
+            self.registrar_envio(momento_captura)
+        except:
+            print 'Não foi possível enviar a mensagem ao cliente'
+
+    def registrar_envio(self, momento_captura):
+        '''
+        Conta o estado recém enviado na latência da conexão, se ela mede
+        :param momento_captura: momento monotônico da captura do frame que gerou o estado
+        '''
+        latencia = getattr(self.conexao, 'latencia', None)
+        if latencia is not None:
+            latencia.registrar_envio(self.sequencia, momento_captura)
+
+    def codificar_binario(self, estado, calibrado, momento_captura=None):
+        '''
+        Codifica o estado do jogador no formato binário
+        :param estado: estado do jogador
+        :param calibrado: se a camera foi calibrada com o jogador
+        :param momento_captura: momento monotônico da captura do frame que gerou o estado
+        :returns: bytearray com o estado, enviado como frame BINARY
+        '''
+        return bytearray(self.FORMATO_BINARIO.pack(
+            estado, 1 if calibrado else 0, self.sequencia,
+            0.0 if momento_captura is None else momento_captura * 1000))
+
+    @classmethod
+    def decodificar_binario(cls, dados):
+        '''
+        Decodifica o estado do jogador do formato binário
+        :param dados: estado codificado por codificar_binario
+        :returns: dicionário com o estado, no mesmo formato do JSON
+        '''
+        estado, calibrado, sequencia, captura = cls.FORMATO_BINARIO.unpack(str(dados))
+        return {"movimento": estado, "calibrado": bool(calibrado), "sequencia": sequencia,
+                "captura": captura or None}
 
     def _set_vivo(self, vivo):
         '''
         Seta o estado vivo do jogador
         :param vivo: se o jogador está vivo
         '''
-        try:
-            with open(self.ARQUIVO_ESTADO_VIDA_JOGADOR, 'r') as arq:
-                estado_jogo = json.loads(arq.read())
-                estado_jogo['jogador_vivo'] = vivo
-            with open(self.ARQUIVO_ESTADO_VIDA_JOGADOR, 'w') as arq:
-                arq.write(json.dumps(estado_jogo))
-        except ValueError as e:
-            print e
+        self.estado.atualizar(jogador_vivo=vivo)
 
     def is_vivo(self):
         '''
         verifica se o jogador está vivo ou não
         :returns: True se o jogador está vivo e False se não
         '''
-        try:
-            with open(self.ARQUIVO_ESTADO_VIDA_JOGADOR) as arq:
-                vivo_str = arq.read()
-                print vivo_str
-            vivo = json.loads(vivo_str)
-            return vivo['jogador_vivo']
-        except ValueError as e:
-            print e
-            return False
+        return self.estado.ler('jogador_vivo')
 
     def tela_atual(self):
         '''
         retorna a tela atual do jogo
         :returns: a tela atual do jogo
         '''
-        with open(self.ARQUIVO_ESTADO_VIDA_JOGADOR) as arq:
-            str_estado_jogo = arq.read()
-        estado_jogo = json.loads(str_estado_jogo)
-        tela = estado_jogo['tela']
-        return tela
+        return self.estado.ler('tela')
+
+    def esperar_tela(self, tela, timeout=None):
+        '''
+        Espera o jogo chegar a uma tela, acordando assim que o estado muda
+        :param tela: tela esperada
+        :param timeout: espera máxima em segundos, ou None
+        :returns: True se o jogo chegou à tela
+        '''
+        return self.estado.esperar(lambda estado: estado['tela'] == tela, timeout)
 
     def finish(self):
         '''
@@ -134,12 +202,24 @@ class DetectorMovimento(threading.Thread):
     MARGEM_ERRO_CALIBRACAO = 20
     # evita que um simples aumento na altura da pessoa seja considerado um pulo
     MARGEM_TOLERANCIA = 70
+    # o histórico custa o mesmo por frame qualquer que seja o tamanho, pode crescer com o fps
     NUM_Y_ANALIZADOS = 5
 
     NUM_Y_GUARDADOS = 5
 
     ALTURA_AGACHAMENTO = 340
 
+    ARQUIVO_TABELA_CORES = './file/tabela_cores.npz'
+
+    TITULO_JANELA = 'JUMP! Detecção'
+
+    # modo estimador: as transições disparam pela posição prevista HORIZONTE_PREVISAO segundos à frente
+    HORIZONTE_PREVISAO = 0.1
+    CONFIANCA_ESTIMADOR = 0.95
+    # abaixo dessa velocidade (px/s) o jogador está parado e o y de repouso acompanha a postura dele
+    VELOCIDADE_REPOUSO = 60.0
+    SUAVIZACAO_REPOUSO = 0.05
+
     class VariacoesMovimento(object):
 
         '''
@@ -149,35 +229,81 @@ class DetectorMovimento(threading.Thread):
         PARA_BAIXO = -1
         SEM_MOVIMENTO = 0
 
-    def __init__(self, id_camera=0, agachar_desabilitado=False, conexao=None):
+    def __init__(self, id_camera=0, agachar_desabilitado=False, conexao=None, rastreamento_roi=False,
+                 tabela_cores=False, sem_interface=False, fps_previa=0, estado_jogo=None,
+                 quadro_compartilhado=None, fonte=None, estimador=False,
+                 confianca_estimador=CONFIANCA_ESTIMADOR, camshift=False):
         '''
         Construtor da Classe
         :param id_camera: identificador da camera que será utilizada, o padrão é 0
+        :param rastreamento_roi: procura o marcador reduzido e refina perto da última posição
+        :param tabela_cores: limiariza o frame bgr por uma tabela pré-calculada em vez de converter para hsv
+        :param sem_interface: não desenha nem abre janela, para rodar sem monitor
+        :param fps_previa: sem interface, mostra uma prévia com essa taxa numa thread própria; 0 desliga
+        :param estado_jogo: EstadoJogo compartilhado com o servidor, ou None para um só deste detector
+        :param quadro_compartilhado: QuadroCompartilhado onde publicar a detecção para outro processo mostrar
+        :param fonte: fonte de frames no lugar da camera, qualquer objeto com a interface de cv2.VideoCapture
+        :param estimador: detecta pulo e agachamento pela previsão de um filtro de Kalman em vez da janela de y
+        :param confianca_estimador: probabilidade mínima da previsão para o estimador disparar uma transição
+        :param camshift: depois da calibração, segue o marcador pela cor aprendida com CamShift em vez de segmentar
         '''
         threading.Thread.__init__(self)
         self.conexao = conexao
         self.movimento = Movimentos.EM_PE
         self.id_camera = id_camera
         self.agachar_desabilitado = agachar_desabilitado
+        self.sem_interface = sem_interface
+        self.fps_previa = fps_previa
+        self.previa = None
+        self.estado_jogo = estado_jogo if estado_jogo is not None else EstadoJogo()
+        self.quadro_compartilhado = quadro_compartilhado
+
+        if tabela_cores:
+            # a tabela fica salva em disco, só é recalculada se a faixa de cor mudar
+            tabela_cores = LimiarLUT(Segmentador.COR_MINIMA, Segmentador.COR_MAXIMA,
+                                     arquivo=self.ARQUIVO_TABELA_CORES)
+        else:
+            tabela_cores = None
+        self.segmentador = Segmentador(tabela_cores)
+        self.camshift = None
+        if camshift:
+            self.camshift = self.localizador = RastreadorCamShift(self.segmentador)
+        elif rastreamento_roi:
+            self.localizador = RastreadorROI(self.segmentador)
+        else:
+            self.localizador = self.segmentador
 
-        if conexao is None:
+        if fonte is not None:
+            self.camera = fonte
+        elif conexao is None:
             self.camera = cv2.VideoCapture(self.id_camera)
         else:
             self.camera = conexao.camera
         if not self.camera.isOpened():
             raise IOError('Não foi possivel ter acesso a camera')
-        if self.NUM_Y_ANALIZADOS > self.NUM_Y_GUARDADOS:
-            raise ValueError(
-                "Número de Y analisados deve ser igual ou menor que o número de Y guardados")
         self.width, self.height = self.camera.get(3), self.camera.get(4)
         print 'Resolução da camera {0} x {1}'.format(self.width, self.height)
+        # a captura roda em paralelo ao processamento, que sempre pega o frame mais novo;
+        # fontes gravadas fora de tempo real não perdem frames, para a execução ser repetível
+        self.sem_descarte = not getattr(self.camera, 'tempo_real', True)
+        self.captura = CapturaFrames(self.camera, sem_descarte=self.sem_descarte)
 
-        self.ys = []
+        self.historico_y = HistoricoY(self.NUM_Y_GUARDADOS, self.NUM_Y_ANALIZADOS)
         self.desenhar_linhas = False
         self.calibrado = False
+        self.momento_pulo = {'y': None}
+        self.momento_agachar = {'y': None}
+        self.espelhado = None
+
+        self.estimador = None
+        if estimador:
+            self.estimador = EstimadorKalman(1.0 / (self.camera.get(cv2.CAP_PROP_FPS) or 30.0))
+            self.z_confianca = quantil_normal(confianca_estimador)
+        self.y_repouso = None
+        self.levantando = False
 
         self.gerenciador_estado_jogador = GerenciadorEstadoJogador(
-            conexao=self.conexao)
+            conexao=self.conexao, estado=self.estado_jogo)
 
     def return_name(self):
         '''
@@ -198,26 +324,52 @@ class DetectorMovimento(threading.Thread):
         :param hsv: imagem no formato de cor hsv
         :returns: a faixa de cor
         '''
-        min_cor = np.array((110, 100, 80), np.uint8)
-        max_cor = np.array((140, 190, 190), np.uint8)
+        return self.segmentador.limiarizar(hsv)
 
-        faixa_cor = cv2.inRange(hsv, min_cor, max_cor)
-        return faixa_cor
+    def desenhar(self, frame, retangulo, no_centro):
+        '''
+        Desenha no frame o quadrado de calibração, o marcador e as linhas de referência
+        :param frame: frame onde desenhar
+        :param retangulo: (x, y, w, h) do marcador ou None
+        :param no_centro: se o marcador está dentro do quadrado de calibração
+        '''
+        centro_x, centro_y = (int)(self.width / 2), (int)(self.height / 2)
+        # o quadrado no centro, para calibrar, fica vermelho com o marcador dentro
+        cv2.rectangle(
+            frame, (centro_x - (self.LARGURA_QUADRADO_CENTRO / 2),
+                    centro_y - (self.ALTURA_QUADRADO_CENTRO / 2)),
+            (centro_x + (self.LARGURA_QUADRADO_CENTRO / 2), centro_y + (self.ALTURA_QUADRADO_CENTRO / 2)),
+            [0, 0, 255] if no_centro else [0, 255, 0], 2)
+
+        if retangulo is not None:
+            x, y, w, h = retangulo
+            cv2.rectangle(frame, (x, y), (x + w, y + h), [255, 0, 0], 2)
+
+        if self.desenhar_linhas:
+            # linha superior (640 x 50)
+            cv2.line(frame, (0, 50), (int(self.width), 50),
+                     (0, 255, 255), 2)
+
+            # linha inferior (640 x 430)
+            cv2.line(frame, (0, int(self.height - 50)),
+                     (int(self.width), int(self.height - 50)), (0, 255, 255), 2)
+
+            # linha que define se o usuário agachou (640 x 330)
+            cv2.line(frame, (0, int(self.height - 150)),
+                     (int(self.width), int(self.height - 150)), (0, 0, 255), 2)
 
     def verificar_movimento(self):
         '''
         Verifica se houve movimento e se foi para baixo ou para cima
         :returns: 0 se não houve movimento, 1 se houve movimento para cima e -1 se houve movimento para baixo
         '''
-        ultimos_valores_y = [0]
-        if len(self.ys) >= self.NUM_Y_ANALIZADOS:
-            ultimos_valores_y = self.ys[
-                len(self.ys) - self.NUM_Y_ANALIZADOS:len(self.ys)]
+        if not self.historico_y.janela_cheia():
+            return self.VariacoesMovimento.SEM_MOVIMENTO
         # houve diferenca maior que a margem entre dois pontos Y dentro do
         # numero de pontos analizados
-        if max(ultimos_valores_y) - min(ultimos_valores_y) > self.MARGEM_TOLERANCIA:
-            ultimo_y = self.ys[len(self.ys) - 1]
-            primeiro_y = self.ys[0]
+        if self.historico_y.maximo() - self.historico_y.minimo() > self.MARGEM_TOLERANCIA:
+            ultimo_y = self.historico_y.ultimo()
+            primeiro_y = self.historico_y.primeiro()
             if primeiro_y < ultimo_y:  # ta descendo
                 return self.VariacoesMovimento.PARA_BAIXO
             else:  # ta subindo
@@ -225,193 +377,253 @@ class DetectorMovimento(threading.Thread):
         else:
             return self.VariacoesMovimento.SEM_MOVIMENTO
 
+    def espelhar(self, frame):
+        '''
+        Espelha o frame horizontalmente, num buffer próprio, pois o frame da captura é reaproveitado por ela
+        :param frame: frame da captura
+        :returns: o frame espelhado, válido até a próxima chamada
+        '''
+        if self.espelhado is None or self.espelhado.shape != frame.shape:
+            self.espelhado = np.empty_like(frame)
+        return cv2.flip(frame, 1, dst=self.espelhado)
+
+    def atualizar_movimento(self, retangulo, momento_captura=None):
+        '''
+        Atualiza a calibração e o movimento do jogador com o marcador de um frame
+        :param retangulo: (x, y, w, h) do marcador ou None se ele não foi encontrado
+        :param momento_captura: momento monotônico da captura do frame, segue no estado enviado
+        :returns: True se o marcador está dentro do quadrado de calibração
+        '''
+        centro_y = (int)(self.height / 2)
+        no_centro = False
+
+        if not self.calibrado:
+            self.historico_y.limpar()
+            self.momento_pulo['y'] = None
+            self.momento_agachar['y'] = None
+            if self.estimador is not None:
+                self.estimador.reiniciar()
+                self.y_repouso = None
+                self.levantando = False
+
+        if retangulo is not None:
+            x, y, w, h = retangulo
+            cx, cy = x + w / 2, y + h / 2
+
+            # verifica se ta no centro
+            if y > centro_y - (self.ALTURA_QUADRADO_CENTRO / 2) - self.MARGEM_ERRO_CALIBRACAO and \
+                y < centro_y - (self.ALTURA_QUADRADO_CENTRO / 2) + self.MARGEM_ERRO_CALIBRACAO and \
+                y + h > centro_y + (self.ALTURA_QUADRADO_CENTRO / 2) - self.MARGEM_ERRO_CALIBRACAO and \
+                    y + h < centro_y + (self.ALTURA_QUADRADO_CENTRO / 2) + self.MARGEM_ERRO_CALIBRACAO:
+                no_centro = True
+                if not self.calibrado:
+                    print 'Calibrou'
+                    self.calibrado = True
+                    if self.camshift is not None:
+                        self.camshift.aprender(retangulo)
+                    self.gerenciador_estado_jogador.atualizar_estado(
+                        self.movimento, self.calibrado, momento_captura)
+
+            # ta guardando ate NUM_Y_GUARDADOS Y
+            self.historico_y.adicionar(y, momento_captura)
+            if self.calibrado and self.estimador is not None:
+                self.atualizar_movimento_estimado(y, momento_captura)
+            elif self.calibrado:
+                # verifica o tipo do movimento, 1 para subiu e -1 para
+                # desceu e 0 para nao movimentou
+                variacao_movimento = self.verificar_movimento()
+                mudou_movimento = False
+                if variacao_movimento:
+                    # guarda o movimento antigo, mas pra nada
+                    movimento_antigo = self.movimento
+                    # subiu, mas o que houve?
+                    if variacao_movimento == self.VariacoesMovimento.PARA_CIMA:
+                        # pulou
+                        if self.movimento == Movimentos.EM_PE:
+                            self.movimento = Movimentos.SUBINDO
+                            self.momento_pulo['y'] = y
+                            mudou_movimento = True
+                        # levantou
+                        elif self.movimento == Movimentos.AGACHADO:
+                            # and y > self.momento_agachar['y'] -
+                            # self.MARGEM_TOLERANCIA
+                            if self.momento_agachar['y'] != None and y < self.momento_agachar['y'] + self.MARGEM_TOLERANCIA:
+                                self.movimento = Movimentos.EM_PE
+                                mudou_movimento = True
+                    # desceu, mas o que houve?
+                    elif variacao_movimento == self.VariacoesMovimento.PARA_BAIXO:
+                        # agachou
+                        if self.movimento == Movimentos.EM_PE and not self.agachar_desabilitado and y > self.ALTURA_AGACHAMENTO:
+                            self.momento_agachar['y'] = y
+                            self.movimento = Movimentos.AGACHADO
+                            mudou_movimento = True
+                        # ta descendo do pulo
+                        elif self.movimento == Movimentos.SUBINDO:
+                            self.movimento = Movimentos.DESCENDO
+                            mudou_movimento = True
+
+                    if self.movimento == Movimentos.DESCENDO:
+                        # voltou ao chao
+                        # and y < self.momento_pulo['y'] +
+                        # self.MARGEM_TOLERANCIA:
+                        if self.momento_pulo['y'] != None and y > self.momento_pulo['y'] - self.MARGEM_TOLERANCIA:
+                            self.movimento = Movimentos.EM_PE
+                            self.momento_pulo['y'] = None
+                            mudou_movimento = True
+                    # print 'mov:{0} mov_ant: {1} mov_var:
+                    # {2}'.format(self.movimento, movimento_antigo,
+                    # variacao_movimento)
+                    if mudou_movimento:
+                        if self.movimento == Movimentos.SUBINDO:
+                            print 'Pulou em px: {0}'.format(self.momento_pulo['y'])
+                        elif self.movimento == Movimentos.AGACHADO:
+                            print 'Agachou em px: {0}'.format(self.momento_agachar['y'])
+                        elif self.movimento == Movimentos.EM_PE:
+                            print 'De pé em px: {0}'.format(y)
+                        self.gerenciador_estado_jogador.atualizar_estado(
+                            self.movimento, self.calibrado, momento_captura)
+                # nao houve variacao grande entre os pontos
+                else:
+                    # and y < self.momento_pulo['y'] + self.MARGEM_TOLERANCIA:
+                    if self.momento_pulo['y'] != None and y > self.momento_pulo['y'] - self.MARGEM_TOLERANCIA:
+                        if self.movimento == Movimentos.DESCENDO:
+                            print 'De pé em px: {0}'.format(y)
+                            self.movimento = Movimentos.EM_PE
+                            self.momento_pulo['y'] = None
+                            self.gerenciador_estado_jogador.atualizar_estado(
+                                self.movimento, self.calibrado, momento_captura)
+                            mudou_movimento = True
+                    # and y > self.momento_agachar['y'] - self.MARGEM_TOLERANCIA:
+                    # não considera a margem de tolerancia, pois ao agachar
+                    # ele pode ja levantar. O ideal seria uma outra margem,
+                    # mas menor
+                    if self.momento_agachar['y'] != None and y < self.momento_agachar['y'] - self.MARGEM_TOLERANCIA:
+                        if self.movimento == Movimentos.AGACHADO:
+                            print 'De pé em px: {0}'.format(y)
+                            self.movimento = Movimentos.EM_PE
+                            self.momento_agachar['y'] = None
+                            self.gerenciador_estado_jogador.atualizar_estado(
+                                self.movimento, self.calibrado, momento_captura)
+                            mudou_movimento = True
+                if self.movimento == Movimentos.EM_PE and mudou_movimento:
+                    # if self.momento_agachar['y']:
+                    #    for i in self.ys:
+                    #        if i < self.momento_agachar['y']:
+                    #            self.ys.remove(i)
+                    # else:
+                    self.historico_y.limpar()
+
+        return no_centro
+
+    def atualizar_movimento_estimado(self, y, momento_captura):
+        '''
+        Máquina de estados do modo estimador: em vez de esperar a variação de y
+        passar da margem dentro da janela, as transições disparam quando a
+        posição prevista pelo filtro passa dos limites com a confiança pedida
+        :param y: y do marcador no frame
+        :param momento_captura: momento monotônico da captura do frame
+        '''
+        # fontes gravadas fora de tempo real chegam mais rápido que o fps delas, o intervalo é o nominal
+        self.estimador.atualizar(y, None if self.sem_descarte else momento_captura)
+        previsto, desvio = self.estimador.prever(self.HORIZONTE_PREVISAO)
+        velocidade, desvio_velocidade = self.estimador.velocidade
+        margem = self.z_confianca * desvio
+        if self.y_repouso is None:
+            self.y_repouso = y
+
+        movimento_antigo = self.movimento
+        if self.movimento == Movimentos.EM_PE:
+            if self.levantando:
+                # ainda subindo do agachamento: a previsão passaria do repouso e viraria um pulo falso
+                self.levantando = velocidade < -self.VELOCIDADE_REPOUSO
+            elif self.y_repouso - (previsto + margem) > self.MARGEM_TOLERANCIA:
+                self.movimento = Movimentos.SUBINDO
+                self.momento_pulo['y'] = y
+            elif not self.agachar_desabilitado and previsto - margem > self.ALTURA_AGACHAMENTO and \
+                    previsto - margem - self.y_repouso > self.MARGEM_TOLERANCIA:
+                self.movimento = Movimentos.AGACHADO
+                self.momento_agachar['y'] = y
+            elif abs(velocidade) < self.VELOCIDADE_REPOUSO:
+                # parado, o repouso acompanha devagar a postura do jogador
+                self.y_repouso += self.SUAVIZACAO_REPOUSO * (self.estimador.y - self.y_repouso)
+        elif self.movimento == Movimentos.SUBINDO:
+            # passou do ponto mais alto
+            if velocidade - self.z_confianca * desvio_velocidade > 0:
+                self.movimento = Movimentos.DESCENDO
+        elif self.movimento == Movimentos.DESCENDO:
+            # vai chegar ao chão dentro do horizonte
+            if previsto - margem > self.y_repouso - self.MARGEM_TOLERANCIA:
+                self.movimento = Movimentos.EM_PE
+                self.momento_pulo['y'] = None
+        elif self.movimento == Movimentos.AGACHADO:
+            # vai voltar para perto do repouso dentro do horizonte
+            if previsto + margem < self.y_repouso + self.MARGEM_TOLERANCIA:
+                self.movimento = Movimentos.EM_PE
+                self.momento_agachar['y'] = None
+                self.levantando = True
+
+        if self.movimento != movimento_antigo:
+            if self.movimento == Movimentos.SUBINDO:
+                print 'Pulou em px: {0}'.format(self.momento_pulo['y'])
+            elif self.movimento == Movimentos.AGACHADO:
+                print 'Agachou em px: {0}'.format(self.momento_agachar['y'])
+            elif self.movimento == Movimentos.EM_PE:
+                print 'De pé em px: {0}'.format(y)
+            self.gerenciador_estado_jogador.atualizar_estado(
+                self.movimento, self.calibrado, momento_captura)
+
     def iniciar(self):
         '''
         Inicia a detecção
         '''
         # so inica a deteccao caso o jogo esteja no menu
-        while self.gerenciador_estado_jogador.tela_atual() != 'menu':
+        if self.gerenciador_estado_jogador.tela_atual() != 'menu':
             print 'Jogo não está na tela de menu'
-            time.sleep(0.5)
+            self.gerenciador_estado_jogador.esperar_tela('menu')
 
-        momento_pulo = {}
-        momento_agachar = {}
-        centro_x, centro_y = (int)(self.width / 2), (int)(self.height / 2)
+        self.momento_pulo = {'y': None}
+        self.momento_agachar = {'y': None}
 
         # print 'Numero de frames:
         # {0}'.format(self.camera.get(cv2.cv.CV_CAP_PROP_FRAME_COUNT))
-        contador = 0
-        while(self.camera.isOpened()):
-            contador = contador + 1
-            # a cada N loops ele verifica se o jogador ta vivo
-            if contador % 50 == 0:
-                if not self.gerenciador_estado_jogador.is_vivo():
-                    print 'Jogador perdeu'
-                    break
-            _, frame = self.camera.read()
-            frame = cv2.flip(frame, 1)
-            blur = cv2.medianBlur(frame, 5)
-            hsv = cv2.cvtColor(frame, cv2.COLOR_BGR2HSV)
-
-            faixa_cor = self.get_thresholded_image(hsv)
-            erode = cv2.erode(faixa_cor, None, iterations=3)
-            dilate = cv2.dilate(erode, None, iterations=10)
-
-            contours, hierarchy = cv2.findContours(
-                dilate, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
-
-            # desenha o quadrado no centro, para calibrar
-            cv2.rectangle(
-                frame, (centro_x - (self.LARGURA_QUADRADO_CENTRO / 2),
-                        centro_y - (self.ALTURA_QUADRADO_CENTRO / 2)),
-                (centro_x + (self.LARGURA_QUADRADO_CENTRO / 2), centro_y + (self.ALTURA_QUADRADO_CENTRO / 2)), [0, 255, 0], 2)
-
-            if not self.calibrado:
-                self.ys = []
-                momento_pulo['y'] = None
-                momento_agachar['y'] = None
-
-            if contours:
-                maior_area = 0
-                maior_contorno = contours[0]
-                for cont in contours:
-                    cx, cy, cw, ch = cv2.boundingRect(cont)
-                    area = cw * ch
-                    if area > maior_area:
-                        maior_area = area
-                        maior_contorno = cont
-
-                x, y, w, h = cv2.boundingRect(maior_contorno)
-                cx, cy = x + w / 2, y + h / 2
-
-                # verifica se ta no centro
-                if y > centro_y - (self.ALTURA_QUADRADO_CENTRO / 2) - self.MARGEM_ERRO_CALIBRACAO and \
-                    y < centro_y - (self.ALTURA_QUADRADO_CENTRO / 2) + self.MARGEM_ERRO_CALIBRACAO and \
-                    y + h > centro_y + (self.ALTURA_QUADRADO_CENTRO / 2) - self.MARGEM_ERRO_CALIBRACAO and \
-                        y + h < centro_y + (self.ALTURA_QUADRADO_CENTRO / 2) + self.MARGEM_ERRO_CALIBRACAO:
-                    if not self.calibrado:
-                        print 'Calibrou'
-                        self.calibrado = True
-                        self.gerenciador_estado_jogador.atualizar_estado(
-                            self.movimento, self.calibrado)
-                    # dentro do quadrado
-                    cv2.rectangle(
-                        frame, (centro_x - (self.LARGURA_QUADRADO_CENTRO / 2),
-                                centro_y - (self.ALTURA_QUADRADO_CENTRO / 2)),
-                        (centro_x + (self.LARGURA_QUADRADO_CENTRO / 2), centro_y + (self.ALTURA_QUADRADO_CENTRO / 2)), [0, 0, 255], 2)
-
-                # print hsv.item(cy, cx, 0), hsv.item(cy, cx, 1), hsv.item(cy, cx, 2)
-                # if 100 < hsv.item(cy, cx, 0) < 120:
-                cv2.rectangle(frame, (x, y), (x + w, y + h), [255, 0, 0], 2)
-
-                if len(self.ys) >= self.NUM_Y_GUARDADOS:
-                    self.ys = self.ys[1:self.NUM_Y_GUARDADOS]
-                self.ys.append(y)
-                # ta guardando ate NUM_Y_GUARDADOS Y
-                if self.calibrado:
-                    # verifica o tipo do movimento, 1 para subiu e -1 para
-                    # desceu e 0 para nao movimentou
-                    variacao_movimento = self.verificar_movimento()
-                    mudou_movimento = False
-                    if variacao_movimento:
-                        # guarda o movimento antigo, mas pra nada
-                        movimento_antigo = self.movimento
-                        # subiu, mas o que houve?
-                        if variacao_movimento == self.VariacoesMovimento.PARA_CIMA:
-                            # pulou
-                            if self.movimento == Movimentos.EM_PE:
-                                self.movimento = Movimentos.SUBINDO
-                                momento_pulo['y'] = y
-                                mudou_movimento = True
-                            # levantou
-                            elif self.movimento == Movimentos.AGACHADO:
-                                # and y > momento_agachar['y'] -
-                                # self.MARGEM_TOLERANCIA
-                                if momento_agachar['y'] != None and y < momento_agachar['y'] + self.MARGEM_TOLERANCIA:
-                                    self.movimento = Movimentos.EM_PE
-                                    mudou_movimento = True
-                        # desceu, mas o que houve?
-                        elif variacao_movimento == self.VariacoesMovimento.PARA_BAIXO:
-                            # agachou
-                            if self.movimento == Movimentos.EM_PE and not self.agachar_desabilitado and y > self.ALTURA_AGACHAMENTO:
-                                momento_agachar['y'] = y
-                                self.movimento = Movimentos.AGACHADO
-                                mudou_movimento = True
-                            # ta descendo do pulo
-                            elif self.movimento == Movimentos.SUBINDO:
-                                self.movimento = Movimentos.DESCENDO
-                                mudou_movimento = True
-
-                        if self.movimento == Movimentos.DESCENDO:
-                            # voltou ao chao
-                            # and y < momento_pulo['y'] +
-                            # self.MARGEM_TOLERANCIA:
-                            if momento_pulo['y'] != None and y > momento_pulo['y'] - self.MARGEM_TOLERANCIA:
-                                self.movimento = Movimentos.EM_PE
-                                momento_pulo['y'] = None
-                                mudou_movimento = True
-                        # print 'mov:{0} mov_ant: {1} mov_var:
-                        # {2}'.format(self.movimento, movimento_antigo,
-                        # variacao_movimento)
-                        if mudou_movimento:
-                            if self.movimento == Movimentos.SUBINDO:
-                                print 'Pulou em px: {0}'.format(momento_pulo['y'])
-                            elif self.movimento == Movimentos.AGACHADO:
-                                print 'Agachou em px: {0}'.format(momento_agachar['y'])
-                            elif self.movimento == Movimentos.EM_PE:
-                                print 'De pé em px: {0}'.format(y)
-                            self.gerenciador_estado_jogador.atualizar_estado(
-                                self.movimento, self.calibrado)
-                            # print self.ys
-                    # nao houve variacao grande entre os pontos
-                    else:
-                        # and y < momento_pulo['y'] + self.MARGEM_TOLERANCIA:
-                        if momento_pulo['y'] != None and y > momento_pulo['y'] - self.MARGEM_TOLERANCIA:
-                            if self.movimento == Movimentos.DESCENDO:
-                                print 'De pé em px: {0}'.format(y)
-                                self.movimento = Movimentos.EM_PE
-                                momento_pulo['y'] = None
-                                self.gerenciador_estado_jogador.atualizar_estado(
-                                    self.movimento, self.calibrado)
-                                mudou_movimento = True
-                        # and y > momento_agachar['y'] - self.MARGEM_TOLERANCIA:
-                        # não considera a margem de tolerancia, pois ao agachar
-                        # ele pode ja levantar. O ideal seria uma outra margem,
-                        # mas menor
-                        if momento_agachar['y'] != None and y < momento_agachar['y'] - self.MARGEM_TOLERANCIA:
-                            if self.movimento == Movimentos.AGACHADO:
-                                print 'De pé em px: {0}'.format(y)
-                                self.movimento = Movimentos.EM_PE
-                                momento_agachar['y'] = None
-                                self.gerenciador_estado_jogador.atualizar_estado(
-                                    self.movimento, self.calibrado)
-                                mudou_movimento = True
-                    if self.movimento == Movimentos.EM_PE and mudou_movimento:
-                        # if momento_agachar['y']:
-                        #    for i in self.ys:
-                        #        if i < momento_agachar['y']:
-                        #            self.ys.remove(i)
-                        # else:
-                        self.ys = []
-
-            if self.desenhar_linhas:
-                # linha superior (640 x 50)
-                cv2.line(frame, (0, 50), (int(self.width), 50),
-                         (0, 255, 255), 2)
-
-                # linha inferior (640 x 430)
-                cv2.line(frame, (0, int(self.height - 50)),
-                         (int(self.width), int(self.height - 50)), (0, 255, 255), 2)
-
-                # linha que define se o usuário agachou (640 x 330)
-                cv2.line(frame, (0, int(self.height - 150)),
-                         (int(self.width), int(self.height - 150)), (0, 0, 255), 2)
-
-            cv2.imshow('JUMP! Detecção', frame)
-
-            key = cv2.waitKey(25)
+        if not self.captura.is_alive():
+            self.captura = CapturaFrames(self.camera, sem_descarte=self.sem_descarte)
+            self.captura.start()
+        if self.sem_interface and self.fps_previa > 0 and \
+                (self.previa is None or not self.previa.is_alive()):
+            self.previa = PreviaDeteccao(self.desenhar, self.TITULO_JANELA, self.fps_previa)
+            self.previa.start()
+
+        while(self.captura.tem_frames()):
+            # ler o estado não toca em disco nem em trava, o jogo que morre para a detecção no próximo frame
+            if not self.gerenciador_estado_jogador.is_vivo():
+                print 'Jogador perdeu'
+                break
+            frame, momento_captura = self.captura.ler()
+            if frame is None:
+                continue
+            frame = self.espelhar(frame)
+            retangulo = self.localizador.localizar(frame)
+            no_centro = self.atualizar_movimento(retangulo, momento_captura)
+
+            if self.sem_interface:
+                if self.previa is not None:
+                    self.previa.oferecer(frame, retangulo, no_centro)
+                if self.quadro_compartilhado is not None:
+                    self.quadro_compartilhado.oferecer(frame, retangulo, no_centro, self.desenhar)
+                continue
+
+            self.desenhar(frame, retangulo, no_centro)
+            cv2.imshow(self.TITULO_JANELA, frame)
+
+            # o ritmo vem da captura, aqui só atende a janela
+            key = cv2.waitKey(1)
             if key == 27:  # esc
                 break
+        # fonte finita (vídeo, sintética) chegou ao fim, não há o que reiniciar
+        if not self.camera.isOpened():
+            print 'Fonte de frames terminou'
+            return
         self.reiniciar()
         '''if self.conexao is None:
             self.reiniciar()
@@ -423,14 +635,16 @@ class DetectorMovimento(threading.Thread):
         reinicia a detecção e os recursos
         '''
         print 'reiniciando captura...'
-        self.ys = []
+        print 'Frames capturados: {0}, descartados: {1}'.format(
+            self.captura.capturados, self.captura.descartados)
+        self.historico_y.limpar()
         self.desenhar_linhas = False
         self.calibrado = False
+        if self.camshift is not None:
+            self.camshift.esquecer()
         self.gerenciador_estado_jogador.finish()
-        if self.conexao is None:
-            self.gerenciador_estado_jogador = GerenciadorEstadoJogador()
-        else:
-            self.gerenciador_estado_jogador = GerenciadorEstadoJogador(conexao=self.conexao)
+        self.gerenciador_estado_jogador = GerenciadorEstadoJogador(
+            conexao=self.conexao, estado=self.estado_jogo)
         self.iniciar()
 
     def finalizar(self):
@@ -440,8 +654,13 @@ class DetectorMovimento(threading.Thread):
         self.calibrado = False
         self.movimento = Movimentos.EM_PE
         self.gerenciador_estado_jogador.finish()
+        self.captura.parar()
         self.camera.release()
-        cv2.destroyAllWindows()
+        if self.previa is not None:
+            self.previa.parar()
+        # sem interface o opencv pode nem ter suporte a janelas
+        if not self.sem_interface:
+            cv2.destroyAllWindows()
 
 if __name__ == "__main__":
     parser = OptionParser()
@@ -449,11 +668,50 @@ if __name__ == "__main__":
                       help="id da camera", type="int", default=0)
     parser.add_option("-a", "--desagachar", dest="agachar_desabilitado",
                       action="store_true", help="Desabilitar agachar", default=False)
+    parser.add_option("-r", "--roi", dest="rastreamento_roi", action="store_true",
+                      help="Rastrear o marcador numa janela em volta da última posição", default=False)
+    parser.add_option("-t", "--tabela-cores", dest="tabela_cores", action="store_true",
+                      help="Limiarizar por uma tabela de cores pré-calculada", default=False)
+    parser.add_option("-k", "--kalman", dest="estimador", action="store_true", default=False,
+                      help="Detectar pulo e agachamento pela previsão de um filtro de Kalman, com menos atraso")
+    parser.add_option("-K", "--confianca", dest="confianca_estimador", type="float",
+                      default=DetectorMovimento.CONFIANCA_ESTIMADOR,
+                      help="Com --kalman, probabilidade mínima da previsão para disparar um movimento")
+    parser.add_option("-m", "--camshift", dest="camshift", action="store_true", default=False,
+                      help="Seguir o marcador pela cor aprendida na calibração, com CamShift")
+    parser.add_option("-s", "--sem-interface", dest="sem_interface", action="store_true",
+                      help="Não desenhar nem abrir janela", default=False)
+    parser.add_option("-p", "--previa", dest="fps_previa", type="float",
+                      help="Sem interface, mostrar uma prévia com essa taxa de frames", default=0)
     parser.add_option(
         "-q", "--quiet", action="store_false", dest="verbose", default=True)
+    parser.add_option("-f", "--fonte", dest="fonte", default=None,
+                      help="Ler os frames de um vídeo, diretório, .npz ou 'sintetico[:roteiro]' em vez da camera")
+    parser.add_option("-x", "--rapido", dest="tempo_real", action="store_false", default=True,
+                      help="Com --fonte, processar os frames o mais rápido possível, sem descartar nenhum")
     (options, args) = parser.parse_args()
 
+    fonte = None
+    if options.fonte is not None:
+        fonte = abrir_fonte(options.fonte, options.tempo_real)
+
+    # sozinho, o detector conversa com o servidor em node pelos arquivos: grava o
+    # estado do jogador e lê o estado do jogo que o servidor escreve
+    estado_jogo = EstadoJogo()
+    persistencia = PersistenciaEstado(
+        estado_jogo, {GerenciadorEstadoJogador.ARQUIVO_ESTADO_JOGADOR: EstadoJogo.CAMPOS_DETECTOR},
+        externos=[GerenciadorEstadoJogador.ARQUIVO_ESTADO_VIDA_JOGADOR])
+    persistencia.start()
+
     detector_movimento = DetectorMovimento(
-        options.id_camera, options.agachar_desabilitado)
-    detector_movimento.iniciar()
-    detector_movimento.finalizar()
+        options.id_camera, options.agachar_desabilitado,
+        rastreamento_roi=options.rastreamento_roi,
+        tabela_cores=options.tabela_cores,
+        sem_interface=options.sem_interface, fps_previa=options.fps_previa,
+        estado_jogo=estado_jogo, fonte=fonte, estimador=options.estimador,
+        confianca_estimador=options.confianca_estimador, camshift=options.camshift)
+    try:
+        detector_movimento.iniciar()
+    finally:
+        detector_movimento.finalizar()
+        persistencia.parar()
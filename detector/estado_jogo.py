@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+# coding:utf-8
+
+import os
+import json
+import time
+import errno
+import fcntl
+import ctypes
+import select
+import threading
+import multiprocessing
+import multiprocessing.util
+
+
+class _Campos(ctypes.Structure):
+    _fields_ = [('sequencia_tela', ctypes.c_uint),
+                ('tela', ctypes.c_char * 32),
+                ('jogador_vivo', ctypes.c_bool),
+                ('calibrado', ctypes.c_bool),
+                ('movimento', ctypes.c_int)]
+
+
+class EstadoJogo(object):
+
+    '''
+    Estado do jogo compartilhado pelo servidor e pelo detector: a tela e se o
+    jogador está vivo vêm do jogo, o movimento e a calibração vêm do detector.
+    Os campos ficam numa memória compartilhada, então o mesmo estado serve
+    entre threads e entre o servidor e as faixas do pool (nesse caso ele
+    precisa ser criado antes do fork). Não há trava entre processos: uma faixa
+    morta não pode deixar o servidor esperando por ela. Cada campo numérico é
+    escrito de uma vez; a tela, que não é, só é escrita por um processo e leva
+    um contador de sequência para a leitura descartar uma escrita pela metade.
+    Cada mudança escreve um byte num pipe que não bloqueia, e é nele que esperar
+    dorme.
+    '''
+    # Constantes
+    TIPOS = {'tela': str, 'jogador_vivo': bool, 'calibrado': bool, 'movimento': int}
+    # campos que o jogo pode mudar pelas mensagens dele
+    CAMPOS_JOGO = ('tela', 'jogador_vivo')
+    CAMPOS_DETECTOR = ('movimento', 'calibrado')
+    TAMANHO_TELA = 31
+    # espera máxima de cada volta em esperar, para o Ctrl+C ser atendido
+    INTERVALO_ESPERA = 1.0
+    # releituras da tela antes de aceitar a que veio, se quem escrevia morreu no meio
+    TENTATIVAS_LEITURA = 100
+
+    def __init__(self, tela='', jogador_vivo=False):
+        '''
+        Construtor da Classe
+        :param tela: tela inicial do jogo
+        :param jogador_vivo: se o jogador começa vivo
+        '''
+        self.campos = multiprocessing.RawValue(_Campos)
+        # o pipe é herdado pelo fork: quem muda o estado escreve nele e quem espera dorme na leitura
+        self.leitura, self.escrita = os.pipe()
+        for descritor in (self.leitura, self.escrita):
+            fcntl.fcntl(descritor, fcntl.F_SETFL, fcntl.fcntl(descritor, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self._apos_fork()
+        # a trava das threads de um processo não pode chegar presa a uma faixa
+        multiprocessing.util.register_after_fork(self, EstadoJogo._apos_fork)
+        self.atualizar(tela=tela, jogador_vivo=jogador_vivo)
+
+    def _apos_fork(self):
+        '''
+        Cria a trava das escritas entre as threads deste processo
+        '''
+        self.trava = threading.Lock()
+
+    @classmethod
+    def validar(cls, campo, valor):
+        '''
+        Confere o tipo do valor de um campo
+        :param campo: nome do campo
+        :param valor: valor novo
+        :returns: o valor no tipo do campo
+        '''
+        if campo not in cls.TIPOS:
+            raise ValueError('Campo desconhecido no estado do jogo: ' + str(campo))
+        tipo = cls.TIPOS[campo]
+        if tipo is str:
+            if not isinstance(valor, basestring):
+                raise TypeError('{0} deve ser texto, veio {1!r}'.format(campo, valor))
+            valor = valor.encode('utf-8') if isinstance(valor, unicode) else valor
+            if len(valor) > cls.TAMANHO_TELA:
+                raise ValueError('{0} com mais de {1} bytes: {2!r}'.format(campo, cls.TAMANHO_TELA, valor))
+            return valor
+        # bool é subclasse de int, os dois aceitam um ao outro
+        if not isinstance(valor, (bool, int, long)):
+            raise TypeError('{0} deve ser {1}, veio {2!r}'.format(campo, tipo.__name__, valor))
+        return tipo(valor)
+
+    def atualizar(self, **campos):
+        '''
+        Muda campos do estado e acorda quem espera, se algum valor mudou
+        :param campos: campo=valor, com os nomes de TIPOS
+        :returns: True se algum campo mudou
+        '''
+        valores = dict((campo, self.validar(campo, valor)) for campo, valor in campos.iteritems())
+        with self.trava:
+            mudou = False
+            for campo, valor in valores.iteritems():
+                if self.ler(campo) == valor:
+                    continue
+                if campo == 'tela':
+                    # ímpar enquanto a tela está sendo escrita
+                    self.campos.sequencia_tela += 1
+                    self.campos.tela = valor
+                    self.campos.sequencia_tela += 1
+                else:
+                    setattr(self.campos, campo, valor)
+                mudou = True
+        if mudou:
+            self._acordar()
+        return mudou
+
+    def _acordar(self):
+        '''
+        Avisa quem espera sem nunca bloquear: com o pipe cheio já há um aviso pendente
+        '''
+        try:
+            os.write(self.escrita, 'x')
+        except OSError as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    def atualizar_json(self, texto):
+        '''
+        Aplica uma mensagem do jogo, como {"tela": "menu", "jogador_vivo": true}
+        :param texto: mensagem em JSON; chaves que não são do jogo são ignoradas
+        :returns: True se algum campo mudou
+        '''
+        dados = json.loads(str(texto))
+        if not isinstance(dados, dict):
+            raise ValueError('Mensagem do jogo não é um objeto: ' + str(texto))
+        return self.atualizar(**dict((campo, dados[campo]) for campo in self.CAMPOS_JOGO if campo in dados))
+
+    def ler(self, campo=None):
+        '''
+        Lê o estado sem tocar em disco e sem trava
+        :param campo: nome do campo, ou None para todos
+        :returns: o valor do campo ou um dicionário com todos os campos
+        '''
+        if campo is None:
+            return dict((nome, self.ler(nome)) for nome in self.TIPOS)
+        if campo != 'tela':
+            return getattr(self.campos, campo)
+        for _ in xrange(self.TENTATIVAS_LEITURA):
+            sequencia = self.campos.sequencia_tela
+            if sequencia % 2 == 0:
+                tela = self.campos.tela
+                if self.campos.sequencia_tela == sequencia:
+                    return tela
+        return self.campos.tela
+
+    def esperar(self, condicao, timeout=None):
+        '''
+        Espera o estado satisfazer uma condição, reavaliada a cada mudança; um só
+        processo deve esperar por estado, os avisos lidos por um não chegam ao outro
+        :param condicao: função que recebe o dicionário de ler() e devolve True quando basta
+        :param timeout: espera máxima em segundos, ou None para esperar o quanto for preciso
+        :returns: True se a condição foi satisfeita, False se o tempo acabou
+        '''
+        limite = None if timeout is None else time.time() + timeout
+        while True:
+            # os avisos são descartados antes de olhar o estado, uma mudança depois disso acorda o select
+            self._descartar_avisos()
+            if condicao(self.ler()):
+                return True
+            espera = self.INTERVALO_ESPERA
+            if limite is not None:
+                espera = min(espera, limite - time.time())
+                if espera <= 0:
+                    return False
+            try:
+                select.select([self.leitura], [], [], espera)
+            except select.error as e:
+                if e.args[0] != errno.EINTR:
+                    raise
+
+    def _descartar_avisos(self):
+        '''
+        Esvazia o pipe de avisos
+        '''
+        while True:
+            try:
+                if not os.read(self.leitura, 4096):
+                    return
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+
+
+class PersistenciaEstado(threading.Thread):
+
+    '''
+    Grava o estado do jogo em arquivos JSON numa thread própria, fora do laço
+    da detecção. Cada arquivo é escrito num temporário e renomeado, então quem
+    lê nunca vê um arquivo pela metade. Também acompanha arquivos escritos por
+    outro programa, como o servidor em node, e aplica os campos do jogo deles
+    no estado.
+    '''
+    # Constantes
+    # de quanto em quanto tempo o estado e os arquivos externos são conferidos, em segundos
+    INTERVALO = 0.02
+
+    def __init__(self, estado, arquivos, externos=()):
+        '''
+        Construtor da Classe
+        :param estado: EstadoJogo persistido
+        :param arquivos: caminho -> campos gravados nele
+        :param externos: arquivos escritos por outro programa, lidos para o estado
+        '''
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.estado = estado
+        self.arquivos = dict(arquivos)
+        self.externos = list(externos)
+        self.executando = False
+        # caminho -> último conteúdo gravado, arquivos que não mudaram não são reescritos
+        self.gravados = {}
+        # caminho -> momento de modificação do último conteúdo externo aplicado
+        self.modificacoes = {}
+
+    def start(self):
+        '''
+        Aplica os arquivos externos já existentes e começa a acompanhar o estado
+        '''
+        self.executando = True
+        self.ler_externos()
+        threading.Thread.start(self)
+
+    def run(self):
+        # confere o estado em vez de esperar por ele: os avisos do estado são de quem detecta
+        while self.executando:
+            self.ler_externos()
+            self.gravar()
+            time.sleep(self.INTERVALO)
+        self.gravar()
+
+    def gravar(self):
+        '''
+        Grava os arquivos cujos campos mudaram desde a última gravação
+        '''
+        estado = self.estado.ler()
+        for caminho, campos in self.arquivos.iteritems():
+            conteudo = json.dumps(dict((campo, estado[campo]) for campo in campos))
+            if self.gravados.get(caminho) == conteudo:
+                continue
+            temporario = caminho + '.tmp'
+            try:
+                with open(temporario, 'w') as arq:
+                    arq.write(conteudo)
+                os.rename(temporario, caminho)
+                self.gravados[caminho] = conteudo
+            except (IOError, OSError) as e:
+                print 'Não foi possível gravar o estado em', caminho, e
+
+    def ler_externos(self):
+        '''
+        Aplica no estado os arquivos externos que mudaram
+        '''
+        for caminho in self.externos:
+            try:
+                modificacao = os.stat(caminho).st_mtime
+                if self.modificacoes.get(caminho) == modificacao:
+                    continue
+                with open(caminho) as arq:
+                    self.estado.atualizar_json(arq.read())
+                self.modificacoes[caminho] = modificacao
+            except (IOError, OSError):
+                # o outro programa ainda não criou o arquivo
+                continue
+            except (ValueError, TypeError):
+                # o outro programa está no meio da escrita, fica para a próxima volta
+                continue
+
+    def parar(self):
+        '''
+        Grava o que faltar e para a thread
+        '''
+        self.executando = False
+        if self.is_alive():
+            self.join()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# coding:utf-8
+
+import math
+import numpy as np
+
+
+def quantil_normal(probabilidade):
+    '''
+    Quantil da normal padrão, para traduzir a confiança pedida em desvios padrão
+    :param probabilidade: probabilidade entre 0.5 e 1 (exclusive)
+    :returns: z tal que P(Z < z) = probabilidade
+    '''
+    if not 0.5 <= probabilidade < 1:
+        raise ValueError('A confiança deve estar entre 0.5 e 1: ' + str(probabilidade))
+    baixo, alto = 0.0, 10.0
+    for _ in xrange(60):
+        meio = (baixo + alto) / 2
+        if 0.5 * (1 + math.erf(meio / math.sqrt(2))) < probabilidade:
+            baixo = meio
+        else:
+            alto = meio
+    return (baixo + alto) / 2
+
+
+class EstimadorKalman(object):
+
+    '''
+    Filtro de Kalman de aceleração constante sobre o y do marcador: estima
+    posição, velocidade e aceleração a cada frame e prevê onde o marcador
+    estará daqui a pouco, com a variância da previsão. O intervalo entre os
+    frames vem do momento da captura; sem ele, usa o intervalo padrão.
+    '''
+    # Constantes
+    # variância do y medido, em px²
+    RUIDO_MEDIDA = 9.0
+    # densidade espectral do solavanco (derivada da aceleração), em px²/s⁵;
+    # alta porque o início de um pulo muda a aceleração em poucos frames
+    RUIDO_PROCESSO = 2e8
+    # incerteza inicial da velocidade (px/s)² e da aceleração (px/s²)²
+    VARIANCIA_INICIAL = (1e4, 1e7)
+
+    def __init__(self, intervalo_padrao=1 / 30.0, ruido_medida=RUIDO_MEDIDA, ruido_processo=RUIDO_PROCESSO):
+        '''
+        Construtor da Classe
+        :param intervalo_padrao: segundos entre dois frames quando o momento da captura não é informado
+        :param ruido_medida: variância do y medido, em px²
+        :param ruido_processo: densidade espectral do solavanco, em px²/s⁵
+        '''
+        self.intervalo_padrao = intervalo_padrao
+        self.ruido_medida = ruido_medida
+        self.ruido_processo = ruido_processo
+        self.H = np.array([[1.0, 0.0, 0.0]])
+        self.reiniciar()
+
+    def reiniciar(self):
+        '''
+        Esquece o estado, a próxima medida recomeça o filtro
+        '''
+        # [y, velocidade, aceleração]
+        self.x = None
+        self.P = None
+        self.momento = None
+
+    def _transicao(self, dt):
+        '''
+        Matriz de transição e ruído de processo para um passo de dt segundos
+        '''
+        F = np.array([[1.0, dt, dt * dt / 2],
+                      [0.0, 1.0, dt],
+                      [0.0, 0.0, 1.0]])
+        q = self.ruido_processo
+        Q = q * np.array([[dt ** 5 / 20, dt ** 4 / 8, dt ** 3 / 6],
+                          [dt ** 4 / 8, dt ** 3 / 3, dt ** 2 / 2],
+                          [dt ** 3 / 6, dt ** 2 / 2, dt]])
+        return F, Q
+
+    def atualizar(self, y, momento=None):
+        '''
+        Incorpora o y de um frame
+        :param y: y medido do marcador
+        :param momento: momento da captura do frame, em segundos
+        '''
+        if self.x is None:
+            self.x = np.array([float(y), 0.0, 0.0])
+            self.P = np.diag([self.ruido_medida] + list(self.VARIANCIA_INICIAL))
+            self.momento = momento
+            return
+        if momento is None or self.momento is None:
+            dt = self.intervalo_padrao
+        else:
+            # dois frames com o mesmo momento não fazem o filtro dividir por zero
+            dt = max(momento - self.momento, 1e-3)
+        self.momento = momento
+
+        F, Q = self._transicao(dt)
+        x = F.dot(self.x)
+        P = F.dot(self.P).dot(F.T) + Q
+
+        residuo = y - x[0]
+        S = P[0, 0] + self.ruido_medida
+        K = P[:, 0] / S
+        self.x = x + K * residuo
+        self.P = P - np.outer(K, P[0, :])
+
+    def prever(self, horizonte):
+        '''
+        Posição prevista do marcador
+        :param horizonte: segundos à frente do último frame
+        :returns: (y previsto, desvio padrão da previsão)
+        '''
+        c = np.array([1.0, horizonte, horizonte * horizonte / 2])
+        return c.dot(self.x), math.sqrt(max(c.dot(self.P).dot(c), 0.0))
+
+    @property
+    def inicializado(self):
+        return self.x is not None
+
+    @property
+    def y(self):
+        return self.x[0]
+
+    @property
+    def velocidade(self):
+        '''
+        :returns: (velocidade em px/s, positiva para baixo, e o desvio padrão dela)
+        '''
+        return self.x[1], math.sqrt(max(self.P[1, 1], 0.0))
@@ -0,0 +1,307 @@
+#!/usr/bin/env python
+# coding:utf-8
+
+import os
+import time
+import cv2
+import numpy as np
+
+
+class FonteFrames(object):
+
+    '''
+    Fonte de frames com a mesma interface de cv2.VideoCapture (read, isOpened,
+    get, release), para que o detector e a captura rodem sem camera. Em tempo
+    real os frames saem no ritmo do fps da fonte; senão saem o mais rápido
+    possível e a captura não descarta nenhum, o que deixa a execução
+    determinística.
+    '''
+
+    def __init__(self, largura, altura, fps, tempo_real=True):
+        '''
+        Construtor da Classe
+        :param largura: largura dos frames
+        :param altura: altura dos frames
+        :param fps: frames por segundo da fonte
+        :param tempo_real: entrega os frames no ritmo do fps
+        '''
+        self.largura = largura
+        self.altura = altura
+        self.fps = fps
+        self.tempo_real = tempo_real
+        self.aberta = True
+        self.indice = 0
+        self.proximo = None
+
+    def _ler(self, frame):
+        '''
+        Produz o próximo frame, implementado por cada fonte
+        :param frame: array para reaproveitar ou None
+        :returns: o frame ou None quando a fonte acabou
+        '''
+        raise NotImplementedError
+
+    def isOpened(self):
+        return self.aberta
+
+    def read(self, frame=None):
+        '''
+        Lê o próximo frame, esperando o momento dele em tempo real
+        :param frame: array para reaproveitar, como em cv2.VideoCapture.read
+        :returns: (True, frame) ou (False, None) quando a fonte acabou
+        '''
+        if not self.aberta:
+            return False, None
+        frame = self._ler(frame)
+        if frame is None:
+            self.aberta = False
+            return False, None
+
+        if self.tempo_real:
+            agora = time.time()
+            if self.proximo is None or self.proximo < agora:
+                # atrasou (ou é o primeiro frame): não tenta recuperar o tempo perdido
+                self.proximo = agora
+            else:
+                time.sleep(self.proximo - agora)
+            self.proximo += 1.0 / self.fps
+        self.indice += 1
+        return True, frame
+
+    def get(self, propriedade):
+        if propriedade == cv2.CAP_PROP_FRAME_WIDTH:
+            return float(self.largura)
+        if propriedade == cv2.CAP_PROP_FRAME_HEIGHT:
+            return float(self.altura)
+        if propriedade == cv2.CAP_PROP_FPS:
+            return float(self.fps)
+        if propriedade == cv2.CAP_PROP_POS_FRAMES:
+            return float(self.indice)
+        return 0.0
+
+    def release(self):
+        self.aberta = False
+
+
+class FonteVideo(FonteFrames):
+
+    '''
+    Frames de um arquivo de vídeo gravado
+    '''
+
+    def __init__(self, caminho, tempo_real=True):
+        '''
+        Construtor da Classe
+        :param caminho: arquivo de vídeo
+        :param tempo_real: entrega os frames no fps do vídeo
+        '''
+        self.video = cv2.VideoCapture(caminho)
+        if not self.video.isOpened():
+            raise IOError('Não foi possível abrir o vídeo ' + caminho)
+        FonteFrames.__init__(self,
+                             int(self.video.get(cv2.CAP_PROP_FRAME_WIDTH)),
+                             int(self.video.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+                             self.video.get(cv2.CAP_PROP_FPS) or 30.0, tempo_real)
+
+    def _ler(self, frame):
+        ok, frame = self.video.read(frame)
+        return frame if ok else None
+
+    def release(self):
+        FonteFrames.release(self)
+        self.video.release()
+
+
+class FonteArquivos(FonteFrames):
+
+    '''
+    Frames de um diretório de imagens, em ordem de nome, ou de um .npz com
+    um array (N, altura, largura, 3) ou um array por frame
+    '''
+
+    EXTENSOES_IMAGEM = ('.png', '.jpg', '.jpeg', '.bmp', '.ppm')
+
+    def __init__(self, caminho, fps=30.0, tempo_real=True):
+        '''
+        Construtor da Classe
+        :param caminho: diretório de imagens ou arquivo .npz
+        :param fps: ritmo dos frames em tempo real
+        :param tempo_real: entrega os frames no ritmo do fps
+        '''
+        if os.path.isdir(caminho):
+            self.arquivos = sorted(
+                os.path.join(caminho, nome) for nome in os.listdir(caminho)
+                if os.path.splitext(nome)[1].lower() in self.EXTENSOES_IMAGEM)
+            self.frames = None
+            if not self.arquivos:
+                raise IOError('Nenhuma imagem em ' + caminho)
+            primeiro = cv2.imread(self.arquivos[0])
+        else:
+            dados = np.load(caminho)
+            if len(dados.files) == 1 and dados[dados.files[0]].ndim == 4:
+                self.frames = dados[dados.files[0]]
+            else:
+                self.frames = [dados[nome] for nome in sorted(dados.files)]
+            self.arquivos = None
+            if not len(self.frames):
+                raise IOError('Nenhum frame em ' + caminho)
+            primeiro = self.frames[0]
+        altura, largura = primeiro.shape[:2]
+        FonteFrames.__init__(self, largura, altura, fps, tempo_real)
+
+    def _ler(self, frame):
+        if self.frames is not None:
+            if self.indice >= len(self.frames):
+                return None
+            # cópia, porque quem lê desenha sobre o frame
+            if frame is None or frame.shape != self.frames[self.indice].shape:
+                return self.frames[self.indice].copy()
+            np.copyto(frame, self.frames[self.indice])
+            return frame
+        if self.indice >= len(self.arquivos):
+            return None
+        return cv2.imread(self.arquivos[self.indice])
+
+
+class FonteSintetica(FonteFrames):
+
+    '''
+    Gera um fundo com ruído e um retângulo azul que segue um roteiro de
+    movimentos. Começa dentro do quadrado de calibração, então o detector
+    calibra sozinho. O roteiro é uma lista separada por vírgula de passos
+    'parado', 'pulo' e 'agachar', cada um com a duração opcional em segundos,
+    como em 'parado:2,pulo,parado:1,agachar:1.5'.
+    '''
+    # Constantes
+    # bgr dentro da faixa de cor do Segmentador (h 115, s 188, v 150)
+    COR_MARCADOR = (150, 60, 40)
+    COR_FUNDO = (40, 120, 60)
+    LARGURA_MARCADOR = 80
+    ALTURA_MARCADOR = 80
+    # deslocamentos do marcador em px: o pulo sobe, o agachamento passa da altura de agachamento
+    ALTURA_PULO = 150
+    PROFUNDIDADE_AGACHAMENTO = 160
+    DURACOES = {'parado': 1.0, 'pulo': 0.6, 'agachar': 1.0}
+    ROTEIRO_PADRAO = 'parado:2,pulo,parado:1,agachar,parado:1'
+    # quadros de ruído pré-gerados e usados em rodízio, gerar a cada frame custaria mais que detectar
+    NUM_RUIDOS = 8
+
+    def __init__(self, roteiro=ROTEIRO_PADRAO, largura=640, altura=480, fps=30.0,
+                 tempo_real=True, repetir=False, semente=0):
+        '''
+        Construtor da Classe
+        :param roteiro: passos do marcador
+        :param largura: largura dos frames
+        :param altura: altura dos frames
+        :param fps: frames por segundo
+        :param tempo_real: entrega os frames no ritmo do fps
+        :param repetir: recomeça o roteiro ao terminar em vez de fechar a fonte
+        :param semente: semente do ruído, a mesma semente gera os mesmos frames
+        '''
+        FonteFrames.__init__(self, largura, altura, fps, tempo_real)
+        self.repetir = repetir
+        self.x = (largura - self.LARGURA_MARCADOR) / 2
+        self.y_repouso = (altura - self.ALTURA_MARCADOR) / 2
+        self.ys, self.passos = self._montar_roteiro(roteiro)
+
+        self.fundo = np.empty((altura, largura, 3), np.uint8)
+        self.fundo[:] = self.COR_FUNDO
+        aleatorio = np.random.RandomState(semente)
+        self.ruidos = [aleatorio.randint(0, 16, self.fundo.shape).astype(np.uint8)
+                       for _ in xrange(self.NUM_RUIDOS)]
+
+    def _montar_roteiro(self, roteiro):
+        '''
+        Calcula o y do marcador em cada frame do roteiro
+        :param roteiro: passos do marcador
+        :returns: (lista de y por frame, lista de (frame inicial, passo))
+        '''
+        ys = []
+        passos = []
+        for passo in roteiro.split(','):
+            nome, _, duracao = passo.strip().partition(':')
+            if nome not in self.DURACOES:
+                raise ValueError('Passo desconhecido no roteiro: ' + nome)
+            quantidade = max(1, int(round(float(duracao or self.DURACOES[nome]) * self.fps)))
+            passos.append((len(ys), nome))
+            for i in xrange(quantidade):
+                fase = (i + 0.5) / quantidade
+                if nome == 'pulo':
+                    # parábola: sobe e volta ao repouso
+                    deslocamento = -self.ALTURA_PULO * 4 * fase * (1 - fase)
+                elif nome == 'agachar':
+                    # desce rápido, fica agachado e levanta rápido
+                    deslocamento = self.PROFUNDIDADE_AGACHAMENTO * min(1.0, 5 * fase, 5 * (1 - fase))
+                else:
+                    deslocamento = 0
+                ys.append(int(round(self.y_repouso + deslocamento)))
+        return ys, passos
+
+    def _ler(self, frame):
+        posicao = self.indice
+        if posicao >= len(self.ys):
+            if not self.repetir:
+                return None
+            posicao %= len(self.ys)
+        if frame is None or frame.shape != self.fundo.shape:
+            frame = np.empty_like(self.fundo)
+        # ruído leve, para a segmentação não trabalhar com cores perfeitas
+        cv2.add(self.fundo, self.ruidos[posicao % self.NUM_RUIDOS], dst=frame)
+        y = self.ys[posicao]
+        cv2.rectangle(frame, (self.x, y),
+                      (self.x + self.LARGURA_MARCADOR - 1, y + self.ALTURA_MARCADOR - 1),
+                      self.COR_MARCADOR, -1)
+        return frame
+
+
+class FonteRedimensionada(FonteFrames):
+
+    '''
+    Entrega os frames de outra fonte redimensionados, para medir o detector em várias resoluções
+    '''
+
+    def __init__(self, fonte, largura, altura):
+        '''
+        Construtor da Classe
+        :param fonte: fonte original, o ritmo continua sendo o dela
+        :param largura: largura dos frames entregues
+        :param altura: altura dos frames entregues
+        '''
+        FonteFrames.__init__(self, largura, altura, fonte.get(cv2.CAP_PROP_FPS) or 30.0, False)
+        self.fonte = fonte
+        self.tempo_real = getattr(fonte, 'tempo_real', True)
+        self.original = None
+
+    def read(self, frame=None):
+        ok, self.original = self.fonte.read(self.original)
+        if not ok:
+            self.aberta = False
+            return False, None
+        self.indice += 1
+        return True, cv2.resize(self.original, (self.largura, self.altura), dst=frame)
+
+    def isOpened(self):
+        return self.aberta and self.fonte.isOpened()
+
+    def release(self):
+        FonteFrames.release(self)
+        self.fonte.release()
+
+
+def abrir_fonte(descricao, tempo_real=True):
+    '''
+    Abre a fonte de frames descrita na linha de comando
+    :param descricao: id da camera, 'sintetico' ou 'sintetico:<roteiro>', diretório, .npz ou vídeo
+    :param tempo_real: para as fontes gravadas, entrega os frames no ritmo do fps
+    :returns: objeto com a interface de cv2.VideoCapture
+    '''
+    descricao = str(descricao)
+    if descricao.isdigit():
+        return cv2.VideoCapture(int(descricao))
+    if descricao == 'sintetico':
+        return FonteSintetica(tempo_real=tempo_real)
+    if descricao.startswith('sintetico:'):
+        return FonteSintetica(descricao[len('sintetico:'):], tempo_real=tempo_real)
+    if os.path.isdir(descricao) or descricao.endswith('.npz'):
+        return FonteArquivos(descricao, tempo_real=tempo_real)
+    return FonteVideo(descricao, tempo_real)
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# coding:utf-8
+
+import collections
+
+
+class HistoricoY(object):
+
+    '''
+    Últimos y do marcador, com o momento da captura de cada um, num buffer
+    circular de capacidade fixa. O mínimo e o máximo dos últimos `janela` y
+    são mantidos por duas filas monotônicas, então adicionar e consultar
+    custam O(1) amortizado qualquer que seja o tamanho da janela.
+    '''
+
+    def __init__(self, capacidade, janela=None):
+        '''
+        Construtor da Classe
+        :param capacidade: quantos y ficam guardados
+        :param janela: quantos dos últimos y entram no mínimo e no máximo; o padrão é a capacidade
+        '''
+        janela = capacidade if janela is None else janela
+        if janela > capacidade:
+            raise ValueError('A janela do histórico não pode ser maior que a capacidade')
+        self.capacidade = capacidade
+        self.janela = janela
+        # (y, momento) dos mais antigos aos mais novos
+        self.amostras = collections.deque(maxlen=capacidade)
+        # (índice, y) com y crescente e decrescente, a frente é o mínimo e o máximo da janela
+        self.minimos = collections.deque()
+        self.maximos = collections.deque()
+        self.indice = 0
+
+    def __len__(self):
+        return len(self.amostras)
+
+    def limpar(self):
+        '''
+        Esquece todos os y
+        '''
+        self.amostras.clear()
+        self.minimos.clear()
+        self.maximos.clear()
+
+    def adicionar(self, y, momento=None):
+        '''
+        Guarda um y, descartando o mais antigo se o histórico estiver cheio
+        :param y: y do marcador
+        :param momento: momento da captura do frame
+        '''
+        self.amostras.append((y, momento))
+        indice = self.indice
+        self.indice += 1
+        while self.minimos and self.minimos[-1][1] >= y:
+            self.minimos.pop()
+        self.minimos.append((indice, y))
+        while self.maximos and self.maximos[-1][1] <= y:
+            self.maximos.pop()
+        self.maximos.append((indice, y))
+        # o que saiu da janela só pode estar na frente das filas
+        inicio_janela = self.indice - self.janela
+        if self.minimos[0][0] < inicio_janela:
+            self.minimos.popleft()
+        if self.maximos[0][0] < inicio_janela:
+            self.maximos.popleft()
+
+    def janela_cheia(self):
+        '''
+        :returns: True se já há y suficientes para preencher a janela
+        '''
+        return len(self.amostras) >= self.janela
+
+    def minimo(self):
+        '''
+        :returns: menor y da janela
+        '''
+        return self.minimos[0][1]
+
+    def maximo(self):
+        '''
+        :returns: maior y da janela
+        '''
+        return self.maximos[0][1]
+
+    def primeiro(self):
+        '''
+        :returns: y mais antigo guardado
+        '''
+        return self.amostras[0][0]
+
+    def ultimo(self):
+        '''
+        :returns: y mais novo
+        '''
+        return self.amostras[-1][0]
+
+    def duracao(self):
+        '''
+        Tempo coberto pelo histórico, do y mais antigo ao mais novo
+        :returns: segundos, ou None se os momentos não foram informados
+        '''
+        if not self.amostras or self.amostras[0][1] is None or self.amostras[-1][1] is None:
+            return None
+        return self.amostras[-1][1] - self.amostras[0][1]
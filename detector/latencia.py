@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# coding:utf-8
+
+import json
+import threading
+import collections
+import numpy as np
+from relogio import monotonico
+
+
+class MedidorLatencia(object):
+
+    '''
+    Mede a latência de ponta a ponta do estado do jogador. Cada estado leva o
+    número de sequência e o momento da captura do frame que o gerou; o jogo
+    devolve a sequência ({"eco": n}) assim que recebe. Com isso o servidor
+    mede, em ms:
+    - deteccao_envio: da captura do frame até o estado ser entregue ao WebSocket
+    - ida_volta: do envio até o eco chegar
+    - captura_eco: da captura até o eco chegar, o movimento até o jogo mais a volta
+    O envio é registrado na thread da detecção e o eco na do servidor.
+    '''
+    # Constantes
+    CHAVE_ECO = 'eco'
+    METRICAS = ('deteccao_envio', 'ida_volta', 'captura_eco')
+    # amostras guardadas por métrica, as mais antigas saem
+    NUM_AMOSTRAS = 1000
+    # envios esperando eco; com vários clientes na faixa a mesma sequência volta várias vezes
+    NUM_ENVIOS = 256
+    # de quanto em quanto tempo o resumo é impresso, em segundos
+    INTERVALO_RELATORIO = 10.0
+
+    def __init__(self, nome='detector'):
+        '''
+        Construtor da Classe
+        :param nome: nome mostrado no relatório, como a faixa
+        '''
+        self.nome = nome
+        self.trava = threading.Lock()
+        self.amostras = dict((metrica, collections.deque(maxlen=self.NUM_AMOSTRAS))
+                             for metrica in self.METRICAS)
+        # sequência -> (momento da captura, momento do envio)
+        self.envios = collections.OrderedDict()
+
+    def registrar_envio(self, sequencia, momento_captura):
+        '''
+        Registra um estado entregue ao WebSocket
+        :param sequencia: número de sequência do estado
+        :param momento_captura: momento monotônico da captura do frame, ou None
+        '''
+        agora = monotonico()
+        with self.trava:
+            if momento_captura is not None:
+                self.amostras['deteccao_envio'].append((agora - momento_captura) * 1000)
+            self.envios[sequencia] = (momento_captura, agora)
+            while len(self.envios) > self.NUM_ENVIOS:
+                self.envios.popitem(last=False)
+
+    def registrar_eco(self, sequencia):
+        '''
+        Registra o eco de um estado vindo do jogo
+        :param sequencia: número de sequência devolvido
+        '''
+        agora = monotonico()
+        with self.trava:
+            envio = self.envios.get(sequencia)
+            if envio is None:
+                # eco atrasado demais ou de um estado de outra execução
+                return
+            momento_captura, momento_envio = envio
+            self.amostras['ida_volta'].append((agora - momento_envio) * 1000)
+            if momento_captura is not None:
+                self.amostras['captura_eco'].append((agora - momento_captura) * 1000)
+
+    @classmethod
+    def eco(cls, mensagem):
+        '''
+        Reconhece a mensagem de eco do jogo
+        :param mensagem: dados recebidos do jogo
+        :returns: a sequência devolvida ou None se a mensagem não for um eco
+        '''
+        try:
+            dados = json.loads(str(mensagem))
+        except ValueError:
+            return None
+        if not isinstance(dados, dict) or cls.CHAVE_ECO not in dados:
+            return None
+        try:
+            return int(dados[cls.CHAVE_ECO])
+        except (TypeError, ValueError):
+            return None
+
+    def resumo(self):
+        '''
+        Percentis de cada métrica
+        :returns: métrica -> p50, p95, p99 e máximo em ms e o número de amostras
+        '''
+        with self.trava:
+            amostras = dict((metrica, list(valores)) for metrica, valores in self.amostras.iteritems())
+        resumo = {}
+        for metrica, valores in amostras.iteritems():
+            if not valores:
+                continue
+            valores = np.array(valores)
+            p50, p95, p99 = np.percentile(valores, [50, 95, 99])
+            resumo[metrica] = {'p50': round(p50, 2), 'p95': round(p95, 2), 'p99': round(p99, 2),
+                               'max': round(valores.max(), 2), 'amostras': len(valores)}
+        return resumo
+
+    def relatar(self):
+        '''
+        Imprime o resumo das métricas que já têm amostras
+        '''
+        resumo = self.resumo()
+        for metrica in self.METRICAS:
+            if metrica in resumo:
+                valores = resumo[metrica]
+                print 'Latência {0} {1} (ms): p50 {2} p95 {3} p99 {4} max {5} ({6} amostras)'.format(
+                    self.nome, metrica, valores['p50'], valores['p95'], valores['p99'],
+                    valores['max'], valores['amostras'])
+
+    def agendar(self, server, intervalo=INTERVALO_RELATORIO):
+        '''
+        Imprime o resumo periodicamente no laço do servidor
+        :param server: servidor WebSocket
+        :param intervalo: segundos entre os relatórios
+        '''
+        def relatar():
+            self.relatar()
+            server.callLater(intervalo, relatar)
+        server.callLater(intervalo, relatar)
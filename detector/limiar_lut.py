@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# coding:utf-8
+
+import os
+import cv2
+import numpy as np
+
+
+class LimiarLUT(object):
+
+    '''
+    Classifica cada pixel bgr contra a faixa de cor hsv por uma tabela pré-calculada,
+    evitando converter o frame inteiro para hsv a cada frame. A tabela é indexada
+    pelo próprio pixel lido como inteiro de 32 bits, com cada canal reduzido a
+    'bits' bits.
+    '''
+
+    def __init__(self, min_cor, max_cor, bits=6, arquivo=None):
+        '''
+        Construtor da Classe
+        :param min_cor: limite inferior da faixa, em hsv
+        :param max_cor: limite superior da faixa, em hsv
+        :param bits: bits guardados de cada canal, 8 é exato e ocupa 16MB
+        :param arquivo: arquivo .npz onde a tabela é guardada entre execuções
+        '''
+        if not 1 <= bits <= 8:
+            raise ValueError('O número de bits por canal deve estar entre 1 e 8')
+        self.bits = bits
+        self.deslocamento = 8 - bits
+        canal = (1 << bits) - 1
+        self.mascara = canal | (canal << 8) | (canal << 16)
+        self.arquivo = arquivo
+
+        # buffers reaproveitados entre frames, crescem até o maior frame visto
+        self._pixels = np.empty(0, np.uint32)
+        self._indices = np.empty(0, np.uint32)
+        self._saida = np.empty(0, np.uint8)
+
+        self.tabela = None
+        self.recalibrar(min_cor, max_cor)
+
+    def recalibrar(self, min_cor, max_cor):
+        '''
+        Troca a faixa de cor, reaproveitando a tabela do arquivo quando ela é da mesma faixa
+        :param min_cor: limite inferior da faixa, em hsv
+        :param max_cor: limite superior da faixa, em hsv
+        '''
+        self.min_cor = np.array(min_cor, np.uint8)
+        self.max_cor = np.array(max_cor, np.uint8)
+        if self.arquivo is not None and self.carregar():
+            return
+        self.tabela = self.construir()
+        if self.arquivo is not None:
+            self.salvar()
+
+    def construir(self):
+        '''
+        Calcula a tabela convertendo para hsv o centro de cada célula da quantização
+        :returns: tabela com 255 para as cores dentro da faixa e 0 fora
+        '''
+        tabela = np.zeros(self.mascara + 1, np.uint8)
+        niveis = np.arange(1 << self.bits, dtype=np.uint32)
+        valores = ((niveis << self.deslocamento) + ((1 << self.deslocamento) >> 1)).astype(np.uint8)
+        g, r = np.meshgrid(niveis, niveis, indexing='ij')
+        indices_gr = ((g << 8) | (r << 16)).ravel()
+
+        bgr = np.empty((indices_gr.size, 1, 3), np.uint8)
+        bgr[:, 0, 1] = np.repeat(valores, niveis.size)
+        bgr[:, 0, 2] = np.tile(valores, niveis.size)
+        # um plano de azul por vez, para não montar todas as cores de uma vez na memória
+        for b in niveis:
+            bgr[:, 0, 0] = valores[b]
+            hsv = cv2.cvtColor(bgr, cv2.COLOR_BGR2HSV)
+            tabela[indices_gr | b] = cv2.inRange(hsv, self.min_cor, self.max_cor).ravel()
+        return tabela
+
+    def carregar(self):
+        '''
+        Carrega a tabela do arquivo se ela foi gerada com a mesma faixa e quantização
+        :returns: True se a tabela foi carregada
+        '''
+        if not os.path.exists(self.arquivo):
+            return False
+        try:
+            dados = np.load(self.arquivo)
+            if int(dados['bits']) != self.bits or \
+                    not np.array_equal(dados['min_cor'], self.min_cor) or \
+                    not np.array_equal(dados['max_cor'], self.max_cor):
+                return False
+            self.tabela = dados['tabela']
+        except (IOError, KeyError, ValueError) as e:
+            print 'Não foi possível carregar a tabela de cores: ', e
+            return False
+        return True
+
+    def salvar(self):
+        '''
+        Guarda a tabela no arquivo
+        '''
+        with open(self.arquivo, 'wb') as arq:
+            np.savez(arq, tabela=self.tabela, bits=self.bits,
+                     min_cor=self.min_cor, max_cor=self.max_cor)
+
+    def aplicar(self, imagem):
+        '''
+        Gera a faixa de cor de uma imagem bgr
+        :param imagem: imagem no formato de cor bgr
+        :returns: a faixa de cor, num buffer reaproveitado na próxima chamada
+        '''
+        altura, largura = imagem.shape[:2]
+        total = altura * largura
+        if self._pixels.size < total:
+            self._pixels = np.empty(total, np.uint32)
+            self._indices = np.empty(total, np.uint32)
+            self._saida = np.empty(total, np.uint8)
+
+        pixels = self._pixels[:total].reshape(altura, largura)
+        indices = self._indices[:total].reshape(altura, largura)
+        saida = self._saida[:total].reshape(altura, largura)
+
+        # bgr -> bgra dentro do buffer de inteiros: cada pixel vira b | g << 8 | r << 16 | a << 24
+        cv2.cvtColor(imagem, cv2.COLOR_BGR2BGRA, dst=pixels.view(np.uint8).reshape(altura, largura, 4))
+        if not np.little_endian:
+            pixels.byteswap(True)
+        if self.deslocamento:
+            np.right_shift(pixels, self.deslocamento, out=indices)
+            np.bitwise_and(indices, self.mascara, out=indices)
+        else:
+            np.bitwise_and(pixels, self.mascara, out=indices)
+        np.take(self.tabela, indices, out=saida, mode='clip')
+        return saida
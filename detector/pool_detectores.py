@@ -0,0 +1,440 @@
+#!/usr/bin/env python
+# coding:utf-8
+
+import os
+import time
+import json
+import signal
+import logging
+import threading
+import urlparse
+import multiprocessing
+from optparse import OptionParser
+import cv2
+from SimpleWebSocketServer import WebSocket, SimpleWebSocketServer
+from detector_movimento import DetectorMovimento, GerenciadorEstadoJogador
+from quadro_compartilhado import QuadroCompartilhado
+from fonte_frames import abrir_fonte
+from latencia import MedidorLatencia
+from estado_jogo import EstadoJogo, PersistenciaEstado
+
+
+class ConexaoFaixa(object):
+
+    '''
+    Faz o papel do WebSocket do jogo dentro do processo de uma faixa: o estado
+    do jogador vai pelo pipe até o servidor, que repassa aos clientes da faixa
+    '''
+    # a faixa sempre manda o estado compacto, o servidor converte para JSON quem pedir
+    subprotocol = GerenciadorEstadoJogador.SUBPROTOCOLO_BINARIO
+
+    def __init__(self, faixa, pipe, camera):
+        '''
+        Construtor da Classe
+        :param faixa: número da faixa
+        :param pipe: ponta do pipe da faixa
+        :param camera: camera já aberta da faixa
+        '''
+        self.address = ('faixa', faixa)
+        self.pipe = pipe
+        self.camera = camera
+        self.trava = threading.Lock()
+
+    def sendMessage(self, mensagem, chave=None):
+        '''
+        Manda o estado ao servidor
+        :param mensagem: estado codificado
+        :param chave: ignorada, o servidor já coalesce os estados na fila de cada cliente
+        '''
+        with self.trava:
+            self.pipe.send_bytes(str(mensagem))
+
+
+def executar_faixa(faixa, id_camera, pipe, opcoes, estado, quadro=None, herdados=(), pid_servidor=None):
+    '''
+    Corpo do processo de uma faixa: abre a camera e roda o detector dela
+    :param faixa: número da faixa
+    :param id_camera: camera da faixa
+    :param pipe: ponta do pipe da faixa
+    :param opcoes: argumentos repassados ao DetectorMovimento
+    :param estado: EstadoJogo da faixa, que o servidor atualiza com as mensagens do jogo
+    :param quadro: QuadroCompartilhado em que a faixa publica a detecção para o servidor mostrar
+    :param herdados: objetos do servidor que o fork copiou para a faixa e que ela precisa fechar
+    :param pid_servidor: processo do servidor, a faixa termina quando ele deixa de ser o pai dela
+    '''
+    # se a faixa ficasse com a ponta do pipe do servidor, o socket que escuta a porta e o epoll,
+    # a morte do servidor não chegaria como EOF e a faixa seguiria segurando a porta
+    for herdado in herdados:
+        try:
+            herdado.close()
+        except (IOError, OSError, EnvironmentError):
+            pass
+
+    camera = abrir_fonte(id_camera)
+    detector = DetectorMovimento(id_camera, conexao=ConexaoFaixa(faixa, pipe, camera),
+                                 estado_jogo=estado, quadro_compartilhado=quadro, **opcoes)
+
+    vigia = threading.Thread(target=vigiar_servidor, args=(pipe, pid_servidor))
+    vigia.daemon = True
+    vigia.start()
+
+    try:
+        detector.iniciar()
+    finally:
+        detector.finalizar()
+
+
+def vigiar_servidor(pipe, pid_servidor=None, intervalo=1.0):
+    '''
+    Termina a faixa quando o servidor morre; o estado do jogo chega pelo EstadoJogo, não pelo pipe
+    :param pipe: ponta do pipe da faixa
+    :param pid_servidor: processo do servidor, ou None para só esperar o EOF do pipe
+    :param intervalo: de quanto em quanto tempo confere se o servidor ainda é o pai da faixa, em segundos
+    '''
+    while True:
+        try:
+            if pipe.poll(intervalo):
+                pipe.recv()
+        except EOFError:
+            # o servidor morreu, não há mais para quem detectar
+            os._exit(0)
+        # o EOF não chega se outro processo ainda tiver a ponta do servidor, mas a faixa órfã é adotada
+        if pid_servidor is not None and os.getppid() != pid_servidor:
+            os._exit(0)
+
+
+class PoolDetectores(object):
+
+    '''
+    Roda um DetectorMovimento por camera, cada um no seu processo (faixa), e
+    distribui o estado de cada faixa aos clientes conectados a ela
+    '''
+    # Constantes
+    # de quanto em quanto tempo as faixas mortas são reiniciadas, em segundos
+    INTERVALO_VERIFICACAO = 2.0
+    # quanto uma faixa tem para terminar antes de ser morta, em segundos
+    ESPERA_TERMINO = 2.0
+
+    def __init__(self, cameras, fps_previa_servidor=0, persistir=False, **opcoes):
+        '''
+        Construtor da Classe
+        :param cameras: id da camera de cada faixa, na ordem das faixas
+        :param fps_previa_servidor: mostra a detecção das faixas no processo do servidor com essa taxa; 0 desliga
+        :param persistir: grava o estado do jogo de cada faixa nos arquivos dela
+        :param opcoes: argumentos repassados ao DetectorMovimento de cada faixa
+        '''
+        self.cameras = list(cameras)
+        self.fps_previa_servidor = fps_previa_servidor
+        self.persistir = persistir
+        if fps_previa_servidor:
+            # quem mostra é o servidor, a visão nem abre janela
+            opcoes['sem_interface'] = True
+        self.opcoes = opcoes
+        self.server = None
+        self.previa = None
+        # faixa -> (processo, pipe)
+        self.faixas = {}
+        # faixa -> QuadroCompartilhado
+        self.quadros = {}
+        # faixa -> MedidorLatencia, mantido quando a faixa é reiniciada
+        self.latencia = {}
+        # faixa -> EstadoJogo, também mantido: a faixa reiniciada continua de onde o jogo está
+        self.estados = {}
+        self.persistencias = []
+
+    @staticmethod
+    def grupo(faixa):
+        '''
+        Nome do grupo do servidor com os clientes de uma faixa
+        :param faixa: número da faixa
+        :returns: o nome do grupo
+        '''
+        return 'faixa-{0}'.format(faixa)
+
+    def faixa_do_caminho(self, caminho):
+        '''
+        Escolhe a faixa pela query da conexão, como em ws://host:1338/?faixa=1
+        :param caminho: caminho pedido no handshake
+        :returns: número da faixa, a 0 se a query não disser
+        '''
+        query = urlparse.parse_qs(urlparse.urlparse(caminho or '').query)
+        try:
+            faixa = int(query.get('faixa', ['0'])[0])
+        except ValueError:
+            raise ValueError('faixa inválida: ' + str(caminho))
+        if faixa not in self.faixas:
+            raise ValueError('faixa inexistente: ' + str(faixa))
+        return faixa
+
+    def iniciar(self, server):
+        '''
+        Inicia o processo de cada faixa e liga os pipes ao servidor
+        :param server: servidor WebSocket dos clientes
+        '''
+        self.server = server
+        server.pool = self
+        for faixa in xrange(len(self.cameras)):
+            self.iniciar_faixa(faixa)
+            self.latencia[faixa].agendar(server)
+            if self.persistir:
+                self.persistencias.append(self.persistencia_faixa(faixa))
+                self.persistencias[-1].start()
+        if self.fps_previa_servidor:
+            self.previa = PreviaFaixas(self, self.fps_previa_servidor)
+            self.previa.start()
+        server.callLater(self.INTERVALO_VERIFICACAO, self.verificar_faixas)
+
+    def persistencia_faixa(self, faixa):
+        '''
+        Persistência do estado de uma faixa nos arquivos dela
+        :param faixa: número da faixa
+        :returns: PersistenciaEstado ainda parada
+        '''
+        arquivo = GerenciadorEstadoJogador.arquivo_faixa
+        return PersistenciaEstado(self.estados[faixa], {
+            arquivo(GerenciadorEstadoJogador.ARQUIVO_ESTADO_JOGADOR, faixa): EstadoJogo.CAMPOS_DETECTOR,
+            arquivo(GerenciadorEstadoJogador.ARQUIVO_ESTADO_VIDA_JOGADOR, faixa): EstadoJogo.CAMPOS_JOGO})
+
+    def iniciar_faixa(self, faixa):
+        '''
+        Inicia o processo de uma faixa
+        :param faixa: número da faixa
+        '''
+        servidor, processo_faixa = multiprocessing.Pipe()
+        # a memória compartilhada precisa existir antes do fork
+        quadro = None
+        if self.fps_previa_servidor:
+            quadro = QuadroCompartilhado(fps=self.fps_previa_servidor)
+        if faixa not in self.estados:
+            # o detector espera o jogo chegar ao menu, até lá a faixa fica parada
+            self.estados[faixa] = EstadoJogo()
+        processo = multiprocessing.Process(
+            target=executar_faixa, name='faixa-{0}'.format(faixa),
+            args=(faixa, self.cameras[faixa], processo_faixa, self.opcoes, self.estados[faixa], quadro,
+                  self.herdados(servidor), os.getpid()))
+        processo.daemon = True
+        processo.start()
+        processo_faixa.close()
+
+        self.faixas[faixa] = (processo, servidor)
+        self.quadros[faixa] = quadro
+        if faixa not in self.latencia:
+            self.latencia[faixa] = MedidorLatencia('faixa {0}'.format(faixa))
+        self.server.addReader(servidor.fileno(), lambda: self.receber_faixa(faixa))
+        print 'Faixa {0} na camera {1}, processo {2}'.format(faixa, self.cameras[faixa], processo.pid)
+
+    def herdados(self, servidor):
+        '''
+        Objetos do servidor que uma faixa nova herda no fork e não usa
+        :param servidor: ponta do servidor no pipe da faixa nova
+        :returns: lista de objetos com close()
+        '''
+        herdados = [servidor, self.server.serversocket, self.server.poller]
+        herdados.extend(pipe for _, pipe in self.faixas.itervalues())
+        herdados.extend(cliente.client for cliente in self.server.connections.itervalues())
+        return herdados
+
+    def receber_faixa(self, faixa):
+        '''
+        Repassa os estados que a faixa mandou aos clientes dela
+        :param faixa: número da faixa
+        '''
+        processo, pipe = self.faixas[faixa]
+        try:
+            while pipe.poll():
+                dados = pipe.recv_bytes()
+                self.repassar(faixa, dados)
+        except EOFError:
+            # a faixa morreu, verificar_faixas a reinicia
+            self.server.removeReader(pipe.fileno())
+
+    def repassar(self, faixa, dados):
+        '''
+        Manda o estado de uma faixa aos clientes dela, binário ou JSON conforme o subprotocolo
+        :param faixa: número da faixa
+        :param dados: estado no formato binário
+        '''
+        binario = GerenciadorEstadoJogador.SUBPROTOCOLO_BINARIO
+        grupo = self.grupo(faixa)
+        estado = GerenciadorEstadoJogador.decodificar_binario(dados)
+        self.server.broadcast(bytearray(dados), filter=lambda cliente: cliente.subprotocol == binario,
+                              group=grupo, key=GerenciadorEstadoJogador.CHAVE_ESTADO)
+        self.server.broadcast(json.dumps(estado),
+                              filter=lambda cliente: cliente.subprotocol != binario,
+                              group=grupo, key=GerenciadorEstadoJogador.CHAVE_ESTADO)
+        # o relógio monotônico é o mesmo nos dois processos, a conta inclui a passagem pelo pipe
+        captura = estado['captura']
+        self.latencia[faixa].registrar_envio(
+            estado['sequencia'], None if captura is None else captura / 1000.0)
+
+    def verificar_faixas(self):
+        '''
+        Reinicia as faixas cujo processo terminou
+        '''
+        for faixa, (processo, pipe) in self.faixas.items():
+            if processo.is_alive():
+                continue
+            logging.warning('faixa ' + str(faixa) + ' terminou com status ' + str(processo.exitcode))
+            self.server.removeReader(pipe.fileno())
+            pipe.close()
+            self.iniciar_faixa(faixa)
+        self.server.callLater(self.INTERVALO_VERIFICACAO, self.verificar_faixas)
+
+    def finalizar(self):
+        '''
+        Termina os processos das faixas
+        '''
+        if self.previa is not None:
+            self.previa.parar()
+        for persistencia in self.persistencias:
+            persistencia.parar()
+        for faixa, (processo, pipe) in self.faixas.items():
+            self.server.removeReader(pipe.fileno())
+            pipe.close()
+            processo.terminate()
+            # o servidor não fica preso a uma faixa que não atende o SIGTERM
+            processo.join(self.ESPERA_TERMINO)
+            if processo.is_alive():
+                os.kill(processo.pid, signal.SIGKILL)
+                processo.join()
+        self.faixas = {}
+
+
+class PreviaFaixas(threading.Thread):
+
+    '''
+    Mostra, no processo do servidor, o que cada faixa publicou no seu QuadroCompartilhado
+    '''
+
+    def __init__(self, pool, fps):
+        '''
+        Construtor da Classe
+        :param pool: pool com os quadros das faixas
+        :param fps: prévias por segundo
+        '''
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.pool = pool
+        self.intervalo = 1.0 / fps
+        self.executando = False
+
+    def start(self):
+        self.executando = True
+        threading.Thread.start(self)
+
+    def run(self):
+        # sequência do último frame mostrado de cada faixa
+        ultimas = {}
+        while self.executando:
+            for faixa, quadro in self.pool.quadros.items():
+                if quadro is None:
+                    continue
+                copia = quadro.copiar(ultimas.get(faixa))
+                if copia is None:
+                    continue
+                ultimas[faixa], frame = copia[0], copia[1]
+                cv2.imshow('{0} - faixa {1}'.format(DetectorMovimento.TITULO_JANELA, faixa), frame)
+            cv2.waitKey(1)
+            time.sleep(self.intervalo)
+        cv2.destroyAllWindows()
+
+    def parar(self):
+        self.executando = False
+        if self.is_alive():
+            self.join()
+
+
+class WebSocketFaixa(WebSocket):
+
+    '''
+    Conexão do jogo com o pool: entra no grupo da faixa pedida e leva a ela as mensagens do jogo
+    '''
+    subprotocols = (GerenciadorEstadoJogador.SUBPROTOCOLO_BINARIO,)
+
+    # aba do jogo fechada ou travada deve matar o jogador rapido
+    pingInterval = 2.0
+    idleTimeout = 6.0
+
+    # as mensagens maiores vão comprimidas para quem oferece permessage-deflate
+    deflate = True
+
+    faixa = None
+
+    def handleConnected(self):
+        try:
+            self.faixa = self.server.pool.faixa_do_caminho(self.request.path)
+        except ValueError as e:
+            print self.address, e
+            self.sendClose()
+            self.server.removeConnection(self)
+            return
+        print self.address, 'connected na faixa', self.faixa
+        self.server.join(self, PoolDetectores.grupo(self.faixa))
+        self.server.pool.estados[self.faixa].atualizar(jogador_vivo=True)
+
+    def handleMessage(self):
+        sequencia = MedidorLatencia.eco(self.data)
+        if sequencia is not None:
+            # o eco do jogo só serve para medir a latência, a faixa não precisa dele
+            self.server.pool.latencia[self.faixa].registrar_eco(sequencia)
+            return
+        print 'Recebeu msg da faixa {0}: '.format(self.faixa), self.data
+        try:
+            self.server.pool.estados[self.faixa].atualizar_json(self.data)
+        except (ValueError, TypeError) as e:
+            print 'Mensagem inválida da faixa {0}:'.format(self.faixa), e
+
+    def handleClose(self):
+        print self.address, 'closed'
+        if self.faixa is not None:
+            self.server.pool.estados[self.faixa].atualizar(jogador_vivo=False)
+
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option("-c", "--cameras", dest="cameras", default="0",
+                      help="ids das cameras (ou fontes de frames) separados por vírgula, uma faixa por camera")
+    parser.add_option("-P", "--porta", dest="porta", type="int", default=1339,
+                      help="porta do WebSocket")
+    parser.add_option("-a", "--desagachar", dest="agachar_desabilitado",
+                      action="store_true", help="Desabilitar agachar", default=False)
+    parser.add_option("-r", "--roi", dest="rastreamento_roi", action="store_true",
+                      help="Rastrear o marcador numa janela em volta da última posição", default=False)
+    parser.add_option("-t", "--tabela-cores", dest="tabela_cores", action="store_true",
+                      help="Limiarizar por uma tabela de cores pré-calculada", default=False)
+    parser.add_option("-k", "--kalman", dest="estimador", action="store_true", default=False,
+                      help="Detectar pulo e agachamento pela previsão de um filtro de Kalman, com menos atraso")
+    parser.add_option("-K", "--confianca", dest="confianca_estimador", type="float",
+                      default=DetectorMovimento.CONFIANCA_ESTIMADOR,
+                      help="Com --kalman, probabilidade mínima da previsão para disparar um movimento")
+    parser.add_option("-m", "--camshift", dest="camshift", action="store_true", default=False,
+                      help="Seguir o marcador pela cor aprendida na calibração, com CamShift")
+    parser.add_option("-s", "--sem-interface", dest="sem_interface", action="store_true",
+                      help="Não desenhar nem abrir janela", default=False)
+    parser.add_option("-p", "--previa", dest="fps_previa", type="float",
+                      help="Sem interface, mostrar uma prévia com essa taxa de frames", default=0)
+    parser.add_option("-v", "--previa-servidor", dest="fps_previa_servidor", type="float",
+                      help="Mostrar a detecção das faixas no processo do servidor com essa taxa de frames",
+                      default=0)
+    parser.add_option("-e", "--persistir", dest="persistir", action="store_true", default=False,
+                      help="Gravar o estado do jogo de cada faixa em arquivos, para quem acompanha por eles")
+    (options, args) = parser.parse_args()
+
+    pool = PoolDetectores(
+        options.cameras.split(','),
+        fps_previa_servidor=options.fps_previa_servidor,
+        persistir=options.persistir,
+        agachar_desabilitado=options.agachar_desabilitado,
+        rastreamento_roi=options.rastreamento_roi,
+        tabela_cores=options.tabela_cores,
+        estimador=options.estimador, confianca_estimador=options.confianca_estimador,
+        camshift=options.camshift,
+        sem_interface=options.sem_interface, fps_previa=options.fps_previa)
+
+    server = SimpleWebSocketServer('', options.porta, WebSocketFaixa)
+    pool.iniciar(server)
+    try:
+        server.serveforever()
+    finally:
+        pool.finalizar()
+        server.close()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# coding:utf-8
+
+import threading
+import time
+import cv2
+
+
+class PreviaDeteccao(threading.Thread):
+
+    '''
+    Mostra a detecção numa janela em ritmo reduzido, numa thread própria.
+    O laço de detecção só oferece o frame; a cópia é feita apenas quando
+    já está na hora de uma nova prévia, e o desenho e a janela ficam por
+    conta desta thread.
+    '''
+
+    def __init__(self, desenhar, titulo, fps=5):
+        '''
+        Construtor da Classe
+        :param desenhar: função que recebe (frame, retangulo, no_centro) e desenha as marcações
+        :param titulo: título da janela
+        :param fps: prévias por segundo
+        '''
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.desenhar = desenhar
+        self.titulo = titulo
+        self.intervalo = 1.0 / fps
+        self.proxima = 0.0
+        self.quadro = None
+        self.executando = False
+        self.condicao = threading.Condition()
+
+    def start(self):
+        '''
+        Inicia a prévia; oferecer() já pode ser chamado assim que start retorna
+        '''
+        self.executando = True
+        threading.Thread.start(self)
+
+    def oferecer(self, frame, retangulo, no_centro):
+        '''
+        Guarda uma cópia do frame se já passou o intervalo desde a última prévia
+        :param frame: frame do laço de detecção, ainda sem marcações
+        :param retangulo: (x, y, w, h) do marcador ou None
+        :param no_centro: se o marcador está dentro do quadrado de calibração
+        '''
+        agora = time.time()
+        if agora < self.proxima:
+            return
+        self.proxima = agora + self.intervalo
+        with self.condicao:
+            self.quadro = (frame.copy(), retangulo, no_centro)
+            self.condicao.notify()
+
+    def run(self):
+        '''
+        Desenha e mostra os frames oferecidos até parar() ser chamado
+        '''
+        while self.executando:
+            with self.condicao:
+                if self.quadro is None:
+                    self.condicao.wait(self.intervalo)
+                quadro, self.quadro = self.quadro, None
+            if quadro is not None:
+                frame, retangulo, no_centro = quadro
+                self.desenhar(frame, retangulo, no_centro)
+                cv2.imshow(self.titulo, frame)
+            # a janela só atualiza atendendo os eventos, na mesma thread do imshow
+            cv2.waitKey(1)
+        cv2.destroyWindow(self.titulo)
+
+    def parar(self):
+        '''
+        Para a prévia e espera a thread terminar
+        '''
+        with self.condicao:
+            self.executando = False
+            self.condicao.notify()
+        if self.is_alive():
+            self.join()
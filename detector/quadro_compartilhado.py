@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# coding:utf-8
+
+import time
+import ctypes
+import multiprocessing
+import numpy as np
+
+
+class QuadroCompartilhado(object):
+
+    '''
+    Último frame da detecção, já com as marcações, e o resultado dele numa
+    memória compartilhada entre o processo da visão e o do servidor. Quem
+    escreve é só o processo da visão; a leitura não trava ninguém: o contador
+    de sequência fica ímpar durante a escrita e quem lê tenta de novo se ele
+    mudou no meio da cópia.
+    A memória é herdada no fork, então o quadro precisa ser criado antes de
+    iniciar o processo da visão.
+    '''
+    # Constantes
+    # x, y, w, h, no_centro e momento da captura; x = -1 sem marcador
+    NUM_CAMPOS_RESULTADO = 6
+    TENTATIVAS_LEITURA = 5
+
+    def __init__(self, largura_maxima=1280, altura_maxima=720, fps=5):
+        '''
+        Construtor da Classe
+        :param largura_maxima: maior largura de frame que cabe na memória
+        :param altura_maxima: maior altura de frame que cabe na memória
+        :param fps: frames publicados por segundo
+        '''
+        self.intervalo = 1.0 / fps
+        self.proxima = 0.0
+        self.sequencia = multiprocessing.RawValue(ctypes.c_ulonglong, 0)
+        self.forma = multiprocessing.RawArray(ctypes.c_int, 2)
+        self.resultado = multiprocessing.RawArray(ctypes.c_double, self.NUM_CAMPOS_RESULTADO)
+        self.memoria = multiprocessing.RawArray(ctypes.c_ubyte, largura_maxima * altura_maxima * 3)
+        self.pixels = np.frombuffer(self.memoria, np.uint8)
+
+    def _frame(self, altura, largura):
+        '''
+        Visão do começo da memória com a forma do frame
+        '''
+        return self.pixels[:altura * largura * 3].reshape(altura, largura, 3)
+
+    def oferecer(self, frame, retangulo, no_centro, desenhar=None):
+        '''
+        Publica o frame se já passou o intervalo desde a última publicação
+        :param frame: frame do laço de detecção, ainda sem marcações
+        :param retangulo: (x, y, w, h) do marcador ou None
+        :param no_centro: se o marcador está dentro do quadrado de calibração
+        :param desenhar: função que desenha as marcações, chamada já sobre a memória compartilhada
+        '''
+        agora = time.time()
+        if agora < self.proxima:
+            return
+        self.proxima = agora + self.intervalo
+        altura, largura = frame.shape[:2]
+        if altura * largura * 3 > self.pixels.size:
+            raise ValueError('Frame {0} x {1} não cabe no quadro compartilhado'.format(largura, altura))
+
+        self.sequencia.value += 1
+        destino = self._frame(altura, largura)
+        np.copyto(destino, frame)
+        if desenhar is not None:
+            desenhar(destino, retangulo, no_centro)
+        self.forma[0], self.forma[1] = altura, largura
+        self.resultado[:] = list(retangulo or (-1, -1, 0, 0)) + [1 if no_centro else 0, agora]
+        self.sequencia.value += 1
+
+    def copiar(self, ultima=None):
+        '''
+        Copia o frame publicado, se houver um mais novo que o último copiado
+        :param ultima: sequência do último frame copiado
+        :returns: (sequência, frame, retangulo, no_centro, momento) ou None se não há frame novo
+        '''
+        for _ in xrange(self.TENTATIVAS_LEITURA):
+            inicio = self.sequencia.value
+            if inicio == 0 or inicio == ultima:
+                return None
+            if inicio % 2:
+                # a visão está escrevendo agora
+                time.sleep(0.001)
+                continue
+            frame = self._frame(self.forma[0], self.forma[1]).copy()
+            x, y, w, h, no_centro, momento = self.resultado[:]
+            if self.sequencia.value == inicio:
+                retangulo = (int(x), int(y), int(w), int(h)) if x >= 0 else None
+                return inicio, frame, retangulo, bool(no_centro), momento
+        return None
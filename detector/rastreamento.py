@@ -0,0 +1,368 @@
+#!/usr/bin/env python
+# coding:utf-8
+
+import cv2
+import numpy as np
+
+
+class Segmentador(object):
+
+    '''
+    Encontra o marcador azul segmentando a imagem inteira pela cor
+    '''
+    # Constantes
+    COR_MINIMA = (110, 100, 80)
+    COR_MAXIMA = (140, 190, 190)
+    ITERACOES_EROSAO = 3
+    ITERACOES_DILATACAO = 10
+
+    def __init__(self, tabela_cores=None):
+        '''
+        Construtor da Classe
+        :param tabela_cores: LimiarLUT que classifica o frame bgr direto, sem passar por hsv
+        '''
+        self.min_cor = np.array(self.COR_MINIMA, np.uint8)
+        self.max_cor = np.array(self.COR_MAXIMA, np.uint8)
+        self.tabela_cores = tabela_cores
+        # buffers das etapas, reaproveitados entre frames e janelas de tamanhos diferentes
+        self.buffers = {}
+
+    def buffer(self, nome, forma, tipo=np.uint8):
+        '''
+        Devolve um array para ser usado como destino de uma etapa, sem alocar a cada frame
+        :param nome: nome da etapa dona do buffer
+        :param forma: forma do array desejado
+        :param tipo: tipo dos elementos
+        :returns: array contíguo com a forma pedida, conteúdo indefinido
+        '''
+        total = int(np.prod(forma))
+        memoria = self.buffers.get(nome)
+        if memoria is None or memoria.size < total or memoria.dtype != tipo:
+            memoria = self.buffers[nome] = np.empty(total, tipo)
+        return memoria[:total].reshape(forma)
+
+    def limiarizar(self, hsv, faixa_cor=None):
+        '''
+        Gera uma faixa de cor
+        :param hsv: imagem no formato de cor hsv
+        :param faixa_cor: buffer de destino, opcional
+        :returns: a faixa de cor
+        '''
+        return cv2.inRange(hsv, self.min_cor, self.max_cor, dst=faixa_cor)
+
+    def localizar(self, imagem, iteracoes_erosao=ITERACOES_EROSAO,
+                  iteracoes_dilatacao=ITERACOES_DILATACAO):
+        '''
+        Localiza o marcador na imagem
+        :param imagem: imagem no formato de cor bgr
+        :param iteracoes_erosao: iterações da erosão, menos em imagens reduzidas
+        :param iteracoes_dilatacao: iterações da dilatação, menos em imagens reduzidas
+        :returns: (x, y, w, h) do maior blob ou None se não houver nenhum
+        '''
+        faixa_cor = self.faixa_de_cor(imagem)
+        erode = self.erodir(faixa_cor, iteracoes_erosao)
+        dilate = self.dilatar(erode, iteracoes_dilatacao)
+        return self.maior_componente(dilate)
+
+    def converter_hsv(self, imagem):
+        '''
+        Converte a imagem para hsv
+        :param imagem: imagem no formato de cor bgr
+        :returns: a imagem em hsv
+        '''
+        return cv2.cvtColor(imagem, cv2.COLOR_BGR2HSV,
+                            dst=self.buffer('hsv', imagem.shape))
+
+    def faixa_de_cor(self, imagem):
+        '''
+        Gera a faixa de cor do marcador direto da imagem bgr
+        :param imagem: imagem no formato de cor bgr
+        :returns: a faixa de cor
+        '''
+        if self.tabela_cores is not None:
+            return self.tabela_cores.aplicar(imagem)
+        return self.limiarizar(self.converter_hsv(imagem),
+                               self.buffer('faixa_cor', imagem.shape[:2]))
+
+    def erodir(self, mascara, iteracoes=ITERACOES_EROSAO):
+        '''
+        Remove da máscara os pontos isolados
+        :param mascara: faixa de cor
+        :param iteracoes: iterações da erosão
+        :returns: a máscara erodida
+        '''
+        return cv2.erode(mascara, None, dst=self.buffer('erode', mascara.shape),
+                         iterations=iteracoes)
+
+    def dilatar(self, mascara, iteracoes=ITERACOES_DILATACAO):
+        '''
+        Junta as partes do marcador que a erosão separou
+        :param mascara: máscara erodida
+        :param iteracoes: iterações da dilatação
+        :returns: a máscara dilatada
+        '''
+        return cv2.dilate(mascara, None, dst=self.buffer('dilate', mascara.shape),
+                          iterations=iteracoes)
+
+    def maior_componente(self, mascara):
+        '''
+        Encontra o componente da máscara de maior retângulo
+        :param mascara: máscara após a morfologia
+        :returns: (x, y, w, h) do maior componente ou None se não houver nenhum
+        '''
+        # o retângulo de cada componente é o mesmo do seu contorno externo
+        num_componentes, _, estatisticas, _ = cv2.connectedComponentsWithStats(
+            mascara, self.buffer('rotulos', mascara.shape, np.int32), connectivity=8)
+        if num_componentes < 2:
+            return None
+
+        # a linha 0 é o fundo
+        componentes = estatisticas[1:]
+        areas = componentes[:, cv2.CC_STAT_WIDTH] * componentes[:, cv2.CC_STAT_HEIGHT]
+        x, y, w, h = componentes[np.argmax(areas), :4]
+        return int(x), int(y), int(w), int(h)
+
+
+class RastreadorROI(object):
+
+    '''
+    Rastreia o marcador do grosso para o fino: quando não sabe onde ele está,
+    procura numa versão reduzida do frame; depois refina em resolução cheia só
+    numa janela ao redor do último retângulo encontrado
+    '''
+    # Constantes
+    # cada nível da pirâmide reduz a imagem pela metade
+    NIVEIS_PIRAMIDE = 2
+    # folga mínima da janela de busca em volta do último retângulo, em px
+    MARGEM_JANELA = 80
+
+    def __init__(self, segmentador):
+        '''
+        Construtor da Classe
+        :param segmentador: Segmentador usado nas duas etapas
+        '''
+        self.segmentador = segmentador
+        self.ultimo = None
+        self.escala = 2 ** self.NIVEIS_PIRAMIDE
+
+    def localizar(self, imagem):
+        '''
+        Localiza o marcador na imagem
+        :param imagem: imagem no formato de cor bgr
+        :returns: (x, y, w, h) do marcador ou None se ele foi perdido
+        '''
+        if self.ultimo is not None:
+            retangulo = self._refinar(imagem, self.ultimo)
+            if retangulo is not None:
+                self.ultimo = retangulo
+                return retangulo
+
+        aproximado = self._buscar_reduzido(imagem)
+        if aproximado is None:
+            self.ultimo = None
+            return None
+
+        retangulo = self._refinar(imagem, aproximado)
+        if retangulo is None:
+            # a busca reduzida achou algo que a janela não confirmou, varre o frame inteiro
+            retangulo = self.segmentador.localizar(imagem)
+        self.ultimo = retangulo
+        return retangulo
+
+    def _buscar_reduzido(self, imagem):
+        '''
+        Procura o marcador no frame inteiro, num nível reduzido da pirâmide
+        :param imagem: imagem no formato de cor bgr
+        :returns: (x, y, w, h) aproximado em coordenadas do frame ou None
+        '''
+        reduzida = imagem
+        for _ in xrange(self.NIVEIS_PIRAMIDE):
+            reduzida = cv2.pyrDown(reduzida)
+
+        retangulo = self.segmentador.localizar(
+            reduzida,
+            max(1, int(round(self.segmentador.ITERACOES_EROSAO / float(self.escala)))),
+            max(1, int(round(self.segmentador.ITERACOES_DILATACAO / float(self.escala)))))
+        if retangulo is None:
+            return None
+        return tuple(valor * self.escala for valor in retangulo)
+
+    def _refinar(self, imagem, retangulo):
+        '''
+        Segmenta em resolução cheia só a janela em volta do retângulo
+        :param imagem: imagem no formato de cor bgr
+        :param retangulo: (x, y, w, h) de referência
+        :returns: (x, y, w, h) do marcador ou None se ele saiu da janela
+        '''
+        altura, largura = imagem.shape[:2]
+        x, y, w, h = retangulo
+        margem_x = max(self.MARGEM_JANELA, w)
+        margem_y = max(self.MARGEM_JANELA, h)
+        x0, y0 = max(0, x - margem_x), max(0, y - margem_y)
+        x1, y1 = min(largura, x + w + margem_x), min(altura, y + h + margem_y)
+
+        encontrado = self.segmentador.localizar(imagem[y0:y1, x0:x1])
+        if encontrado is None:
+            return None
+
+        ex, ey, ew, eh = encontrado
+        # encostou numa borda da janela que não é borda do frame: o marcador pode estar cortado
+        if (ex == 0 and x0 > 0) or (ey == 0 and y0 > 0) or \
+                (ex + ew == x1 - x0 and x1 < largura) or (ey + eh == y1 - y0 and y1 < altura):
+            return None
+        return ex + x0, ey + y0, ew, eh
+
+
+class RastreadorCamShift(object):
+
+    '''
+    Rastreia o marcador pela cor aprendida na calibração: guarda o histograma
+    de matiz do marcador dentro do quadrado de calibração e, daí em diante,
+    segue o marcador com retroprojeção e CamShift só numa janela em volta da
+    última posição. O tamanho da janela do CamShift oscila de um frame para o
+    outro, então o retângulo devolvido tem o tamanho aprendido, centrado nela,
+    e o y dele não treme. Só a matiz entra no histograma, então a detecção aguenta
+    melhor a mudança de luz do local que as faixas fixas de hsv. Quando a
+    confiança cai, procura de novo pela retroprojeção no frame inteiro; antes
+    da calibração, e se isso também falhar, usa o Segmentador.
+    '''
+    # Constantes
+    NUM_FAIXAS_MATIZ = 32
+    # pixels escuros ou sem cor têm matiz instável e ficam fora do histograma e da retroprojeção
+    SATURACAO_MINIMA = 60
+    BRILHO_MINIMO = 40
+    # folga mínima da janela de busca em volta do último retângulo, em px
+    MARGEM_JANELA = 80
+    # média da retroprojeção (0 a 1) dentro do retângulo abaixo da qual o marcador foi perdido
+    CONFIANCA_MINIMA = 0.3
+    # o retângulo do CamShift não pode encolher ou crescer mais que isso em área em relação ao aprendido
+    VARIACAO_AREA = 4.0
+    # retroprojeção mínima (0 a 255) de um pixel na nova procura pelo frame inteiro
+    LIMIAR_REDETECCAO = 64
+    CRITERIO_CAMSHIFT = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 10, 1)
+
+    def __init__(self, segmentador):
+        '''
+        Construtor da Classe
+        :param segmentador: Segmentador usado antes da calibração e como último recurso
+        '''
+        self.segmentador = segmentador
+        self.histograma = None
+        self.tamanho = None
+        # janela do CamShift, adapta o tamanho ao marcador e serve de ponto de partida do próximo frame
+        self.janela = None
+        self.imagem = None
+        self.min_cor = np.array((0, self.SATURACAO_MINIMA, self.BRILHO_MINIMO), np.uint8)
+        self.max_cor = np.array((180, 255, 255), np.uint8)
+
+    def aprender(self, retangulo):
+        '''
+        Aprende o histograma de matiz do marcador no último frame localizado
+        :param retangulo: (x, y, w, h) do marcador dentro do quadrado de calibração
+        '''
+        x, y, w, h = retangulo
+        marcador = self.imagem[y:y + h, x:x + w]
+        hsv = cv2.cvtColor(marcador, cv2.COLOR_BGR2HSV)
+        # o retângulo sai da máscara dilatada e pega uma borda do fundo, só a cor do marcador entra
+        mascara = cv2.bitwise_and(cv2.inRange(hsv, self.min_cor, self.max_cor),
+                                  self.segmentador.faixa_de_cor(marcador))
+        histograma = cv2.calcHist([hsv], [0], mascara, [self.NUM_FAIXAS_MATIZ], [0, 180])
+        cv2.normalize(histograma, histograma, 0, 255, cv2.NORM_MINMAX)
+        self.histograma = histograma
+        self.tamanho = (w, h)
+        self.janela = retangulo
+
+    def esquecer(self):
+        '''
+        Descarta o histograma aprendido, o marcador volta a ser achado pelo Segmentador
+        '''
+        self.histograma = None
+        self.janela = None
+
+    def localizar(self, imagem):
+        '''
+        Localiza o marcador na imagem
+        :param imagem: imagem no formato de cor bgr
+        :returns: (x, y, w, h) do marcador ou None se ele foi perdido
+        '''
+        # aprender() usa o frame em que a calibração aconteceu
+        self.imagem = imagem
+        if self.histograma is None:
+            return self.segmentador.localizar(imagem)
+
+        if self.janela is not None:
+            self.janela = self._seguir(imagem, self.janela)
+        if self.janela is None:
+            self.janela = self._redetectar(imagem)
+        if self.janela is None:
+            return None
+        x, y, w, h = self.janela
+        largura, altura = self.tamanho
+        return x + (w - largura) / 2, y + (h - altura) / 2, largura, altura
+
+    def _retroprojetar(self, imagem):
+        '''
+        Probabilidade de cada pixel ser do marcador, pelo histograma aprendido
+        :param imagem: imagem (ou janela) no formato de cor bgr
+        :returns: retroprojeção de 0 a 255, zerada nos pixels escuros ou sem cor
+        '''
+        forma = imagem.shape[:2]
+        hsv = cv2.cvtColor(imagem, cv2.COLOR_BGR2HSV,
+                           dst=self.segmentador.buffer('camshift_hsv', imagem.shape))
+        retroprojecao = cv2.calcBackProject([hsv], [0], self.histograma, [0, 180], 1)
+        mascara = cv2.inRange(hsv, self.min_cor, self.max_cor,
+                              dst=self.segmentador.buffer('camshift_mascara', forma))
+        return cv2.bitwise_and(retroprojecao, mascara, dst=retroprojecao)
+
+    def _confiavel(self, retroprojecao, retangulo):
+        '''
+        Confere se o retângulo ainda é o marcador
+        :param retroprojecao: retroprojeção da janela
+        :param retangulo: (x, y, w, h) na janela
+        :returns: True se a área é plausível e a cor dentro dele bate com a aprendida
+        '''
+        x, y, w, h = retangulo
+        if w <= 0 or h <= 0:
+            return False
+        variacao = w * h / float(self.tamanho[0] * self.tamanho[1])
+        if variacao > self.VARIACAO_AREA or variacao < 1 / self.VARIACAO_AREA:
+            return False
+        return cv2.mean(retroprojecao[y:y + h, x:x + w])[0] / 255.0 >= self.CONFIANCA_MINIMA
+
+    def _seguir(self, imagem, retangulo):
+        '''
+        Move o retângulo com o CamShift numa janela em volta dele
+        :param imagem: imagem no formato de cor bgr
+        :param retangulo: (x, y, w, h) do frame anterior
+        :returns: (x, y, w, h) do marcador ou None se a confiança caiu
+        '''
+        altura, largura = imagem.shape[:2]
+        x, y, w, h = retangulo
+        margem_x = max(self.MARGEM_JANELA, w)
+        margem_y = max(self.MARGEM_JANELA, h)
+        x0, y0 = max(0, x - margem_x), max(0, y - margem_y)
+        x1, y1 = min(largura, x + w + margem_x), min(altura, y + h + margem_y)
+
+        retroprojecao = self._retroprojetar(imagem[y0:y1, x0:x1])
+        _, (ex, ey, ew, eh) = cv2.CamShift(retroprojecao, (x - x0, y - y0, w, h), self.CRITERIO_CAMSHIFT)
+        if not self._confiavel(retroprojecao, (ex, ey, ew, eh)):
+            return None
+        return int(ex + x0), int(ey + y0), int(ew), int(eh)
+
+    def _redetectar(self, imagem):
+        '''
+        Procura o marcador no frame inteiro, pela retroprojeção e depois pela segmentação
+        :param imagem: imagem no formato de cor bgr
+        :returns: (x, y, w, h) do marcador ou None se ele não está no frame
+        '''
+        retroprojecao = self._retroprojetar(imagem)
+        mascara = cv2.threshold(retroprojecao, self.LIMIAR_REDETECCAO, 255, cv2.THRESH_BINARY,
+                                dst=self.segmentador.buffer('camshift_limiar', retroprojecao.shape))[1]
+        mascara = self.segmentador.dilatar(self.segmentador.erodir(mascara, 1), 2)
+        retangulo = self.segmentador.maior_componente(mascara)
+        if retangulo is not None and self._confiavel(retroprojecao, retangulo):
+            return retangulo
+        retangulo = self.segmentador.localizar(imagem)
+        if retangulo is not None and self._confiavel(retroprojecao, retangulo):
+            return retangulo
+        return None
@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# coding:utf-8
+
+import sys
+import time
+import ctypes
+import ctypes.util
+
+
+class _Timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+
+def _carregar_clock_gettime():
+    '''
+    Procura o clock_gettime da libc (ou da librt, nas glibc antigas)
+    :returns: a função ou None se o sistema não tiver
+    '''
+    for nome in ('c', 'rt'):
+        caminho = ctypes.util.find_library(nome)
+        if caminho is None:
+            continue
+        try:
+            funcao = ctypes.CDLL(caminho, use_errno=True).clock_gettime
+        except (OSError, AttributeError):
+            continue
+        funcao.argtypes = [ctypes.c_int, ctypes.POINTER(_Timespec)]
+        funcao.restype = ctypes.c_int
+        return funcao
+    return None
+
+
+# o relógio monotônico é o mesmo para todos os processos da máquina, então o
+# momento da captura numa faixa pode ser comparado com o relógio do servidor
+CLOCK_MONOTONIC = 6 if sys.platform == 'darwin' else 1
+_clock_gettime = _carregar_clock_gettime()
+
+
+def monotonico():
+    '''
+    Momento atual num relógio que não volta nem salta com o ajuste da hora do sistema
+    :returns: segundos desde um ponto arbitrário; time.time() se o sistema não tiver relógio monotônico
+    '''
+    if _clock_gettime is None:
+        return time.time()
+    # uma estrutura por chamada, a captura e o servidor leem o relógio em threads diferentes
+    agora = _Timespec()
+    if _clock_gettime(CLOCK_MONOTONIC, ctypes.byref(agora)) != 0:
+        return time.time()
+    return agora.tv_sec + agora.tv_nsec * 1e-9
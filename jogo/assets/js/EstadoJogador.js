@@ -0,0 +1,35 @@
+// estado do jogador enviado pelo detector, em JSON ou no formato binário
+BasicGame.EstadoJogador = {
+
+    // subprotocolo em que o detector envia o estado como frame binário
+    SUBPROTOCOLOS: ['jump-estado-binario'],
+
+    // endereço do detector; com vários jogadores na mesma máquina, a faixa vem
+    // da página (index.html?faixa=1) e segue na query da conexão
+    endereco: function (base) {
+        var faixa = /[?&]faixa=(\d+)/.exec(window.location.search);
+        return faixa ? base + '/?faixa=' + faixa[1] : base;
+    },
+
+    // movimento (int8), calibrado (uint8), sequência (uint32) e momento da
+    // captura em ms (float64, no relógio do detector; 0 quando não veio de um frame)
+    decodificar: function (dados) {
+        if (dados instanceof ArrayBuffer) {
+            var visao = new DataView(dados);
+            return {
+                'movimento': visao.getInt8(0),
+                'calibrado': visao.getUint8(1) == 1,
+                'sequencia': visao.getUint32(2),
+                'captura': visao.getFloat64(6) || null
+            };
+        }
+        return JSON.parse(dados);
+    },
+
+    // devolve a sequência do estado assim que ele chega, o detector mede a latência com ela
+    ecoar: function (conexao, estado) {
+        if (estado['sequencia'] !== undefined) {
+            conexao.send(JSON.stringify({'eco': estado['sequencia']}));
+        }
+    }
+};
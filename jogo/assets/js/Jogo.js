@@ -47,13 +47,15 @@ BasicGame.Jogo.prototype = {
         this.ultimo_eixo_x = 500;
 
         if (window.WebSocket) {
-            this.conexao = new WebSocket('ws://127.0.0.1:1338');
+            this.conexao = new WebSocket(BasicGame.EstadoJogador.endereco('ws://127.0.0.1:1338'), BasicGame.EstadoJogador.SUBPROTOCOLOS);
+            this.conexao.binaryType = 'arraybuffer';
             console.log("Conectou ao websocket: ws://127.0.0.1:1338");
             this.conexao.onopen = function() {
                  this.aberto = true;
             }
             this.conexao.onmessage = function(message) {
-                this.estado_jogador = JSON.parse(message.data);
+                this.estado_jogador = BasicGame.EstadoJogador.decodificar(message.data);
+                BasicGame.EstadoJogador.ecoar(this, this.estado_jogador);
                 this.movimento = this.estado_jogador['movimento'];
                 console.log("Estado Jogador: ", this.estado_jogador);
             }
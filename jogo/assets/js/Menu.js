@@ -55,10 +55,12 @@ BasicGame.Menu.prototype = {
                 }
             }
 
-            this.conexao_webcam = new WebSocket('ws://127.0.0.1:1338');
+            this.conexao_webcam = new WebSocket(BasicGame.EstadoJogador.endereco('ws://127.0.0.1:1338'), BasicGame.EstadoJogador.SUBPROTOCOLOS);
+            this.conexao_webcam.binaryType = 'arraybuffer';
             this.conexao_webcam.menu = this;
             this.conexao_webcam.onmessage = function(message) {
-                this.estado_jogador = JSON.parse(message.data);
+                this.estado_jogador = BasicGame.EstadoJogador.decodificar(message.data);
+                BasicGame.EstadoJogador.ecoar(this, this.estado_jogador);
                 this.calibrado = this.estado_jogador['calibrado'];
 
                 console.log("Calibrado: ", this.calibrado);